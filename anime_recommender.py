@@ -1,9 +1,13 @@
 """This is the main Python file to create the anime recommender system."""
 
+import glob
+import os
 import time
 import pickle
+import queue
+import threading
 from tqdm import tqdm
-from src import data_cleaning as dc, recommender as rec, scrape
+from src import ann, artifacts, data_cleaning as dc, item_neighbours, nmf_update, prefix_index, recommender as rec, scrape, sharding, telemetry
 import pandas as pd
 from joblib import Parallel, delayed
 from sklearn.decomposition import NMF
@@ -12,26 +16,48 @@ from sklearn.metrics import pairwise_distances
 # These will be all the users included in my recommender system. In this project,
 # I got data on 120,000 users.
 BASE_URL = 'https://myanimelist.net/users.php'
+# Raw pages are archived here so they can be re-parsed with src/reparse.py
+# after a parser fix instead of rescraping
+ARCHIVE_DIR = '../archive'
+# Scraper latency/outcome metrics are exported here (summarize them with
+# python -m src.telemetry ../metrics). Set before Parallel so workers inherit it.
+os.environ[telemetry.METRICS_DIR_ENV] = '../metrics'
+# IDs of users whose animelists are saved are appended here, so rerunning only
+# scrapes new users
+USER_ID_STORE = '../pickles/user_ids.txt'
 mal_user_ids_urls = scrape.get_mal_user_ids_urls(BASE_URL, num_users=240)
-user_ids = scrape.get_mal_user_ids(mal_user_ids_urls)
+
+# Find user IDs in a background thread so scraping can start as soon as the
+# first 100 new IDs are found instead of waiting for every users.php page
+user_id_queue = queue.Queue()
+threading.Thread(target=scrape.discover_mal_user_ids,
+                 args=(mal_user_ids_urls, USER_ID_STORE, user_id_queue),
+                 kwargs={'archive_dir': ARCHIVE_DIR}, daemon=True).start()
 
 # Scrape user animelists
 # NOTE: Running this will take a long time (multiple days on a single machine).
 # It's best to use a Docker container to deploy the web scraping script across 
 # multiple cloud instances (I used Google Cloud Compute Engine).
 # Please refer to my containers folder to see how I set up my Docker container
-for i in tqdm(range(1200)):
+# Continue numbering after the chunks scraped in earlier runs
+num_chunks = len(glob.glob('../pickles/animelist_data_100_*.pkl'))
+for user_ids_chunk in tqdm(scrape.iter_queue_chunks(user_id_queue, 100)):
     animelist_data_100_chunk = Parallel(n_jobs=4, verbose=5) \
-        (map(delayed(scrape.get_animelist_data), user_ids[i*100:i*100+100]))
+        (delayed(scrape.get_animelist_data)(user_id, ARCHIVE_DIR)
+         for user_id in user_ids_chunk)
     scrape.driver.quit()
-    with open(f'../pickles/animelist_data_100_{i}.pkl', 'wb') as to_write:
+    with open(f'../pickles/animelist_data_100_{num_chunks}.pkl', 'wb') as to_write:
         pickle.dump(animelist_data_100_chunk, to_write)
+    # Only now are these users done; if the run crashes before this, the next
+    # run discovers and scrapes them again
+    scrape.add_to_user_id_store(USER_ID_STORE, user_ids_chunk)
+    num_chunks += 1
     # Pause for 3 minutes to let web server "rest"
     time.sleep(180)
 
 # Concatenate all the animelist_data_chunks into a complete_animelist
 complete_animelist = []
-for i in tqdm(range(1200)):
+for i in tqdm(range(num_chunks)):
     with open(f'../pickles/animelist_data_100_{i}.pkl', 'rb') as read_file:
         animelist_data_chunk = pickle.load(read_file)
     complete_animelist += animelist_data_chunk
@@ -39,7 +65,7 @@ for i in tqdm(range(1200)):
 # Scrape data on 1,000 top anime on MyAnimeList
 mal_ids_top_1000_anime = scrape.get_top_anime_mal_ids(num_top_anime=1000)
 top_anime_data_1000 = [
-    scrape.get_animelist_data(user_id) for user_id in tqdm(mal_ids_top_1000_anime)
+    scrape.get_anime_data(mal_id, ARCHIVE_DIR) for mal_id in tqdm(mal_ids_top_1000_anime)
 ]
 top_anime_data_1000_df = pd.DataFrame(top_anime_data_1000)
 anime_titles = top_anime_data_1000_df['title_main'].to_list()
@@ -57,10 +83,20 @@ top_anime_df = dc.clean_top_anime_data_1000_df(top_anime_data_1000_df)
 #####COLLABORATIVE FILTERING RECOMMENDER#####
 
 # Use NMF (non-negative matrix factorization) to create user/a/nime embeddings
-# for collaborative-filtering
+# for collaborative-filtering. To compare other n_components/max_iter values and
+# content feature sets, see src/sweep.py
 nmf = NMF(n_components=6, max_iter=500, random_state=4444)
 user_embedding = nmf.fit_transform(user_score_df.drop(columns=['user_id', 'animelist_url']))
 
+# Keep the fit and its sufficient statistics so that new or changed users can
+# be added later with src/nmf_update.py instead of refitting from scratch
+nmf_state = nmf_update.create_nmf_state(
+    user_score_df['user_id'], anime_titles,
+    user_score_df.drop(columns=['user_id', 'animelist_url']).values,
+    user_embedding, nmf.components_)
+with open('../pickles/nmf_state.pkl', 'wb') as f:
+    pickle.dump(nmf_state, f)
+
 user_embedding_df = pd.DataFrame(user_embedding.round(2))
 anime_embedding_df = pd.DataFrame(nmf.components_.round(2),
                                   columns=anime_titles)
@@ -112,7 +148,35 @@ user_anime_cosine_distances_content = pairwise_distances(user_vector_df, top_ani
 
 #####PICKLE#####
 
-#Pickle recommender components to be used in production (e.g. in a Flask app)
+#Pickle recommender components for analysis (the Flask app uses the bundle below)
 with open('../pickles/rec_data.pkl', 'wb') as f:
     pickle.dump([user_anime_cosine_distances_content, user_anime_cosine_distances_collab,
                  user_score_df, user_anime_history_df, anime_titles], f)
+
+# Write the serving bundle for the Flask app (see src/artifacts.py). Besides the
+# top candidates of each user, it holds the anime-side factors for folding in new
+# or updated users without retraining (src/fold_in.py), IVF indexes so fold-in
+# recommendations only rank a few clusters of anime (src/ann.py), and the top
+# similar anime for every anime (src/item_neighbours.py).
+anime_features = top_anime_df_core.values.astype(float)
+ann_indexes = {'collab': ann.build_ivf_index(nmf.components_.T),
+               'content': ann.build_ivf_index(anime_features)}
+neighbour_table = item_neighbours.create_neighbour_table(nmf.components_, anime_features)
+serving_arrays = artifacts.create_serving_arrays(
+    user_anime_cosine_distances_content, user_anime_cosine_distances_collab,
+    user_score_df.drop(columns=['user_id', 'animelist_url']).values,
+    user_anime_history_df_core.values, nmf.components_, anime_features,
+    ann_indexes, neighbour_table)
+serving_ids = artifacts.create_serving_ids(user_score_df['user_id'], anime_titles, top_anime_df)
+# Sorted keys for autocompleting user IDs and anime titles (src/prefix_index.py)
+serving_arrays.update(prefix_index.create_user_prefix_arrays(serving_ids['user_ids']))
+serving_arrays.update(prefix_index.create_title_prefix_arrays(anime_titles, top_anime_df))
+# With more than 1 shard, each shard only gets the candidates and seen sets of its
+# own users under ../artifacts/shard-<n>, and flask/router.py forwards requests to
+# the shard that owns the user (see src/sharding.py)
+NUM_SHARDS = 1
+# Publishing a new version makes a running Flask app swap to it without restarting
+if NUM_SHARDS > 1:
+    sharding.publish_sharded_bundles('../artifacts', serving_arrays, serving_ids, NUM_SHARDS)
+else:
+    artifacts.publish_bundle('../artifacts', serving_arrays, serving_ids)
@@ -0,0 +1,89 @@
+"""Benchmarks parse.parse_animelist_rows against get_animelist_titles and
+get_animelist_scores on a corpus of saved animelist pages.
+
+Usage (from the repo root):
+    python -m benchmarks.animelist_parse_benchmark path/to/saved_animelist_pages
+
+Save pages with driver.page_source after create_soup_selenium has loaded them,
+since animelists are rendered with JavaScript. Every *.html file in the
+directory is parsed both ways. The script reports the time per page and the
+pages where the old functions returned titles and scores of different lengths.
+"""
+
+import argparse
+import time
+from pathlib import Path
+from src import parse
+
+
+def parse_legacy(html):
+    """Returns (titles, scores) the way get_animelist_data used to: html5lib
+    and two separate passes over the rows."""
+    soup = parse.create_page_soup(html, 'html5lib')
+    return parse.get_animelist_titles(soup), parse.get_animelist_scores(soup)
+
+
+def parse_single_pass(html, parser=parse.PARSER):
+    """Returns (titles, scores) using the single-pass row parser."""
+    return parse.parse_animelist_rows(parse.create_page_soup(html, parser))
+
+
+def time_pages(parse_func, pages, repeat):
+    """Returns total seconds to parse all pages, best of repeat runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for html in pages:
+            parse_func(html)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('pages_dir', help='Directory of saved animelist *.html files.')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='Times to parse the corpus (best time is kept).')
+    args = arg_parser.parse_args()
+
+    paths = sorted(Path(args.pages_dir).glob('*.html'))
+    if not paths:
+        raise SystemExit(f'No *.html files found in {args.pages_dir}')
+    pages = [path.read_text(encoding='utf-8') for path in paths]
+
+    misaligned = []
+    different = []
+    for path, html in zip(paths, pages):
+        legacy_titles, legacy_scores = parse_legacy(html)
+        titles, scores = parse_single_pass(html)
+        if legacy_titles is not None and len(legacy_titles) != len(legacy_scores):
+            # fix_mismatching_animelist_len would have zeroed this user's scores
+            misaligned.append(path.name)
+        elif (legacy_titles, legacy_scores) != (titles, scores):
+            different.append(path.name)
+
+    approaches = [
+        ('two passes, html5lib', parse_legacy),
+        ('single pass, html5lib', lambda html: parse_single_pass(html, 'html5lib')),
+        (f'single pass, {parse.PARSER}', parse_single_pass)
+    ]
+    print(f'{len(pages)} pages, best of {args.repeat}')
+    baseline = None
+    for name, parse_func in approaches:
+        total = time_pages(parse_func, pages, args.repeat)
+        baseline = baseline or total
+        print(f'{name:<30} {1000*total/len(pages):8.2f} ms/page  '
+              f'{baseline/total:5.1f}x')
+
+    print(f'{len(misaligned)} pages where the old titles and scores did not line up '
+          '(now kept with unscored rows as \'-\')')
+    if different:
+        print(f'{len(different)} aligned pages with different output:')
+        for name in different:
+            print(f'  {name}')
+    else:
+        print('Output identical on all aligned pages.')
+
+
+if __name__ == '__main__':
+    main()
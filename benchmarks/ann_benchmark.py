@@ -0,0 +1,79 @@
+"""Benchmarks the IVF index in src/ann.py against exact search.
+
+Reports recall@k of the index (the fraction of the exact top-k that it finds)
+and query latency for several num_probe values, on synthetic NMF components and
+content features. Run from the repo root:
+
+    python -m benchmarks.ann_benchmark --num-anime 20000
+"""
+
+import argparse
+import time
+
+import numpy as np
+from sklearn.decomposition import NMF
+
+from benchmarks import synthetic
+from src import ann
+
+NUM_PROBES = [1, 2, 4, 8, 16, 32]
+
+
+def get_recall(index, vectors, queries, k, num_probe):
+    """Returns (mean recall@k, mean query ms) of index over queries."""
+    recalls = []
+    total_time = 0
+    for query in queries:
+        exact_idxs, _ = ann.exact_search(vectors, query, k)
+        start = time.perf_counter()
+        idxs, _ = ann.query_ivf_index(index, query, k, num_probe)
+        total_time += time.perf_counter() - start
+        recalls.append(len(np.intersect1d(idxs, exact_idxs)) / len(exact_idxs))
+    return np.mean(recalls), total_time / len(queries) * 1000
+
+
+def get_exact_ms(vectors, queries, k):
+    """Returns mean exact search ms over queries."""
+    start = time.perf_counter()
+    for query in queries:
+        ann.exact_search(vectors, query, k)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def run(name, vectors, queries, k):
+    vectors = ann.normalize_rows(vectors)
+    start = time.perf_counter()
+    index = ann.build_ivf_index(vectors)
+    print(f'\n{name}: {vectors.shape[0]} x {vectors.shape[1]}, '
+          f'{len(index["centroids"])} lists, built in {time.perf_counter() - start:.2f}s')
+    print(f'  exact      {get_exact_ms(vectors, queries, k):7.3f} ms  recall@{k} 1.000')
+    for num_probe in NUM_PROBES:
+        if num_probe > len(index['centroids']):
+            break
+        recall, ms = get_recall(index, vectors, queries, k, num_probe)
+        print(f'  probe {num_probe:<4} {ms:7.3f} ms  recall@{k} {recall:.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-users', type=int, default=20000)
+    parser.add_argument('--num-anime', type=int, default=20000)
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=50)
+    args = parser.parse_args()
+
+    user_score_matrix, history = synthetic.make_user_score_matrix(args.num_users, args.num_anime)
+    nmf = NMF(n_components=6, max_iter=200, random_state=4444)
+    user_embedding = nmf.fit_transform(user_score_matrix)
+    rng = np.random.default_rng(4444)
+    query_users = rng.choice(args.num_users, args.num_queries, replace=False)
+    run('collab', nmf.components_.T, user_embedding[query_users], args.k)
+
+    # Content queries are mean feature vectors of animelists, like fold_in does
+    anime_features = synthetic.make_anime_features(args.num_anime)
+    content_queries = history[query_users] @ anime_features
+    run('content', anime_features, np.asarray(content_queries), args.k)
+
+
+if __name__ == '__main__':
+    main()
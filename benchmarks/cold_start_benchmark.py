@@ -0,0 +1,140 @@
+"""Compares cold start and request latency of the pandas recommender against the
+NumPy serving runtime in flask/recommendation/runtime.py.
+
+Usage (from the repo root):
+    python -m benchmarks.cold_start_benchmark --num-users 20000 --num-anime 1000
+
+Writes synthetic artifacts in both formats (rec_data.pkl with DataFrames and a
+src/artifacts.py bundle) to a temporary directory, then starts a fresh Python
+process for each that imports its modules, loads its artifacts and serves one
+recommendation. Reports import + load time, first request time, mean request
+time over a few users, and peak RSS of the process.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from src import artifacts
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NUM_REQUESTS = 20
+
+# Each snippet prints JSON timings; {dir} is the artifact directory
+PANDAS_SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import pickle
+from recommendation.recommender import recommend
+with open('{dir}/rec_data.pkl', 'rb') as f:
+    content, collab, user_score_df, user_anime_history_df, anime_titles = pickle.load(f)
+loaded = time.perf_counter()
+user_ids = user_score_df['user_id'].tolist()[:{num_requests}]
+recommend(user_ids[0], content, collab, user_score_df, user_anime_history_df, anime_titles)
+first = time.perf_counter()
+for user_id in user_ids:
+    recommend(user_id, content, collab, user_score_df, user_anime_history_df, anime_titles)
+done = time.perf_counter()
+'''
+
+RUNTIME_SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+from recommendation import runtime as rt
+runtime = rt.load_runtime('{dir}/bundle')
+loaded = time.perf_counter()
+user_ids = runtime['user_ids'][:{num_requests}]
+rt.recommend(runtime, user_ids[0])
+first = time.perf_counter()
+for user_id in user_ids:
+    rt.recommend(runtime, user_id)
+done = time.perf_counter()
+'''
+
+# ru_maxrss survives exec on Linux and would report this process's peak, so
+# the peak RSS of the child is read from VmHWM instead
+REPORT_SNIPPET = '''
+with open('/proc/self/status') as f:
+    max_rss_kb = int([line for line in f if line.startswith('VmHWM')][0].split()[1])
+print(json.dumps({{'load_s': loaded - start, 'first_request_ms': (first - loaded) * 1000,
+                  'request_ms': (done - first) / len(user_ids) * 1000,
+                  'pandas_imported': 'pandas' in sys.modules,
+                  'max_rss_mb': max_rss_kb / 1024}}))
+'''
+
+
+def get_cosine_distances(user_vectors, anime_vectors):
+    """Returns user x anime cosine distance matrix."""
+    user_norms = np.linalg.norm(user_vectors, axis=1, keepdims=True)
+    anime_norms = np.linalg.norm(anime_vectors, axis=1, keepdims=True)
+    return 1 - (user_vectors / np.maximum(user_norms, 1e-12)) \
+        @ (anime_vectors / np.maximum(anime_norms, 1e-12)).T
+
+
+def write_artifacts(artifact_dir, num_users, num_anime):
+    """Writes rec_data.pkl and a serving bundle for synthetic data."""
+    user_score_matrix, history = synthetic.make_user_score_matrix(num_users, num_anime)
+    user_scores = user_score_matrix.toarray()
+    user_anime_history = history.toarray()
+    anime_titles = synthetic.make_anime_titles(num_anime)
+    user_ids = synthetic.make_user_ids(num_users)
+    anime_features = synthetic.make_anime_features(num_anime)
+    rng = np.random.default_rng(4444)
+    user_embedding = rng.gamma(0.5, 1.0, (num_users, synthetic.NUM_TASTES))
+    components = rng.gamma(0.5, 1.0, (synthetic.NUM_TASTES, num_anime))
+    collab = get_cosine_distances(user_embedding, components.T)
+    user_vectors = user_anime_history @ anime_features \
+        / np.maximum(user_anime_history.sum(axis=1, keepdims=True), 1)
+    content = get_cosine_distances(user_vectors, anime_features)
+
+    user_score_df = pd.DataFrame(user_scores, columns=anime_titles)
+    user_anime_history_df = pd.DataFrame(user_anime_history, columns=anime_titles)
+    for df in [user_score_df, user_anime_history_df]:
+        df.insert(0, 'animelist_url', '')
+        df.insert(0, 'user_id', user_ids)
+    with open(os.path.join(artifact_dir, 'rec_data.pkl'), 'wb') as f:
+        pickle.dump([content, collab, user_score_df, user_anime_history_df, anime_titles], f)
+
+    top_anime_df = pd.DataFrame({'title_main': anime_titles, 'url': '', 'image_url': ''})
+    arrays = artifacts.create_serving_arrays(content, collab, user_scores, user_anime_history,
+                                             components, anime_features)
+    artifacts.save_bundle(os.path.join(artifact_dir, 'bundle'), arrays,
+                          artifacts.create_serving_ids(user_ids, anime_titles, top_anime_df))
+
+
+def run_snippet(snippet, artifact_dir, num_requests):
+    """Returns timings dict printed by snippet in a fresh Python process."""
+    code = (snippet + REPORT_SNIPPET).format(dir=artifact_dir, num_requests=num_requests)
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                            text=True, cwd=os.path.join(REPO_DIR, 'flask'))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-users', type=int, default=20000)
+    parser.add_argument('--num-anime', type=int, default=1000)
+    parser.add_argument('--num-requests', type=int, default=NUM_REQUESTS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as artifact_dir:
+        write_artifacts(artifact_dir, args.num_users, args.num_anime)
+        print(f'{args.num_users} users x {args.num_anime} anime')
+        print(f'{"":10}{"load s":>10}{"first ms":>10}{"req ms":>10}{"RSS MB":>10}  pandas')
+        for name, snippet in [('pandas', PANDAS_SNIPPET), ('runtime', RUNTIME_SNIPPET)]:
+            timings = run_snippet(snippet, artifact_dir, args.num_requests)
+            print(f'{name:10}{timings["load_s"]:10.2f}{timings["first_request_ms"]:10.2f}'
+                  f'{timings["request_ms"]:10.2f}{timings["max_rss_mb"]:10.0f}  '
+                  f'{timings["pandas_imported"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+"""Load test for the Flask app's HTML and API endpoints on synthetic artifacts.
+
+Usage (from the repo root):
+    python -m benchmarks.load_test --num-users 120000 --workers 4 --concurrency 16 \\
+        --duration 30 --mix form=1,submit=2,recommendation=4,api=3
+
+Publishes a synthetic artifact version to a temporary artifact root (or serves
+an existing one with --artifact-root), starts flask/serve.py on it and drives it
+with --concurrency client processes, each sending requests back to back over a
+keep-alive connection. Request types:
+
+    form            GET /
+    submit          POST / with the form, then GET the redirect to
+                    /recommendation/<user_id>/<adventurous_level> (timed as one)
+    recommendation  GET /recommendation/<user_id>/<adventurous_level>
+    api             GET /api/recommendation/<user_id>?adventurous_level=...
+
+Users are drawn uniformly or from a Zipf distribution (--user-dist). A
+--hot-ratio share of requests goes to a small set of --hot-users users, whose
+rows stay in CPU and page caches, to set the cache-hit ratio; --unknown-ratio
+sends user IDs that aren't in the artifacts (404s, like a typo in the form).
+Adventurous levels are drawn from --weights.
+
+Reports requests per second and p50/p95/p99 latency per request type, and RSS,
+PSS (RSS with shared pages split between the processes sharing them) and peak
+RSS of every server process. Results are written as JSON like
+recommender_benchmark.py's, and --compare checks them against an earlier run.
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import recommender_benchmark as rb, synthetic
+from src import ann, artifacts, item_neighbours, prefix_index
+
+REQUEST_TYPES = ['form', 'submit', 'recommendation', 'api']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-users', type=int, default=20000)
+    parser.add_argument('--num-anime', type=int, default=1000)
+    parser.add_argument('--artifact-root', help='Serve this artifact root instead of '
+                                                'generating synthetic artifacts')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py worker processes')
+    parser.add_argument('--threaded', action='store_true', help='Passed on to serve.py')
+    parser.add_argument('--batch-window-ms', type=float, default=0,
+                        help='Passed on to serve.py (0 = no batching)')
+    parser.add_argument('--batch-max-size', type=int, default=32, help='Passed on to serve.py')
+    parser.add_argument('--port', type=int, default=0, help='Default: a free port')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client processes')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds measured')
+    parser.add_argument('--warmup', type=float, default=3,
+                        help='Seconds of load before measuring')
+    parser.add_argument('--mix', default='form=1,submit=2,recommendation=4,api=3',
+                        help='Relative frequency of each request type')
+    parser.add_argument('--weights', default='0,0.5,1,1.5,2',
+                        help='Adventurous levels (collab weights) to draw from')
+    parser.add_argument('--user-dist', choices=['uniform', 'zipf'], default='zipf')
+    parser.add_argument('--zipf-exponent', type=float, default=1.1)
+    parser.add_argument('--hot-ratio', type=float, default=0.0,
+                        help='Share of requests for the hot users')
+    parser.add_argument('--hot-users', type=int, default=100)
+    parser.add_argument('--unknown-ratio', type=float, default=0.0,
+                        help='Share of requests for user IDs not in the artifacts')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/...)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative p50 slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def parse_mix(mix):
+    """Returns array of probabilities of REQUEST_TYPES from e.g.
+    'form=1,api=3'."""
+    weights = dict.fromkeys(REQUEST_TYPES, 0.0)
+    for item in mix.split(','):
+        request_type, weight = item.split('=')
+        if request_type not in weights:
+            raise ValueError(f'unknown request type {request_type!r}')
+        weights[request_type] = float(weight)
+    probabilities = np.array([weights[request_type] for request_type in REQUEST_TYPES])
+    return probabilities / probabilities.sum()
+
+
+def publish_synthetic_artifacts(artifact_root, num_users, num_anime):
+    """Publishes a serving bundle for synthetic data under artifact_root and
+    returns its version.
+
+    The embeddings are random rather than fitted, since only the shapes matter for
+    serving speed, and candidates are computed in blocks so this works at 1M
+    users.
+    """
+    user_score_matrix, history = synthetic.make_user_score_matrix(num_users, num_anime)
+    anime_titles = synthetic.make_anime_titles(num_anime)
+    anime_features = synthetic.make_anime_features(num_anime)
+    rng = np.random.default_rng(4444)
+    user_embedding = rng.gamma(0.5, 1.0, (num_users, synthetic.NUM_TASTES))
+    components = rng.gamma(0.5, 1.0, (synthetic.NUM_TASTES, num_anime))
+    ann_indexes = {'collab': ann.build_ivf_index(components.T),
+                   'content': ann.build_ivf_index(anime_features)}
+    neighbour_table = item_neighbours.create_neighbour_table(components, anime_features)
+    arrays = rb.create_blocked_serving_arrays(
+        user_embedding, rb.get_user_vectors(history, anime_features), user_score_matrix,
+        history, components, anime_features, ann_indexes, neighbour_table)
+    top_anime_df = pd.DataFrame({
+        'title_main': anime_titles,
+        'url': [f'https://myanimelist.net/anime/{idx + 1}' for idx in range(num_anime)],
+        'image_url': [f'https://cdn.myanimelist.net/images/anime/{idx + 1}.jpg'
+                      for idx in range(num_anime)]
+    })
+    ids = artifacts.create_serving_ids(synthetic.make_user_ids(num_users), anime_titles,
+                                       top_anime_df)
+    arrays.update(prefix_index.create_user_prefix_arrays(ids['user_ids']))
+    arrays.update(prefix_index.create_title_prefix_arrays(
+        anime_titles, top_anime_df.assign(title_english=None)))
+    return artifacts.publish_bundle(artifact_root, arrays, ids)
+
+
+def load_user_ids(artifact_root):
+    """Returns the user IDs of the current version under artifact_root."""
+    version = artifacts.get_current_version(artifact_root)
+    with open(os.path.join(artifact_root, version, 'ids.json')) as f:
+        return json.load(f)['user_ids']
+
+
+def get_free_port():
+    """Returns a TCP port that is free right now."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, artifact_root, port, metrics_dir, log_file):
+    """Starts serve.py and returns its Popen once it answers requests. The
+    server's output (including an access log line per request) goes to
+    log_file rather than the terminal."""
+    command = [sys.executable, 'serve.py', '--port', str(port), '--workers',
+               str(args.workers), '--poll-interval', '3600']
+    if args.threaded:
+        command.append('--threaded')
+    if args.batch_window_ms > 0:
+        command += ['--batch-window-ms', str(args.batch_window_ms),
+                    '--batch-max-size', str(args.batch_max_size)]
+    env = dict(os.environ, ARTIFACT_ROOT=os.path.abspath(artifact_root),
+               SERVE_METRICS_DIR=metrics_dir)
+    server = subprocess.Popen(command, cwd=os.path.join(rb.REPO_DIR, 'flask'), env=env,
+                              stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        if server.poll() is not None:
+            with open(log_file.name) as f:
+                raise RuntimeError(f'serve.py exited with status {server.returncode}:\n'
+                                   f'{f.read()[-2000:]}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/version')
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('serve.py did not start within 5 minutes')
+
+
+def create_user_sampler(num_users, args, rng):
+    """Returns function returning the row of the next user to request, or -1 for
+    an unknown user."""
+    # Spreads the popular users (low Zipf ranks) and the hot users over the rows.
+    # Seeded the same way in every client so they agree on who is popular.
+    user_order = np.random.default_rng(4444).permutation(num_users)
+    hot_users = user_order[:min(args.hot_users, num_users)]
+
+    def sample():
+        draw = rng.random()
+        if draw < args.unknown_ratio:
+            return -1
+        if draw < args.unknown_ratio + args.hot_ratio:
+            return int(hot_users[rng.integers(len(hot_users))])
+        if args.user_dist == 'uniform':
+            return int(rng.integers(num_users))
+        rank = rng.zipf(args.zipf_exponent) - 1
+        while rank >= num_users:
+            rank = rng.zipf(args.zipf_exponent) - 1
+        return int(user_order[rank])
+    return sample
+
+
+def send_request(conn, method, path, body=None):
+    """Sends a request and returns (status, location header), reading the whole
+    response. Returns None if the server closed the connection."""
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    response.read()
+    if response.will_close:
+        conn.close()
+    return response.status, response.getheader('Location')
+
+
+def run_client(client_idx, args, port, user_ids, start_at, queue):
+    """Sends requests until the test ends and puts (latencies, statuses) on
+    queue. latencies maps request type to a list of seconds measured after the
+    warmup; statuses counts responses by (request type, status)."""
+    rng = np.random.default_rng(client_idx)
+    probabilities = parse_mix(args.mix)
+    weights = [weight.strip() for weight in args.weights.split(',')]
+    sample_user = create_user_sampler(len(user_ids), args, rng)
+    measure_from, stop_at = start_at + args.warmup, start_at + args.warmup + args.duration
+    latencies = {request_type: [] for request_type in REQUEST_TYPES}
+    statuses = {}
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    while True:
+        now = time.time()
+        if now >= stop_at:
+            break
+        request_type = REQUEST_TYPES[rng.choice(len(REQUEST_TYPES), p=probabilities)]
+        user_row = sample_user()
+        user_id = user_ids[user_row] if user_row >= 0 else f'unknown_user_{rng.integers(1e9)}'
+        user_id = urllib.parse.quote(user_id, safe='')
+        weight = weights[rng.integers(len(weights))]
+        start = time.perf_counter()
+        try:
+            if request_type == 'form':
+                status, _ = send_request(conn, 'GET', '/')
+            elif request_type == 'submit':
+                body = urllib.parse.urlencode({'user_id': user_ids[user_row] if user_row >= 0
+                                               else user_id, 'adventurous_level': weight})
+                status, location = send_request(conn, 'POST', '/', body)
+                if status in (301, 302, 303) and location:
+                    status, _ = send_request(conn, 'GET', urllib.parse.urlsplit(location).path)
+            elif request_type == 'recommendation':
+                status, _ = send_request(conn, 'GET', f'/recommendation/{user_id}/{weight}')
+            else:
+                status, _ = send_request(
+                    conn, 'GET', f'/api/recommendation/{user_id}?adventurous_level={weight}')
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status = 'connection error'
+        seconds = time.perf_counter() - start
+        if now >= measure_from:
+            latencies[request_type].append(seconds)
+            key = f'{request_type}.{status}'
+            statuses[key] = statuses.get(key, 0) + 1
+    queue.put((latencies, statuses))
+
+
+def get_process_memory(pid):
+    """Returns dict with RSS, PSS and peak RSS (VmHWM) of a process in bytes."""
+    memory = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Pss:'):
+                memory[fields[0][:-1].lower() + '_bytes'] = int(fields[1]) * 1024
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                memory['peak_rss_bytes'] = int(line.split()[1]) * 1024
+    return memory
+
+
+def get_child_pids(pid):
+    """Returns pids of the child processes of pid."""
+    child_pids = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # The command name in parentheses may contain spaces
+                    parent_pid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if parent_pid == pid:
+                child_pids.append(int(entry))
+    return sorted(child_pids)
+
+
+def get_server_memory(server_pid):
+    """Returns dict mapping 'parent' and 'worker-<pid>' to memory dicts of the
+    serve.py processes."""
+    server_memory = {'parent': get_process_memory(server_pid)}
+    for pid in get_child_pids(server_pid):
+        try:
+            server_memory[f'worker-{pid}'] = get_process_memory(pid)
+        except OSError:
+            pass
+    return server_memory
+
+
+def summarize(latencies, statuses, duration):
+    """Returns dict of per request type results in the format of
+    recommender_benchmark.time_case, plus throughput and error counts."""
+    cases = {}
+    for request_type in REQUEST_TYPES + ['all']:
+        seconds = (sum(latencies.values(), []) if request_type == 'all'
+                   else latencies[request_type])
+        if not seconds:
+            continue
+        # Includes the expected 404s for --unknown-ratio
+        errors = sum(count for key, count in statuses.items()
+                     if (request_type == 'all' or key.startswith(request_type + '.'))
+                     and not key.rsplit('.', 1)[1][:1] in ('2', '3'))
+        p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+        cases[f'load.{request_type}'] = {
+            'status': 'ok', 'num_calls': len(seconds), 'rps': len(seconds) / duration,
+            'errors': errors, 'p50': p50, 'p95': p95, 'p99': p99,
+            'mean': float(np.mean(seconds)), 'max': max(seconds)
+        }
+    return cases
+
+
+def main():
+    args = parse_args()
+    port = args.port or get_free_port()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifact_root = args.artifact_root
+        if artifact_root is None:
+            artifact_root = os.path.join(tmp_dir, 'artifacts')
+            os.makedirs(artifact_root)
+            print(f'Publishing synthetic artifacts for {args.num_users} users x '
+                  f'{args.num_anime} anime ...')
+            publish_synthetic_artifacts(artifact_root, args.num_users, args.num_anime)
+        user_ids = load_user_ids(artifact_root)
+        log_file = open(os.path.join(tmp_dir, 'serve.log'), 'w')
+        server = start_server(args, artifact_root, port, os.path.join(tmp_dir, 'metrics'),
+                              log_file)
+        try:
+            print(f'Running {args.concurrency} clients against {args.workers} workers for '
+                  f'{args.warmup:g} + {args.duration:g} s ...')
+            queue = multiprocessing.Queue()
+            start_at = time.time()
+            clients = [multiprocessing.Process(target=run_client,
+                                               args=(idx, args, port, user_ids, start_at, queue))
+                       for idx in range(args.concurrency)]
+            for client in clients:
+                client.start()
+            client_results = [queue.get() for _ in clients]
+            for client in clients:
+                client.join()
+            server_memory = get_server_memory(server.pid)
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('GET', '/metrics?format=json')
+            server_metrics = json.loads(conn.getresponse().read())
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            log_file.close()
+
+    latencies = {request_type: [] for request_type in REQUEST_TYPES}
+    statuses = {}
+    for client_latencies, client_statuses in client_results:
+        for request_type, seconds in client_latencies.items():
+            latencies[request_type] += seconds
+        for key, count in client_statuses.items():
+            statuses[key] = statuses.get(key, 0) + count
+    cases = summarize(latencies, statuses, args.duration)
+
+    print(f"\n{'request type':<22}{'RPS':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'max ms':>10}")
+    for name, result in cases.items():
+        print(f"{name:<22}{result['rps']:10.1f}{result['errors']:8d}"
+              f"{result['p50']*1000:10.2f}{result['p95']*1000:10.2f}"
+              f"{result['p99']*1000:10.2f}{result['max']*1000:10.2f}")
+    print(f"\n{'process':<22}{'RSS MB':>10}{'PSS MB':>10}{'peak MB':>10}")
+    for process, memory in server_memory.items():
+        print(f"{process:<22}{memory.get('rss_bytes', 0)/2**20:10.1f}"
+              f"{memory.get('pss_bytes', 0)/2**20:10.1f}"
+              f"{memory.get('peak_rss_bytes', 0)/2**20:10.1f}")
+    num_batches = server_metrics['counters'].get('batches.batches')
+    if num_batches:
+        queue_histogram = server_metrics['histograms']['stage_seconds.batch_queue']
+        print(f"\nBatches: {num_batches}, mean size "
+              f"{server_metrics['counters']['batches.items'] / num_batches:.1f}, "
+              f"queue time mean {queue_histogram['mean']*1000:.2f} ms, "
+              f"p95 <= {(queue_histogram['p95<='] or float('inf'))*1000:g} ms")
+
+    output = {
+        'created_at': time.time(),
+        'git_commit': rb.get_git_commit(),
+        'cpu_count': os.cpu_count(),
+        'scale': {'num_users': len(user_ids), 'workers': args.workers,
+                  'concurrency': args.concurrency, 'mix': args.mix},
+        'options': vars(args),
+        'statuses': statuses,
+        'server_memory': server_memory,
+        'server_metrics': server_metrics,
+        'cases': cases
+    }
+    output_path = args.output or os.path.join(
+        rb.RESULTS_DIR, f"load-{time.strftime('%Y%m%d-%H%M%S')}-{len(user_ids)}users-"
+                        f'{args.workers}workers.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'\nResults written to {output_path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = rb.compare_results(json.load(f), output, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Compares nmf_update.update_nmf against refitting NMF on synthetic data.
+
+Usage (from the repo root):
+    python -m benchmarks.nmf_update_benchmark --num-users 20000 --num-anime 1000 \\
+        --num-changed 1000 --num-new 500
+
+Fits NMF like anime_recommender.py, applies a delta of changed and new users
+and reports wall time and relative reconstruction error ||X - WH||_F / ||X||_F
+for the incremental update, a warm-started refit and a refit from scratch, and
+how far components_ moved for anime the delta didn't touch.
+"""
+
+import argparse
+import time
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import NMF
+from src import nmf_update
+from benchmarks import synthetic
+
+
+def fit_nmf(user_score_matrix, max_iter, user_embedding=None, components=None):
+    """Returns (user_embedding, components, seconds) for an NMF fit, warm
+    started if previous factors are given."""
+    if user_embedding is None:
+        nmf = NMF(n_components=synthetic.NUM_TASTES, max_iter=max_iter, random_state=4444)
+        start = time.perf_counter()
+        user_embedding = nmf.fit_transform(user_score_matrix)
+    else:
+        nmf = NMF(n_components=synthetic.NUM_TASTES, max_iter=max_iter, init='custom')
+        start = time.perf_counter()
+        dtype = user_score_matrix.dtype
+        user_embedding = nmf.fit_transform(user_score_matrix, W=user_embedding.astype(dtype),
+                                           H=components.astype(dtype))
+    return user_embedding, nmf.components_, time.perf_counter() - start
+
+
+def get_error(user_score_matrix, user_embedding, components):
+    """Returns relative reconstruction error of a fit."""
+    state = nmf_update.create_nmf_state(range(user_score_matrix.shape[0]),
+                                        range(user_score_matrix.shape[1]),
+                                        user_score_matrix, user_embedding, components)
+    return nmf_update.get_reconstruction_error(state)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('--num-users', type=int, default=20000)
+    arg_parser.add_argument('--num-anime', type=int, default=1000)
+    arg_parser.add_argument('--num-changed', type=int, default=1000)
+    arg_parser.add_argument('--num-new', type=int, default=500)
+    arg_parser.add_argument('--max-iter', type=int, default=500)
+    arg_parser.add_argument('--num-passes', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    user_score_matrix, _ = synthetic.make_user_score_matrix(args.num_users, args.num_anime)
+    user_embedding, components, seconds = fit_nmf(user_score_matrix, args.max_iter)
+    print(f'initial fit on {args.num_users} users: {seconds:.1f} s, '
+          f'error {get_error(user_score_matrix, user_embedding, components):.4f}')
+
+    changed_user_idxs, delta_score_rows = synthetic.make_delta(
+        user_score_matrix, args.num_changed, args.num_new)
+    user_ids = list(range(args.num_users))
+    delta_user_ids = list(changed_user_idxs) + list(range(args.num_users,
+                                                          args.num_users + args.num_new))
+
+    state = nmf_update.create_nmf_state(user_ids, range(args.num_anime), user_score_matrix,
+                                        user_embedding, components)
+    start = time.perf_counter()
+    nmf_update.update_nmf(state, delta_user_ids, delta_score_rows, args.num_passes)
+    update_seconds = time.perf_counter() - start
+    updated_matrix = state['user_score_matrix']
+
+    touched = np.zeros(args.num_anime, dtype=bool)
+    touched[sparse.vstack([user_score_matrix[changed_user_idxs], delta_score_rows]).indices] = True
+    untouched_change = np.abs(state['components'][:, ~touched] - components[:, ~touched]).max() \
+        if (~touched).any() else 0.0
+
+    results = [('incremental update', update_seconds,
+                nmf_update.get_reconstruction_error(state))]
+    padded_embedding = np.vstack([user_embedding, np.zeros((args.num_new, synthetic.NUM_TASTES))])
+    padded_embedding[args.num_users:] = state['user_embedding'][args.num_users:]
+    warm_embedding, warm_components, warm_seconds = fit_nmf(
+        updated_matrix, args.max_iter, padded_embedding, components)
+    results.append(('warm-started refit', warm_seconds,
+                    get_error(updated_matrix, warm_embedding, warm_components)))
+    full_embedding, full_components, full_seconds = fit_nmf(updated_matrix, args.max_iter)
+    results.append(('refit from scratch', full_seconds,
+                    get_error(updated_matrix, full_embedding, full_components)))
+
+    print(f'delta: {args.num_changed} changed + {args.num_new} new users, '
+          f'{touched.sum()} of {args.num_anime} anime touched')
+    for name, seconds, error in results:
+        print(f'{name:<20} {seconds:8.2f} s   error {error:.4f}')
+    print(f'max change in components_ of untouched anime: {untouched_change:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Benchmarks parse.parse_anime_page against the per-field get_* functions on
+a corpus of saved anime pages.
+
+Usage (from the repo root):
+    python -m benchmarks.parse_benchmark path/to/saved_anime_pages
+
+Every *.html file in the directory is parsed both ways. The script reports
+the time per page for each approach and any page where the outputs differ.
+"""
+
+import argparse
+import time
+from pathlib import Path
+from src import parse
+
+LEGACY_GETTERS = [
+    ('image_url', parse.get_image_url),
+    ('trailer_url', parse.get_trailer_url),
+    ('title_main', parse.get_title_main),
+    ('title_english', parse.get_title_english),
+    ('media_type', parse.get_media_type),
+    ('source_material', parse.get_source_material),
+    ('num_episodes', parse.get_num_episodes),
+    ('airing_status', parse.get_airing_status),
+    ('aired_dates', parse.get_aired_dates),
+    ('premiered', parse.get_premiered),
+    ('duration', parse.get_duration),
+    ('content_rating', parse.get_content_rating),
+    ('genres', parse.get_genres),
+    ('score', parse.get_score),
+    ('scored_by_num_users', parse.get_scored_by_num_users),
+    ('rank_score', parse.get_rank_score),
+    ('rank_popularity', parse.get_rank_popularity),
+    ('members', parse.get_members),
+    ('favorites', parse.get_favorites),
+    ('studios', parse.get_studios),
+    ('producers', parse.get_producers),
+    ('licensors', parse.get_licensors)
+]
+
+
+def parse_legacy(html):
+    """Returns anime data the way get_anime_data used to: html5lib and one
+    search per field."""
+    soup = parse.create_page_soup(html, 'html5lib')
+    return {field: getter(soup) for field, getter in LEGACY_GETTERS}
+
+
+def parse_single_pass(html, parser=parse.PARSER):
+    """Returns anime data using the single-pass parser."""
+    return parse.parse_anime_page(parse.create_page_soup(html, parser))
+
+
+def time_per_page(parse_func, pages, repeat):
+    """Returns list of the best-of-repeat seconds taken to parse each page."""
+    timings = []
+    for html in pages:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse_func(html)
+            best = min(best, time.perf_counter() - start)
+        timings.append(best)
+    return timings
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('pages_dir', help='Directory of saved anime page *.html files.')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='Times to parse each page (best time is kept).')
+    args = arg_parser.parse_args()
+
+    paths = sorted(Path(args.pages_dir).glob('*.html'))
+    if not paths:
+        raise SystemExit(f'No *.html files found in {args.pages_dir}')
+    pages = [path.read_text(encoding='utf-8') for path in paths]
+
+    mismatches = []
+    for path, html in zip(paths, pages):
+        expected = parse_legacy(html)
+        actual = parse_single_pass(html)
+        diff_fields = [field for field in expected if expected[field] != actual[field]]
+        if diff_fields:
+            mismatches.append((path.name, diff_fields))
+
+    approaches = [
+        ('per-field search, html5lib', parse_legacy),
+        ('single pass, html5lib', lambda html: parse_single_pass(html, 'html5lib')),
+        (f'single pass, {parse.PARSER}', parse_single_pass)
+    ]
+    print(f'{len(pages)} pages, best of {args.repeat}')
+    baseline = None
+    for name, parse_func in approaches:
+        total = sum(time_per_page(parse_func, pages, args.repeat))
+        baseline = baseline or total
+        print(f'{name:<30} {1000*total/len(pages):8.2f} ms/page  '
+              f'{baseline/total:5.1f}x')
+
+    if mismatches:
+        print(f'{len(mismatches)} pages with different output:')
+        for name, diff_fields in mismatches:
+            print(f'  {name}: {", ".join(diff_fields)}')
+    else:
+        print('Output identical on all pages.')
+
+
+if __name__ == '__main__':
+    main()
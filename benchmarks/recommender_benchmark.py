@@ -0,0 +1,539 @@
+"""Benchmark suite for the recommender build and serving hot path on synthetic
+data.
+
+Usage (from the repo root):
+    python -m benchmarks.recommender_benchmark --scale medium
+    python -m benchmarks.recommender_benchmark --num-users 50000 --num-anime 2000 \\
+        --compare benchmarks/results/20201101-120000-50000x2000.json
+
+Generates a synthetic dataset (see synthetic.py), then times the public
+functions of data_cleaning, recommender, fold_in, ann, item_neighbours,
+nmf_update, artifacts and the serving runtime, plus the full build from
+scraped animelists to serving arrays. Each case is called repeatedly (per-user
+functions with a different user each call) and reports p50/p95/p99 latency and
+the peak memory traced by tracemalloc during one call.
+
+The pandas functions hold dense users x anime DataFrames and loop in Python, so
+they are skipped above PANDAS_MAX_CELLS users x anime instead of running for
+hours, and so are the dense distance matrices above DENSE_MAX_CELLS. Skipped
+cases are still recorded. Above DENSE_MAX_CELLS the serving runtime is built
+from candidates computed in blocks.
+
+Results are written as JSON to benchmarks/results/ (or --output). With
+--compare, p50 latencies are compared against an earlier results file and the
+script exits with status 1 if any case got slower by more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.decomposition import NMF
+from sklearn.metrics import pairwise_distances
+
+from benchmarks import synthetic
+from src import (ann, artifacts, data_cleaning as dc, fold_in, item_neighbours, nmf_update,
+                 recommender as rec)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The serving runtime imports its package the way the Flask app does
+sys.path.insert(0, os.path.join(REPO_DIR, 'flask'))
+from recommendation import runtime as rt  # noqa: E402
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+# (num_users, num_anime) presets
+SCALES = {
+    'small': (1000, 1000),
+    'medium': (20000, 1000),
+    'large': (100000, 5000),
+    'xlarge': (1000000, 20000)
+}
+PANDAS_MAX_CELLS = 2e7
+DENSE_MAX_CELLS = 1e8
+PANDAS_CASES = [
+    'data_cleaning.fix_mismatching_animelist_len', 'data_cleaning.create_user_score_dicts',
+    'data_cleaning.create_user_anime_history_df', 'data_cleaning.clean_user_anime_history_df',
+    'data_cleaning.create_user_score_df', 'data_cleaning.clean_user_score_df',
+    'recommender.create_user_vector_df', 'recommender.get_collab_filt_recs',
+    'recommender.get_content_filt_recs', 'recommender.recommend', 'full_build'
+]
+DENSE_CASES = ['build.collab_distances', 'build.content_distances',
+               'artifacts.create_serving_arrays']
+# Users that per-user cases cycle through
+NUM_SAMPLE_USERS = 200
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--num-users', type=int, help='Overrides the users of --scale')
+    parser.add_argument('--num-anime', type=int, help='Overrides the anime of --scale')
+    parser.add_argument('--repeats', type=int, default=50,
+                        help='Maximum number of timed calls per case')
+    parser.add_argument('--max-seconds', type=float, default=20,
+                        help='Stop repeating a case after this long (it runs at least once)')
+    parser.add_argument('--nmf-max-iter', type=int, default=500)
+    parser.add_argument('--cases', help='Only time cases whose name matches this regex')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/...)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative p50 slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def time_case(run, setup=None, repeats=50, max_seconds=20):
+    """Returns result dict with latency percentiles and peak traced memory.
+
+    The first call is traced with tracemalloc to get its peak memory and is not
+    timed, since tracing slows Python code down. Then run is timed up to repeats
+    times or until max_seconds have passed, but at least once.
+
+    Args:
+        run: Function to benchmark.
+        setup: Optional function returning a tuple of arguments for one call of
+            run, e.g. a fresh copy of a DataFrame that run modifies. Not timed.
+        repeats: Maximum number of timed calls.
+        max_seconds: Time budget for the timed calls.
+    """
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        run(*args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    seconds = []
+    deadline = time.perf_counter() + max_seconds
+    while len(seconds) < repeats and (not seconds or time.perf_counter() < deadline):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        run(*args)
+        seconds.append(time.perf_counter() - start)
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+    return {'status': 'ok', 'num_calls': len(seconds), 'p50': p50, 'p95': p95, 'p99': p99,
+            'mean': float(np.mean(seconds)), 'min': min(seconds), 'peak_bytes': peak_bytes}
+
+
+def print_result(name, result):
+    """Prints one line summarizing a case result."""
+    if result['status'] != 'ok':
+        print(f'{name:<48} {result["status"]}: {result["reason"]}')
+        return
+    print(f'{name:<48} p50 {result["p50"]*1000:10.3f} ms  p95 {result["p95"]*1000:10.3f} ms  '
+          f'p99 {result["p99"]*1000:10.3f} ms  peak {result["peak_bytes"]/2**20:8.1f} MB  '
+          f'({result["num_calls"]} calls)')
+
+
+
+def create_bench(results, args):
+    """Returns function bench(name, run, setup=None) that times a case with
+    time_case, prints it and stores its result dict in results[name]. Cases
+    whose name doesn't match args.cases are not run."""
+    pattern = re.compile(args.cases) if args.cases else None
+
+    def bench(name, run, setup=None):
+        if pattern and not pattern.search(name):
+            return
+        try:
+            results[name] = time_case(run, setup, args.repeats, args.max_seconds)
+        except Exception as e:
+            results[name] = {'status': 'error', 'reason': repr(e)}
+        print_result(name, results[name])
+    return bench
+
+
+def skip(results, names, reason):
+    """Records the cases in names as skipped."""
+    for name in names:
+        results[name] = {'status': 'skipped', 'reason': reason}
+        print_result(name, results[name])
+
+
+def bench_and_keep(bench, data, key, name, function):
+    """Times function as case name and stores its result in data[key] for later
+    cases. If the case didn't run (filtered out or failed), function is called
+    once more untimed."""
+    def run():
+        data[key] = function()
+    data.pop(key, None)
+    bench(name, run)
+    if key not in data:
+        run()
+    return data[key]
+
+
+def cycle(items):
+    """Returns setup function giving the next item of items (as a 1-tuple) each
+    call, so per-user cases don't hit the same user every time."""
+    position = [-1]
+
+    def next_item():
+        position[0] = (position[0] + 1) % len(items)
+        return (items[position[0]],)
+    return next_item
+
+
+def get_blocked_candidates(user_vectors, anime_vectors, block_size=10000):
+    """Returns each user's artifacts.NUM_CANDIDATES nearest anime by cosine
+    distance without building the full users x anime distance matrix."""
+    return np.vstack([
+        artifacts.get_candidates(pairwise_distances(user_vectors[start:start+block_size],
+                                                    anime_vectors, metric='cosine'))
+        for start in range(0, len(user_vectors), block_size)
+    ])
+
+
+def get_user_vectors(user_anime_history, anime_features):
+    """Returns content-based user vectors (the mean features of the anime on each
+    animelist, like create_user_vector_df) from a sparse animelist matrix."""
+    return np.asarray(user_anime_history @ anime_features) / \
+        np.maximum(np.asarray(user_anime_history.sum(axis=1)), 1)
+
+
+def create_blocked_serving_arrays(user_embedding, user_vectors, user_score_matrix,
+                                  user_anime_history, components, anime_features,
+                                  ann_indexes=None, neighbour_table=None):
+    """Returns the same arrays as artifacts.create_serving_arrays from user
+    vectors and sparse matrices, computing candidates in blocks of users so that
+    no users x anime matrix is ever dense.
+
+    Args:
+        user_embedding: NMF user embedding, shape (n_users, n_components).
+        user_vectors: Content-based user vectors, shape (n_users, n_features).
+        user_score_matrix: Sparse CSR user-rating matrix.
+        user_anime_history: Sparse CSR animelist matrix.
+        components: NMF components_, shape (n_components, n_anime).
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+        ann_indexes: Optional dict of IVF indexes from src/ann.py.
+        neighbour_table: Optional dict from item_neighbours.create_neighbour_table.
+    """
+    arrays = {
+        'collab_candidates': get_blocked_candidates(user_embedding, components.T),
+        'content_candidates': get_blocked_candidates(user_vectors, anime_features),
+        'components': np.asarray(components, dtype=float),
+        'anime_features': np.asarray(anime_features, dtype=float)
+    }
+    for name, matrix in [('scored', user_score_matrix), ('history', user_anime_history)]:
+        matrix = matrix.tocsr()
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        arrays[f'{name}_indptr'] = matrix.indptr.astype(np.int64)
+        arrays[f'{name}_indices'] = matrix.indices.astype(np.int32)
+    for kind, index in (ann_indexes or {}).items():
+        for key, array in index.items():
+            arrays[f'{kind}_ivf_{key}'] = array
+    for kind, (neighbour_idxs, neighbour_dists) in (neighbour_table or {}).items():
+        arrays[f'{kind}_neighbour_idxs'] = neighbour_idxs
+        arrays[f'{kind}_neighbour_dists'] = neighbour_dists
+    return arrays
+
+
+def fit_nmf(user_score_matrix, max_iter):
+    """Returns (user_embedding, components) of an NMF fit like
+    anime_recommender.py's."""
+    nmf = NMF(n_components=synthetic.NUM_TASTES, max_iter=max_iter, random_state=4444)
+    return nmf.fit_transform(user_score_matrix), nmf.components_
+
+
+def build_from_animelists(complete_animelist, anime_titles, anime_features, nmf_max_iter):
+    """Returns serving arrays built the way anime_recommender.py builds them from
+    scraped animelists. Content features come from the synthetic feature table
+    (clean_top_anime_data_1000_df is timed on its own)."""
+    complete_animelist = dc.fix_mismatching_animelist_len(complete_animelist)
+    user_score_dicts = dc.create_user_score_dicts(complete_animelist, anime_titles)
+    user_anime_history_df = dc.clean_user_anime_history_df(
+        dc.create_user_anime_history_df(user_score_dicts, anime_titles), anime_titles)
+    user_score_df = dc.clean_user_score_df(dc.create_user_score_df(user_score_dicts),
+                                           anime_titles)
+    user_scores = user_score_df.drop(columns=['user_id', 'animelist_url']).values
+    user_embedding, components = fit_nmf(user_scores, nmf_max_iter)
+    collab_dists = pairwise_distances(user_embedding, components.T, metric='cosine')
+    user_anime_history_df_core = user_anime_history_df.drop(columns=['user_id',
+                                                                     'animelist_url'])
+    user_vector_df = rec.create_user_vector_df(user_anime_history_df_core,
+                                               pd.DataFrame(anime_features))
+    content_dists = pairwise_distances(user_vector_df, anime_features, metric='cosine')
+    ann_indexes = {'collab': ann.build_ivf_index(components.T),
+                   'content': ann.build_ivf_index(anime_features)}
+    neighbour_table = item_neighbours.create_neighbour_table(components, anime_features)
+    return artifacts.create_serving_arrays(content_dists, collab_dists, user_scores,
+                                           user_anime_history_df_core.values, components,
+                                           anime_features, ann_indexes, neighbour_table)
+
+
+def get_animelist(data, user):
+    """Returns (animelist_titles, animelist_scores) of a synthetic user in the
+    scraper's format."""
+    anime_idxs = data['user_anime_history'][user].indices
+    scores = data['user_score_matrix'][user].toarray()[0, anime_idxs]
+    return ([data['anime_titles'][idx] for idx in anime_idxs],
+            [str(int(score)) if score else '-' for score in scores])
+
+
+def generate_data(num_users, num_anime):
+    """Returns dict of synthetic inputs for the benchmark cases."""
+    user_score_matrix, user_anime_history = synthetic.make_user_score_matrix(num_users,
+                                                                             num_anime)
+    anime_titles = synthetic.make_anime_titles(num_anime)
+    user_ids = synthetic.make_user_ids(num_users)
+    data = {
+        'user_score_matrix': user_score_matrix,
+        'user_anime_history': user_anime_history,
+        'anime_titles': anime_titles,
+        'user_ids': user_ids,
+        'anime_features': synthetic.make_anime_features(num_anime),
+        'top_anime_data_df': synthetic.make_top_anime_data_df(anime_titles),
+        'sample_users': np.random.default_rng(4444).choice(
+            num_users, min(NUM_SAMPLE_USERS, num_users), replace=False)
+    }
+    if num_users * num_anime <= PANDAS_MAX_CELLS:
+        data['complete_animelist'] = synthetic.make_complete_animelist(
+            user_score_matrix, user_anime_history, anime_titles, user_ids)
+    return data
+
+
+def bench_cleaning(bench, data):
+    """Times the data_cleaning functions on scraper-format data and adds the
+    cleaned user_score_df and user_anime_history_df to data."""
+    anime_titles = data['anime_titles']
+    # The clean_* functions change their input, so each call gets a fresh copy
+    bench('data_cleaning.clean_top_anime_data_1000_df', dc.clean_top_anime_data_1000_df,
+          lambda: (data['top_anime_data_df'].copy(),))
+    if 'complete_animelist' not in data:
+        return
+    bench('data_cleaning.fix_mismatching_animelist_len',
+          lambda: dc.fix_mismatching_animelist_len(data['complete_animelist']))
+    user_score_dicts = bench_and_keep(
+        bench, data, 'user_score_dicts', 'data_cleaning.create_user_score_dicts',
+        lambda: dc.create_user_score_dicts(data['complete_animelist'], anime_titles))
+    user_anime_history_df = bench_and_keep(
+        bench, data, 'user_anime_history_df', 'data_cleaning.create_user_anime_history_df',
+        lambda: dc.create_user_anime_history_df(user_score_dicts, anime_titles))
+    bench('data_cleaning.clean_user_anime_history_df',
+          lambda df: dc.clean_user_anime_history_df(df, anime_titles),
+          lambda: (user_anime_history_df.copy(),))
+    user_score_df = bench_and_keep(bench, data, 'user_score_df',
+                                   'data_cleaning.create_user_score_df',
+                                   lambda: dc.create_user_score_df(user_score_dicts))
+    bench('data_cleaning.clean_user_score_df',
+          lambda df: dc.clean_user_score_df(df, anime_titles), lambda: (user_score_df.copy(),))
+    data['user_anime_history_df'] = dc.clean_user_anime_history_df(user_anime_history_df,
+                                                                   anime_titles)
+    data['user_score_df'] = dc.clean_user_score_df(user_score_df, anime_titles)
+
+
+def bench_build(bench, data, args):
+    """Times the build steps and adds the serving runtime to data."""
+    anime_features = data['anime_features']
+    history = data['user_anime_history']
+    num_users, num_anime = history.shape
+    # NMF is fitted on the sparse matrix so it runs at every scale
+    user_embedding, components = bench_and_keep(
+        bench, data, 'nmf', 'build.nmf_fit',
+        lambda: fit_nmf(data['user_score_matrix'], args.nmf_max_iter))
+    user_vectors = get_user_vectors(history, anime_features)
+    if 'user_anime_history_df' in data:
+        bench('recommender.create_user_vector_df',
+              lambda: rec.create_user_vector_df(
+                  data['user_anime_history_df'].drop(columns=['user_id', 'animelist_url']),
+                  pd.DataFrame(anime_features)))
+    ann_indexes = {
+        'collab': bench_and_keep(bench, data, 'collab_ivf', 'ann.build_ivf_index.collab',
+                                 lambda: ann.build_ivf_index(components.T)),
+        'content': bench_and_keep(bench, data, 'content_ivf', 'ann.build_ivf_index.content',
+                                  lambda: ann.build_ivf_index(anime_features))
+    }
+    neighbour_table = bench_and_keep(
+        bench, data, 'neighbour_table', 'item_neighbours.create_neighbour_table',
+        lambda: item_neighbours.create_neighbour_table(components, anime_features))
+
+    if num_users * num_anime <= DENSE_MAX_CELLS:
+        collab_dists = bench_and_keep(
+            bench, data, 'collab_dists', 'build.collab_distances',
+            lambda: pairwise_distances(user_embedding, components.T, metric='cosine'))
+        content_dists = bench_and_keep(
+            bench, data, 'content_dists', 'build.content_distances',
+            lambda: pairwise_distances(user_vectors, anime_features, metric='cosine'))
+        user_scores = data['user_score_matrix'].toarray()
+        user_anime_history = history.toarray()
+        serving_arrays = bench_and_keep(
+            bench, data, 'serving_arrays', 'artifacts.create_serving_arrays',
+            lambda: artifacts.create_serving_arrays(
+                content_dists, collab_dists, user_scores, user_anime_history, components,
+                anime_features, ann_indexes, neighbour_table))
+        del user_scores, user_anime_history
+    else:
+        skip(data['results'], DENSE_CASES, f'users x anime above {DENSE_MAX_CELLS:.0e}')
+        serving_arrays = create_blocked_serving_arrays(
+            user_embedding, user_vectors, data['user_score_matrix'], history, components,
+            anime_features, ann_indexes, neighbour_table)
+    serving_ids = artifacts.create_serving_ids(data['user_ids'], data['anime_titles'],
+                                               data['top_anime_data_df'])
+    data['runtime'] = rt.create_runtime(serving_arrays, serving_ids,
+                                        {'format_version': artifacts.FORMAT_VERSION})
+
+    # A delta like a refresh scrape: 1% of users changed and 0.5% new
+    num_changed, num_new = max(num_users // 100, 1), max(num_users // 200, 1)
+    changed_user_idxs, delta_score_rows = synthetic.make_delta(data['user_score_matrix'],
+                                                               num_changed, num_new)
+    delta_user_ids = list(changed_user_idxs) + list(range(num_users, num_users + num_new))
+    bench('nmf_update.update_nmf',
+          lambda state: nmf_update.update_nmf(state, delta_user_ids, delta_score_rows),
+          lambda: (nmf_update.create_nmf_state(range(num_users), data['anime_titles'],
+                                               data['user_score_matrix'], user_embedding,
+                                               components),))
+
+    if 'complete_animelist' in data:
+        bench('full_build', lambda: build_from_animelists(
+            data['complete_animelist'], data['anime_titles'], anime_features,
+            args.nmf_max_iter))
+
+
+def bench_serving(bench, data, args):
+    """Times the per-user recommendation functions, each call for a different
+    sample user."""
+    runtime = data['runtime']
+    anime_titles = data['anime_titles']
+    sample_user_ids = [data['user_ids'][user] for user in data['sample_users']]
+    bench('runtime.recommend', lambda user_id: rt.recommend(runtime, user_id),
+          cycle(sample_user_ids))
+    filter_recs = [rt.get_filter_recs(runtime, runtime['user_idx'][user_id])
+                   for user_id in sample_user_ids]
+    bench('runtime.fuse_recs', lambda recs: rt.fuse_recs(*recs), cycle(filter_recs))
+
+    if 'user_score_df' in data:
+        content_dists, collab_dists = data['content_dists'], data['collab_dists']
+        user_score_df, user_anime_history_df = data['user_score_df'], \
+            data['user_anime_history_df']
+        bench('recommender.get_collab_filt_recs',
+              lambda user_id: rec.get_collab_filt_recs(user_id, collab_dists, anime_titles,
+                                                       user_score_df),
+              cycle(sample_user_ids))
+        bench('recommender.get_content_filt_recs',
+              lambda user_id: rec.get_content_filt_recs(user_id, content_dists, anime_titles,
+                                                        user_anime_history_df),
+              cycle(sample_user_ids))
+        bench('recommender.recommend',
+              lambda user_id: rec.recommend(user_id, content_dists, collab_dists,
+                                            user_score_df, user_anime_history_df,
+                                            anime_titles),
+              cycle(sample_user_ids))
+
+    components, anime_features = runtime['arrays']['components'], data['anime_features']
+    gram = runtime['gram']
+    anime_idx = runtime['anime_idx']
+    animelists = [get_animelist(data, user) for user in data['sample_users']]
+    bench('fold_in.create_fold_in_state',
+          lambda animelist: fold_in.create_fold_in_state(*animelist, anime_idx, components,
+                                                         gram, anime_features),
+          cycle(animelists))
+    states = [fold_in.create_fold_in_state(*animelist, anime_idx, components, gram,
+                                           anime_features) for animelist in animelists]
+    bench('fold_in.get_fold_in_recs.exact',
+          lambda state: fold_in.get_fold_in_recs(state, components, anime_features,
+                                                 anime_titles),
+          cycle(states))
+    bench('fold_in.get_fold_in_recs.ann',
+          lambda state: fold_in.get_fold_in_recs(state, components, anime_features,
+                                                 anime_titles,
+                                                 ann_indexes=runtime['ann_indexes']),
+          cycle(states))
+    bench('ann.query_ivf_index',
+          lambda state: ann.query_ivf_index(runtime['ann_indexes']['collab'],
+                                            state['user_embedding']),
+          cycle(states))
+
+
+def get_git_commit():
+    """Returns the current git commit of the repo, or None."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old_results, new_results, threshold):
+    """Prints p50 latencies of new_results against old_results and returns the
+    names of cases that got slower by more than threshold (e.g. 0.2 = 20%)."""
+    if old_results['scale'] != new_results['scale']:
+        print(f"Warning: comparing against a different scale {old_results['scale']}")
+    regressions = []
+    print(f"\n{'case':<48} {'old p50':>12} {'new p50':>12} {'change':>8}")
+    for name, result in new_results['cases'].items():
+        old_result = old_results['cases'].get(name)
+        if result['status'] != 'ok' or not old_result or old_result['status'] != 'ok':
+            continue
+        change = result['p50'] / old_result['p50'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<48} {old_result['p50']*1000:9.3f} ms {result['p50']*1000:9.3f} ms "
+              f'{change:+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    num_users, num_anime = SCALES[args.scale]
+    num_users, num_anime = args.num_users or num_users, args.num_anime or num_anime
+
+    print(f'Generating {num_users} users x {num_anime} anime ...')
+    start = time.perf_counter()
+    data = generate_data(num_users, num_anime)
+    generate_seconds = time.perf_counter() - start
+    print(f'{data["user_score_matrix"].nnz} scores in {generate_seconds:.1f} s')
+
+    results = data['results'] = {}
+    bench = create_bench(results, args)
+    if num_users * num_anime > PANDAS_MAX_CELLS:
+        skip(results, PANDAS_CASES, f'users x anime above {PANDAS_MAX_CELLS:.0e}')
+    bench_cleaning(bench, data)
+    bench_build(bench, data, args)
+    bench_serving(bench, data, args)
+
+    output = {
+        'created_at': time.time(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scale': {'num_users': num_users, 'num_anime': num_anime,
+                  'num_scores': int(data['user_score_matrix'].nnz)},
+        'options': vars(args),
+        'generate_seconds': generate_seconds,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'cases': results
+    }
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{num_users}x{num_anime}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'\nPeak RSS {output["peak_rss_bytes"]/2**20:.0f} MB. Results written to {output_path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), output, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
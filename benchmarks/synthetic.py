@@ -0,0 +1,218 @@
+"""This module generates synthetic recommender data for benchmarks, so that
+performance can be measured without the scraped pickles.
+
+Animelists follow a few properties of the real MyAnimeList data: anime
+popularity is long-tailed, animelist lengths are log-normal, scores come from a
+low-rank taste model (so NMF has structure to find), and some anime on an
+animelist are not scored ('-', stored as 0).
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+NUM_TASTES = 6
+
+
+def make_user_score_matrix(num_users, num_anime, seed=4444, mean_animelist_len=60,
+                           unscored_fraction=0.15):
+    """Returns (user_score_matrix, user_anime_history) as sparse CSR matrices.
+
+    user_score_matrix holds scores 1-10 (0 for unscored), user_anime_history
+    holds 1 for every anime on a user's animelist.
+
+    Args:
+        num_users: Number of users (rows).
+        num_anime: Number of anime (columns).
+        seed: Random seed.
+        mean_animelist_len: Median number of anime on an animelist.
+        unscored_fraction: Fraction of animelist entries without a score.
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, num_anime+1) ** 0.9
+    popularity /= popularity.sum()
+    user_tastes = rng.gamma(0.5, 1.0, (num_users, NUM_TASTES))
+    anime_tastes = rng.gamma(0.5, 1.0, (NUM_TASTES, num_anime))
+
+    animelist_lens = np.clip(rng.lognormal(np.log(mean_animelist_len), 0.8, num_users),
+                             1, num_anime).astype(int)
+    # Sampling every entry at once with replacement (inverse CDF) and
+    # deduplicating keeps this fast at 1M users x 20k anime; the few duplicates
+    # make animelists slightly shorter than animelist_lens
+    indices = np.searchsorted(np.cumsum(popularity), rng.random(animelist_lens.sum()),
+                              side='right')
+    indices = np.minimum(indices, num_anime - 1).astype(np.int32)
+    user_idx = np.repeat(np.arange(num_users), animelist_lens)
+    history = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), (user_idx, indices)),
+                                shape=(num_users, num_anime))
+    history.data[:] = 1
+    history.sort_indices()
+
+    rows = np.repeat(np.arange(num_users), np.diff(history.indptr))
+    affinity = np.empty(len(rows))
+    # In blocks, since gathering taste vectors for every entry at once would take
+    # gigabytes at 1M users
+    for start in range(0, len(rows), 1 << 20):
+        block = slice(start, start + (1 << 20))
+        affinity[block] = np.einsum('ij,ji->i', user_tastes[rows[block]],
+                                    anime_tastes[:, history.indices[block]])
+    # Map affinity to a 1-10 score around a typical MyAnimeList mean of ~7.5
+    ranks = affinity.argsort().argsort() / max(len(affinity) - 1, 1)
+    scores = np.clip(np.round(5 + 5 * ranks + rng.normal(0, 0.8, len(ranks))), 1, 10)
+    scores[rng.random(len(scores)) < unscored_fraction] = 0
+    user_score_matrix = sparse.csr_matrix((scores.astype(np.float32), history.indices.copy(),
+                                           history.indptr.copy()), shape=history.shape)
+    user_score_matrix.eliminate_zeros()
+    return user_score_matrix, history
+
+
+def make_anime_titles(num_anime):
+    """Returns list of unique synthetic anime titles."""
+    return [f'Synthetic Anime {idx}' for idx in range(num_anime)]
+
+
+def make_user_ids(num_users):
+    """Returns list of unique synthetic user IDs."""
+    return [f'synthetic_user_{idx}' for idx in range(num_users)]
+
+
+def make_delta(user_score_matrix, num_changed, num_new, seed=4444):
+    """Returns (changed_user_idxs, delta_score_rows) for a delta of users.
+
+    Changed users gain a few new scored anime and rescore some existing ones;
+    new users get fresh animelists.
+
+    Args:
+        user_score_matrix: Sparse user-rating matrix the delta applies to.
+        num_changed: Number of existing users whose animelists change.
+        num_new: Number of new users.
+        seed: Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    num_users, num_anime = user_score_matrix.shape
+    changed_user_idxs = rng.choice(num_users, num_changed, replace=False)
+    changed_rows = user_score_matrix[changed_user_idxs].tolil()
+    for row in range(num_changed):
+        for idx in rng.choice(num_anime, 5, replace=False):
+            changed_rows[row, idx] = rng.integers(1, 11)
+    new_rows, _ = make_user_score_matrix(num_new, num_anime, seed=seed+1)
+    return changed_user_idxs, sparse.vstack([changed_rows.tocsr(), new_rows]).tocsr()
+
+
+def make_anime_features(num_anime, seed=4444, num_genres=40, num_types=6):
+    """Returns content feature matrix shaped like top_anime_df_core.
+
+    Each anime gets a few multi-hot genres, one media type dummy and a couple of
+    numeric columns scaled to [0, 1].
+
+    Args:
+        num_anime: Number of anime (rows).
+        seed: Random seed.
+        num_genres: Number of genre columns.
+        num_types: Number of media type columns.
+    """
+    rng = np.random.default_rng(seed)
+    genre_popularity = rng.dirichlet(np.full(num_genres, 0.5))
+    genres = np.zeros((num_anime, num_genres))
+    for anime in range(num_anime):
+        genres[anime, rng.choice(num_genres, rng.integers(1, 6), replace=False,
+                                 p=genre_popularity)] = 1
+    types = np.eye(num_types)[rng.choice(num_types, num_anime, p=[.5, .2, .1, .1, .05, .05]
+                                         if num_types == 6 else None)]
+    numeric = rng.random((num_anime, 2))
+    return np.hstack([genres, types, numeric])
+
+
+def make_complete_animelist(user_score_matrix, user_anime_history, anime_titles, user_ids,
+                            seed=4444, unlisted_fraction=0.3):
+    """Returns animelists in the format of the scraper's complete_animelist.
+
+    Scores are strings, with '-' for anime on the animelist without a score. Real
+    animelists also hold anime outside the top anime, so a fraction of extra
+    titles that data_cleaning has to skip is mixed in.
+
+    Args:
+        user_score_matrix: Sparse user-rating matrix from make_user_score_matrix.
+        user_anime_history: Sparse animelist matrix from make_user_score_matrix.
+        anime_titles: List of anime titles, one per column.
+        user_ids: List of user IDs, one per row.
+        seed: Random seed.
+        unlisted_fraction: Number of extra titles per animelist as a fraction of
+            its length.
+    """
+    rng = np.random.default_rng(seed)
+    complete_animelist = []
+    for user, user_id in enumerate(user_ids):
+        start, end = user_anime_history.indptr[user], user_anime_history.indptr[user+1]
+        anime_idxs = user_anime_history.indices[start:end]
+        scores = user_score_matrix[user].toarray()[0, anime_idxs]
+        animelist_titles = [anime_titles[idx] for idx in anime_idxs]
+        animelist_scores = [str(int(score)) if score else '-' for score in scores]
+        num_unlisted = rng.binomial(len(anime_idxs), unlisted_fraction)
+        animelist_titles += [f'Unlisted Anime {idx}' for idx in
+                             rng.integers(0, 10 * len(anime_titles), num_unlisted)]
+        animelist_scores += [str(score) for score in rng.integers(1, 11, num_unlisted)]
+        complete_animelist.append({
+            'user_id': user_id,
+            'animelist_url': f'https://myanimelist.net/animelist/{user_id}',
+            'animelist_titles': animelist_titles,
+            'animelist_scores': animelist_scores
+        })
+    return complete_animelist
+
+
+def make_top_anime_data_df(anime_titles, seed=4444):
+    """Returns a DataFrame shaped like the scraped top_anime_data_1000_df, with
+    the same string formats clean_top_anime_data_1000_df expects (e.g. '#12',
+    '1,234,567', 'Apr 3, 1998 to Apr 24, 1999').
+
+    Args:
+        anime_titles: List of anime titles.
+        seed: Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    num_anime = len(anime_titles)
+    media_types = rng.choice(['TV', 'Movie', 'OVA', 'Special', 'ONA', 'Music'], num_anime,
+                             p=[.5, .2, .1, .1, .05, .05])
+    genres = ['Action', 'Adventure', 'Comedy', 'Drama', 'Fantasy', 'Mystery', 'Romance',
+              'Sci-Fi', 'Slice of Life', 'Sports', 'Supernatural', 'Thriller']
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov',
+              'Dec']
+    seasons = ['Winter', 'Spring', 'Summer', 'Fall']
+    members = np.sort(rng.lognormal(11, 1.2, num_anime).astype(int))[::-1]
+    top_anime_data = []
+    for idx, (title, media_type) in enumerate(zip(anime_titles, media_types)):
+        year, month = rng.integers(1970, 2021), rng.integers(12)
+        aired_from = f'{months[month]} {rng.integers(1, 29)}, {year}'
+        single_airing = media_type in ['Movie', 'Music']
+        top_anime_data.append({
+            'mal_id': idx + 1,
+            'url': f'https://myanimelist.net/anime/{idx + 1}',
+            'image_url': f'https://cdn.myanimelist.net/images/anime/{idx + 1}.jpg',
+            'trailer_url': None,
+            'title_main': title,
+            'title_english': title,
+            'media_type': media_type,
+            'source_material': rng.choice(['Manga', 'Original', 'Light novel']),
+            'num_episodes': '1' if single_airing else
+                            rng.choice(['12', '13', '24', '26', '52', 'Unknown']),
+            'airing_status': 'Finished Airing',
+            'aired_dates': aired_from if single_airing else
+                           f'{aired_from} to {months[(month + 3) % 12]} 1, {year + 1}',
+            'premiered': None if single_airing else f'{seasons[month // 3]} {year}',
+            'duration': '24 min. per ep.',
+            'content_rating': rng.choice(['PG-13 - Teens 13 or older',
+                                          'R - 17+ (violence & profanity)',
+                                          'G - All Ages']),
+            'genres': list(rng.choice(genres, rng.integers(1, 5), replace=False)),
+            'score': f'{rng.uniform(7, 9.2):.2f}',
+            'scored_by_num_users': str(int(members[idx] * 0.7)),
+            'rank_score': f'#{idx + 1}',
+            'rank_popularity': f'#{rng.integers(1, 10 * num_anime)}',
+            'members': f'{members[idx]:,}',
+            'favorites': f'{int(members[idx] * 0.01):,}',
+            'studios': ['Synthetic Studio'],
+            'producers': ['Synthetic Producer'],
+            'licensors': []
+        })
+    return pd.DataFrame(top_anime_data)
@@ -0,0 +1,144 @@
+"""This module contains functions to keep raw scraped pages in a compressed,
+append-only archive so that they can be re-parsed later without rescraping.
+
+An archive is a directory of gzipped JSON-lines shard files. Each record holds
+the page URL, the time it was fetched and the raw HTML. Every thread of every
+process writes to its own shard and starts a new shard every hour, so parallel
+scrapers (and the threads of one scraper) never write to the same file and
+re-parsing can be spread over many shards.
+
+Each record is its own gzip member. A corrupt member is reported and skipped,
+and reading carries on at the next member, so one bad record doesn't hide the
+rest of its shard.
+"""
+
+import gzip
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+
+# Every gzip member starts with these bytes (magic number and deflate method)
+GZIP_MAGIC = b'\x1f\x8b\x08'
+READ_CHUNK_SIZE = 1 << 16
+
+
+def get_shard_path(archive_dir, fetched_at):
+    """Returns path of the shard file this thread writes to at fetched_at.
+
+    Shards are named by process and thread, since gzip members appended to one
+    file by several threads at once interleave and can't be read back.
+
+    Args:
+        archive_dir: Directory of the archive.
+        fetched_at: Fetch time as seconds since the epoch.
+    """
+    hour = time.strftime('%Y%m%d%H', time.gmtime(fetched_at))
+    return os.path.join(archive_dir,
+                        f'pages-{hour}-{os.getpid()}-{threading.get_ident()}.jsonl.gz')
+
+
+def append_page(archive_dir, url, html, fetched_at=None):
+    """Appends a raw page to the archive.
+
+    Each record is written as its own gzip member, so a crash can at most lose
+    the record being written and never corrupts earlier ones.
+
+    Args:
+        archive_dir: Directory of the archive. Created if it doesn't exist.
+        url: URL the page was fetched from.
+        html: Raw HTML of the page.
+        fetched_at: Fetch time as seconds since the epoch. Defaults to now.
+    """
+    if fetched_at is None:
+        fetched_at = time.time()
+    os.makedirs(archive_dir, exist_ok=True)
+    record = {'url': url, 'fetched_at': fetched_at, 'html': html}
+    with gzip.open(get_shard_path(archive_dir, fetched_at), 'ab') as f:
+        f.write(json.dumps(record).encode('utf-8') + b'\n')
+
+
+def get_shard_paths(archive_dir):
+    """Returns sorted list of shard file paths in the archive.
+
+    Args:
+        archive_dir: Directory of the archive.
+    """
+    return sorted(os.path.join(archive_dir, file_name)
+                  for file_name in os.listdir(archive_dir)
+                  if file_name.endswith('.jsonl.gz'))
+
+
+def read_member(data, offset):
+    """Returns (member, end): the decompressed gzip member starting at offset of
+    data and the offset after it. Raises zlib.error if the member is corrupt or
+    cut off.
+
+    Args:
+        data: Bytes or memory map of a shard file.
+        offset: Offset of the member's header.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    position = offset
+    # Fed in chunks, since unused_data would copy the rest of the shard
+    while not decompressor.eof:
+        if position >= len(data):
+            raise zlib.error('gzip member cut off at the end of the shard')
+        chunk = data[position:position + READ_CHUNK_SIZE]
+        parts.append(decompressor.decompress(chunk))
+        position += len(chunk)
+    return b''.join(parts), position - len(decompressor.unused_data)
+
+
+def iter_shard(shard_path, counts=None):
+    """Yields the records (dicts with url, fetched_at and html) in a shard.
+
+    A corrupt record, e.g. one cut off by a crash, is skipped with a warning
+    and counted, and reading resumes at the next gzip member.
+
+    Args:
+        shard_path: Path of a shard file.
+        counts: Optional dict whose 'corrupt_records' count is increased for
+            every corrupt stretch of the shard that is skipped.
+    """
+    with open(shard_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            skipping = False
+            while offset < len(data):
+                end = None
+                try:
+                    member, end = read_member(data, offset)
+                    records = [json.loads(line) for line in member.splitlines() if line]
+                except (zlib.error, ValueError) as e:
+                    # Offsets tried after a failure to decompress are part of
+                    # the same corrupt stretch
+                    if not skipping:
+                        print(f'Skipping corrupt record in {shard_path} at byte {offset}: {e!r}')
+                        if counts is not None:
+                            counts['corrupt_records'] = counts.get('corrupt_records', 0) + 1
+                    if end is None:
+                        skipping = True
+                        offset = data.find(GZIP_MAGIC, offset + 1)
+                        if offset == -1:
+                            return
+                        continue
+                    records = []
+                skipping = False
+                offset = end
+                yield from records
+
+
+def iter_pages(archive_dir):
+    """Yields every record in the archive, shard by shard.
+
+    Args:
+        archive_dir: Directory of the archive.
+    """
+    for shard_path in get_shard_paths(archive_dir):
+        yield from iter_shard(shard_path)
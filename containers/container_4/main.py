@@ -1,11 +1,20 @@
 """This is the main web scraping script to scrape MAL user anime lists."""
 
+import os
 import time
 import pickle
 from tqdm import tqdm
 from joblib import Parallel, delayed
 # Scrape is my module that initiates the Chrome driver and contains helper functions
 import scrape
+import telemetry
+
+# Raw pages are archived here so they can be re-parsed with src/reparse.py
+# instead of rescraped
+ARCHIVE_DIR = 'archive'
+# Scraper latency/outcome metrics are exported here. Set before Parallel so
+# workers inherit it.
+os.environ[telemetry.METRICS_DIR_ENV] = 'metrics'
 
 # May need to change the file path depending on where the pickle is located
 with open('user_ids_to_rescrape.pkl', 'rb') as read_file:
@@ -15,7 +24,8 @@ with open('user_ids_to_rescrape.pkl', 'rb') as read_file:
 for i in tqdm(range(645, 871)):
     # Need to change i back to i*100
     animelist_rescraped_100_chunk = Parallel(n_jobs=4, verbose=5) \
-        (map(delayed(scrape.get_animelist_data), user_ids[i*100:i*100+100]))
+        (delayed(scrape.get_animelist_data)(user_id, ARCHIVE_DIR)
+         for user_id in user_ids[i*100:i*100+100])
     scrape.driver.quit()
     with open(f'pickles/animelist_rescraped_100_{i}.pkl', 'wb') as to_write:
         pickle.dump(animelist_rescraped_100_chunk, to_write)
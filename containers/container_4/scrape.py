@@ -8,6 +8,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException
+import archive
+import telemetry
 
 
 # Define Chrome browser options
@@ -24,9 +26,13 @@ chrome_options.add_argument("--no-sandbox")
 # Initialize the driver (aka a new broswer)
 driver = webdriver.Chrome(options=chrome_options)
 
-def create_soup_selenium(url, driver=driver):
+def create_soup_selenium(url, driver=driver, archive_dir=None):
     """Returns BeautifulSoup object for given URL by using Selenium to load
-    the webpage in chromedriver and extract the HTML."""
+    the webpage in chromedriver and extract the HTML.
+
+    If archive_dir is given, the page source is also appended to the page
+    archive in that directory (see archive.py)."""
+    start = time.perf_counter()
     driver.get(url)
     # time.sleep gives time for the webpage to fully load
     # and then I can extract the HTML
@@ -37,59 +43,92 @@ def create_soup_selenium(url, driver=driver):
         # Wait until the page is loaded before returning the soup
         WebDriverWait(driver, 5) \
             .until(expected_conditions.visibility_of_element_located((By.TAG_NAME, 'table')))
-        soup = BeautifulSoup(driver.page_source, 'html5lib')
-        return soup
     # If TimeoutException, means the animelist is restricted and so will
     # return the soup without confirming there is a 'table' element
     except TimeoutException:
         # print("""It's possible that the anime list is restricted or
         # the page is not loading for some reason.
         # Will return the soup and move on.""")
-        soup = BeautifulSoup(driver.page_source, 'html5lib')
-        return soup
+        telemetry.increment('timeouts.animelist')
         # try:
         #     # If 'badresult' class exists, means the anime list is private
         #     # and cannot be accessed. Will return soup as is.
         #     if driver.find_element_by_class_name('badresult'):        #
         # except NoSuchElementException:
         #     driver.refresh()
+    page_source = driver.page_source
+    # Fetch time includes the fixed sleep and the wait for the table
+    telemetry.observe('fetch_seconds.animelist', time.perf_counter() - start)
+    telemetry.increment('bytes.animelist', len(page_source.encode('utf-8')))
+    if archive_dir:
+        archive.append_page(archive_dir, url, page_source)
+    with telemetry.timer('parse_seconds.animelist'):
+        soup = BeautifulSoup(page_source, 'lxml')
+    return soup
+
+def get_animelist_data(user_id, archive_dir=None):
+    """Returns dictionary of data for user's animelist.
 
-def get_animelist_data(user_id):
-    """Returns dictionary of data for user's animelist."""
+    If archive_dir is given, the raw page is also appended to the page archive
+    in that directory."""
     BASE_URL = 'https://myanimelist.net/animelist/'
     url = BASE_URL + user_id
-    soup = create_soup_selenium(url, driver)
+    soup = create_soup_selenium(url, driver, archive_dir)
+    with telemetry.timer('extract_seconds.animelist'):
+        animelist_titles, animelist_scores = parse_animelist_rows(soup)
+    telemetry.record_page('animelist', get_animelist_outcome(soup, animelist_titles))
     animelist_data = {
         'user_id': user_id,
         'animelist_url': url,
-        'animelist_titles': get_animelist_titles(soup),
-        'animelist_scores': get_animelist_scores(soup)
+        'animelist_titles': animelist_titles,
+        'animelist_scores': animelist_scores
     }
     return animelist_data
 
 
-def get_animelist_titles(soup):
-    """Returns list of all anime titles in user's animelist."""
-    if soup.find_all('tbody', class_='list-item'):
-        animelist_titles = []
-        for element in soup.find_all('tbody', class_='list-item'):
-            # Making sure that the element exists before appending
-            if element.find(class_='data title clearfix'):
-                if element.find(class_='data title clearfix').find(class_='link sort'):
-                    animelist_title = element.find(class_='data title clearfix') \
-                        .find(class_='link sort').text
-                    animelist_titles.append(animelist_title)
-        return animelist_titles
+def get_animelist_outcome(soup, animelist_titles):
+    """Returns the outcome of scraping an animelist page: 'ok' if it has anime
+    rows, 'private' if MyAnimeList refused access, 'timeout' if the list table
+    never loaded and 'empty' otherwise."""
+    if animelist_titles is not None:
+        return 'ok'
+    # If 'badresult' class exists, means the anime list is private
+    if soup.find(class_='badresult'):
+        return 'private'
+    # create_soup_selenium waits for a table, so no table means the wait timed out
+    if soup.find('table') is None:
+        return 'timeout'
+    return 'empty'
+
+
+def parse_animelist_row(row):
+    """Returns (title, score) for an animelist row, or None if the row has no
+    title. Rows with a title but no score text get the score '-', the same
+    value MyAnimeList shows for unscored anime."""
+    title_cell = row.find(class_='data title clearfix')
+    title_link = title_cell.find(class_='link sort') if title_cell else None
+    if title_link is None:
+        return None
+    score_cell = row.find(class_='data score')
+    score = score_cell.text.strip() if score_cell else ''
+    return title_link.text, score or '-'
+
 
+def parse_animelist_rows(soup):
+    """Returns (animelist_titles, animelist_scores) for a user's animelist.
 
-def get_animelist_scores(soup):
-    """Returns list of all anime ratings in user's animelist."""
-    if soup.find_all('tbody', class_='list-item'):
-        animelist_scores = []
-        for element in soup.find_all('tbody', class_='list-item'):
-            # Making sure that the element exists before appending
-            if element.find(class_='data score'):
-                if element.find(class_='data score').text:
-                    animelist_score = element.find(class_='data score').text.strip()
-                    animelist_scores.append(animelist_score)
-        return animelist_scores
+    Each row is read once and only rows with a title are kept, so the two lists
+    always have the same length and line up. Both are None if the page has no
+    anime rows (e.g. the list is private or empty).
+    """
+    rows = soup.find_all('tbody', class_='list-item')
+    if not rows:
+        return None, None
+    animelist_titles = []
+    animelist_scores = []
+    for row in rows:
+        title_score = parse_animelist_row(row)
+        if title_score:
+            animelist_titles.append(title_score[0])
+            animelist_scores.append(title_score[1])
+    return animelist_titles, animelist_scores
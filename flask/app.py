@@ -1,14 +1,278 @@
-import pickle
-from flask import Flask, redirect, url_for, request, render_template
-from recommendation.recommender import recommend
+import copy
+import json
+import math
+import numbers
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, redirect, url_for, request, render_template, jsonify, abort, g, make_response
+from recommendation import artifact_manager as am, batcher as bt, fold_in, fold_in_store as fs, metrics, prefix_search, runtime as rt, sharding
 app = Flask(__name__)
 
-with open('../pickles/rec_data.pkl', 'rb') as f:
-    user_anime_cosine_distances_content, user_anime_cosine_distances_collab, \
-        user_score_df, user_anime_history_df, anime_titles = pickle.load(f)
+# Artifact bundles published by anime_recommender.py (see src/artifacts.py). They
+# only hold NumPy arrays and JSON, so serving never imports pandas. The manager
+# swaps to a newly published version in the background without a restart.
+# serve.py memory-maps the arrays (ARTIFACT_MMAP=1) so that its worker processes
+# share one copy, and starts polling in each worker itself (ARTIFACT_POLL_SECONDS=0)
+ARTIFACT_ROOT = os.environ.get('ARTIFACT_ROOT', '../artifacts')
+ARTIFACT_POLL_SECONDS = float(os.environ.get('ARTIFACT_POLL_SECONDS', 10))
+ARTIFACT_MMAP_MODE = 'r' if os.environ.get('ARTIFACT_MMAP') == '1' else None
+manager = am.create_artifact_manager(ARTIFACT_ROOT, ARTIFACT_MMAP_MODE)
+if not am.check_for_update(manager):
+    raise RuntimeError(f'no valid artifact version in {ARTIFACT_ROOT}')
+if ARTIFACT_POLL_SECONDS > 0:
+    am.start_polling(manager, ARTIFACT_POLL_SECONDS)
 
-with open('../pickles/cleaned_top_anime_data_1000_df.pkl', 'rb') as f:
-    top_anime_df = pickle.load(f)
+# NUM_PROBE trades accuracy for speed of the ANN indexes used for fold-in
+# recommendations and can be overridden per request
+NUM_PROBE = int(os.environ.get('ANN_NUM_PROBE', 16))
+
+# With BATCH_WINDOW_MS > 0, lookups of precomputed users from concurrent requests
+# that arrive within the window are filtered together in one batch of at most
+# BATCH_MAX_SIZE users (see recommendation/batcher.py). Only useful with threads,
+# e.g. serve.py --threaded --batch-window-ms 2
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 0))
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 32))
+
+# Per-request profiling (?profile=1 or an X-Profile header) returns a cProfile
+# summary instead of the response. It's off unless ALLOW_PROFILING=1, and each
+# request only pays for a flag check when it isn't used.
+ALLOW_PROFILING = os.environ.get('ALLOW_PROFILING') == '1'
+METRICS_DIR = os.environ.get(metrics.METRICS_DIR_ENV)
+
+# Users whose animelists were sent to the API are folded in, and take priority
+# over the precomputed recommendations, which may be out of date. Their
+# animelists are kept in a fold-in store that every serve.py worker shares (see
+# recommendation/fold_in_store.py), in the artifact root unless
+# FOLD_IN_STORE_DIR is set. With shards each shard root has its own, which is
+# enough since the router sends every request of a user to the same shard.
+FOLD_IN_STORE_DIR = os.environ.get('FOLD_IN_STORE_DIR', os.path.join(ARTIFACT_ROOT, 'fold_in'))
+fold_in_store = fs.create_store(FOLD_IN_STORE_DIR)
+# This worker's fold-in states of stored users, the FOLD_IN_CACHE_SIZE most
+# recently used. Each keeps the store revision and artifact version it was built
+# for, so it is folded in again when another worker changed the user or a new
+# artifact version (with new components) is swapped in. Entries are replaced,
+# never changed in place, so a request that got a state can keep using it
+# while a rating of the same user is handled.
+FOLD_IN_CACHE_SIZE = int(os.environ.get('FOLD_IN_CACHE_SIZE', 10000))
+folded_in_users = OrderedDict()
+folded_in_lock = threading.Lock()
+
+
+def get_filter_recs_batches(items):
+    """Returns rt.get_filter_recs for a batch of (runtime, user_row) items from
+    the batcher. Items of requests that use different artifact versions are
+    filtered in a batch per version."""
+    positions_by_runtime = {}
+    for position, (runtime, _) in enumerate(items):
+        positions_by_runtime.setdefault(id(runtime), (runtime, []))[1].append(position)
+    results = [None] * len(items)
+    for runtime, positions in positions_by_runtime.values():
+        batch_recs = rt.get_filter_recs_batch(runtime, [items[position][1]
+                                                        for position in positions])
+        for position, recs in zip(positions, batch_recs):
+            results[position] = recs
+    return results
+
+
+batcher = None
+if BATCH_WINDOW_MS > 0:
+    batcher = bt.create_batcher(get_filter_recs_batches, BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE)
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+    if ALLOW_PROFILING and (request.args.get('profile') or request.headers.get('X-Profile')):
+        g.profile = metrics.start_profile()
+    # Each request uses one artifact version from start to finish
+    g.artifacts = am.acquire_version(manager)
+
+@app.teardown_request
+def release_artifacts(exception=None):
+    if 'artifacts' in g:
+        am.release_version(manager, g.artifacts)
+
+@app.after_request
+def finish_request(response):
+    if 'profile' in g:
+        response = app.response_class(metrics.get_profile_summary(g.profile),
+                                      status=response.status_code, mimetype='text/plain')
+    if 'artifacts' in g:
+        response.headers['X-Artifact-Version'] = g.artifacts['version']
+    response.headers['Server-Timing'] = metrics.finish_request(
+        request.endpoint, response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+
+def get_cached_fold_in(user_id):
+    """Returns this worker's cached fold-in entry of a user, or None."""
+    with folded_in_lock:
+        folded_in_user = folded_in_users.get(user_id)
+        if folded_in_user is not None:
+            folded_in_users.move_to_end(user_id)
+        return folded_in_user
+
+
+def cache_fold_in(user_id, folded_in_user):
+    """Caches a user's fold-in entry, evicting the least recently used entries
+    beyond FOLD_IN_CACHE_SIZE."""
+    with folded_in_lock:
+        folded_in_users[user_id] = folded_in_user
+        folded_in_users.move_to_end(user_id)
+        while len(folded_in_users) > FOLD_IN_CACHE_SIZE:
+            folded_in_users.popitem(last=False)
+
+
+def get_fold_in_state(user_id, stored=None):
+    """Returns the fold-in state of a user in the fold-in store for the request's
+    artifact version, or None if the user isn't in the store. The user is folded
+    in again if the cached state is of an older revision or another version.
+
+    Args:
+        user_id: User ID.
+        stored: The user from fs.load_user, if it was already loaded.
+    """
+    if stored is None:
+        stored = fs.load_user(fold_in_store, user_id)
+        if stored is None:
+            return None
+    folded_in_user = get_cached_fold_in(user_id)
+    if folded_in_user is None or folded_in_user['revision'] != stored['revision'] \
+            or folded_in_user['version'] != g.artifacts['version']:
+        runtime = g.artifacts['runtime']
+        animelist = stored['animelist']
+        with metrics.span('fold_in_state'):
+            state = fold_in.create_fold_in_state(
+                list(animelist), list(animelist.values()), runtime['anime_idx'],
+                runtime['arrays']['components'], runtime['gram'],
+                runtime['arrays']['anime_features'])
+        folded_in_user = {'revision': stored['revision'], 'version': g.artifacts['version'],
+                          'state': state}
+        cache_fold_in(user_id, folded_in_user)
+    return folded_in_user['state']
+
+
+def get_recs(user_id, collab_weight, num_probe=NUM_PROBE, diversity=0):
+    """Returns (recs, rec_rows) for a folded-in or precomputed user, or None if
+    the user is unknown. With diversity above 0, recs are re-ranked by
+    rt.rerank_diverse, but rec_rows keep the order before re-ranking."""
+    runtime = g.artifacts['runtime']
+    with metrics.span('lookup'):
+        user_row = runtime['user_idx'].get(user_id)
+    # Precomputed users are only looked up in the fold-in store if its listing
+    # has them, so most requests don't touch the store's files
+    state = None
+    if user_row is None or fs.has_user(fold_in_store, user_id):
+        state = get_fold_in_state(user_id)
+    if state is not None:
+        with metrics.span('fold_in_recs'):
+            collab_recs, content_recs = fold_in.get_fold_in_recs(
+                state, runtime['arrays']['components'],
+                runtime['arrays']['anime_features'], runtime['anime_titles'],
+                ann_indexes=runtime['ann_indexes'], num_probe=num_probe)
+    else:
+        if user_row is None:
+            return None
+        if batcher is None:
+            collab_recs, content_recs = rt.get_filter_recs(runtime, user_row)
+        else:
+            collab_recs, content_recs = bt.submit(batcher, (runtime, user_row))
+    recs, rec_rows = rt.fuse_recs(collab_recs, content_recs, collab_weight)
+    if diversity > 0:
+        recs = rt.rerank_diverse(runtime, rec_rows, diversity, len(recs))
+    return recs, rec_rows
+
+
+def bad_request(message):
+    """Aborts the request with a 400 response whose JSON body says what's wrong."""
+    abort(make_response(jsonify(error=message), 400))
+
+
+def get_json_object():
+    """Returns the request's JSON body, which must be an object."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        bad_request('the request body must be a JSON object')
+    return body
+
+
+def check_score(score):
+    """Aborts with 400 unless score is a valid animelist score: a number from 1
+    to 10 (numeric strings like the scraper's '7' too) or '-' for on the
+    animelist but not scored."""
+    if score == '-':
+        return
+    if isinstance(score, str):
+        try:
+            score = float(score)
+        except ValueError:
+            pass
+    if isinstance(score, bool) or not isinstance(score, numbers.Real) or not 1 <= score <= 10:
+        bad_request(f'scores must be numbers from 1 to 10 or "-", not {score!r}')
+
+
+def get_number(name, value, default, parse=float, low=None, high=None):
+    """Returns a number from a query argument or URL part of the request,
+    clamped to [low, high]. Aborts with 400 if it isn't a finite number.
+
+    Args:
+        name: Name of the argument, for the error message.
+        value: The argument's string, or None if it's missing.
+        default: Returned if the argument is missing or empty.
+        parse: int or float.
+        low: Smallest value, or None.
+        high: Largest value, or None.
+    """
+    if value is None or value == '':
+        return default
+    try:
+        number = parse(value)
+    except ValueError:
+        number = None
+    if number is None or not math.isfinite(number):
+        bad_request(f'{name} must be {"an integer" if parse is int else "a number"}, '
+                    f'not {value!r}')
+    if low is not None:
+        number = max(number, low)
+    if high is not None:
+        number = min(number, high)
+    return number
+
+
+def get_diversity(value):
+    """Returns the diversity weight of a request, clamped to [0, 1]."""
+    return get_number('diversity', value, 0, low=0, high=1)
+
+
+def suggest_user_ids(user_id, limit=5):
+    """Returns (prefix_len, user_ids): known user IDs that share the longest
+    possible prefix with an unknown user ID, e.g. to catch a typo near its end,
+    and the length of that prefix (0 if there are none)."""
+    prefix_indexes = g.artifacts['runtime']['prefix_indexes']
+    if 'users' not in prefix_indexes:
+        return 0, []
+    keys, rows = prefix_indexes['users']
+    for prefix_len in range(len(user_id), 0, -1):
+        found = prefix_search.search(keys, rows, user_id[:prefix_len], limit)
+        if found:
+            return prefix_len, [g.artifacts['runtime']['user_ids'][row] for row in found]
+    return 0, []
+
+
+def get_unknown_user_suggestions(user_id):
+    """Returns the user IDs to suggest in place of an unknown user ID. Behind
+    the router, this shard only knows its own users, so the router sends the
+    closest user IDs of every shard in a header."""
+    suggested = request.headers.get(sharding.SUGGESTED_USER_IDS_HEADER)
+    if suggested:
+        try:
+            return [str(suggested_id) for suggested_id in json.loads(suggested)]
+        except (ValueError, TypeError):
+            pass
+    return suggest_user_ids(user_id)[1]
 
 # To pass a variable into my request function, I need to put it into the URL
 @app.route('/recommendation/<user_id>/<adventurous_level>', methods=['POST', 'GET'])
@@ -17,22 +281,165 @@ def recommendation(user_id, adventurous_level):
         # Use request.form for POST requests and request.args for GET requests
         return redirect(url_for('recommendation',
                                 user_id=request.form.get('user_id'),
-                                adventurous_level=request.form.get('adventurous_level')))
+                                adventurous_level=request.form.get('adventurous_level'),
+                                diversity=request.form.get('diversity')))
+
+    diversity = get_diversity(request.args.get('diversity'))
+    fused = get_recs(user_id, get_number('adventurous_level', adventurous_level, 1),
+                     diversity=diversity)
+    if fused is None:
+        # Back to the form, with the closest user IDs in case of a typo
+        return render_template('index.html', unknown_user_id=user_id,
+                               suggestions=get_unknown_user_suggestions(user_id)), 404
+
+    with metrics.span('render'):
+        recs_dicts = []
+        for anime_title in fused[0]:
+            url, image_url = rt.get_anime_links(g.artifacts['runtime'], anime_title)
+            recs_dicts.append({'anime_title': anime_title, 'url': url, 'image_url': image_url})
+        return render_template('recommendation.html', recs=recs_dicts, user_id=user_id,
+                               adventurous_level=adventurous_level, diversity=diversity)
+
+@app.route('/api/users/<user_id>/animelist', methods=['PUT'])
+def put_animelist(user_id):
+    # Expects {"animelist_titles": [...], "animelist_scores": [...]} like the scraper
+    # output. Titles that aren't in the recommender are ignored.
+    animelist = get_json_object()
+    titles = animelist.get('animelist_titles')
+    scores = animelist.get('animelist_scores')
+    if not isinstance(titles, list) or not isinstance(scores, list) \
+            or len(titles) != len(scores):
+        bad_request('animelist_titles and animelist_scores must be lists of the same length')
+    if not all(isinstance(title, str) for title in titles):
+        bad_request('animelist_titles must be strings')
+    for score in scores:
+        check_score(score)
+    animelist = dict(zip(titles, scores))
+    with fs.lock_user(fold_in_store, user_id):
+        stored = fs.load_user(fold_in_store, user_id)
+        revision = 1 if stored is None else stored['revision'] + 1
+        fs.save_user(fold_in_store, user_id, animelist, revision)
+        state = get_fold_in_state(user_id, {'animelist': animelist, 'revision': revision})
+    return jsonify(user_id=user_id, num_anime=state['num_on_animelist'])
+
+@app.route('/api/users/<user_id>/ratings', methods=['POST'])
+def post_rating(user_id):
+    # Expects {"anime_title": ..., "score": ...} where a null score removes the anime
+    rating = get_json_object()
+    if 'anime_title' not in rating or 'score' not in rating:
+        bad_request('expected "anime_title" and "score"')
+    if rating['anime_title'] not in g.artifacts['runtime']['anime_idx']:
+        bad_request(f"unknown anime title {rating['anime_title']!r}")
+    if rating['score'] is not None:
+        check_score(rating['score'])
+    runtime = g.artifacts['runtime']
+    with fs.lock_user(fold_in_store, user_id):
+        stored = fs.load_user(fold_in_store, user_id)
+        if stored is None:
+            abort(404)
+        # A copy of the state of the stored revision is updated for the rating
+        # instead of folding the user in again
+        state = copy.deepcopy(get_fold_in_state(user_id, stored))
+        animelist = stored['animelist']
+        if rating['score'] is None:
+            animelist.pop(rating['anime_title'], None)
+        else:
+            animelist[rating['anime_title']] = rating['score']
+        fs.save_user(fold_in_store, user_id, animelist, stored['revision'] + 1)
+        fold_in.update_fold_in_rating(state, rating['anime_title'], rating['score'],
+                                      runtime['anime_idx'], runtime['arrays']['components'],
+                                      runtime['gram'], runtime['arrays']['anime_features'])
+        cache_fold_in(user_id, {'revision': stored['revision'] + 1,
+                                'version': g.artifacts['version'], 'state': state})
+    return jsonify(user_id=user_id, num_anime=state['num_on_animelist'])
+
+@app.route('/api/recommendation/<user_id>', methods=['GET'])
+def api_recommendation(user_id):
+    # diversity between 0 and 1 trades relevance for variety (see rt.rerank_diverse)
+    # The ANN search probes at most all of its lists, however large num_probe is
+    fused = get_recs(user_id, get_number('adventurous_level',
+                                         request.args.get('adventurous_level'), 1),
+                     get_number('num_probe', request.args.get('num_probe'), NUM_PROBE, int,
+                                low=1),
+                     get_diversity(request.args.get('diversity')))
+    if fused is None:
+        abort(404)
+    recs, rec_rows = fused
+    if request.args.get('debug'):
+        # Scores behind the recommendations, shaped like recs_df
+        return jsonify(user_id=user_id, recs=recs,
+                       details=rt.get_recs_df(user_id, rec_rows).to_dict(orient='records'))
+    return jsonify(user_id=user_id, recs=recs)
+
+@app.route('/api/anime/<path:anime_title>/similar', methods=['GET'])
+def similar_anime(anime_title):
+    # kind is 'content' (similar genres, type, etc.) or 'collab' (liked by the
+    # same users). Only a row of the precomputed table is read.
+    kind = request.args.get('kind', 'content')
+    runtime = g.artifacts['runtime']
+    if kind not in runtime['neighbour_table'] or anime_title not in runtime['anime_idx']:
+        abort(404)
+    neighbour_idxs, neighbour_dists = runtime['neighbour_table'][kind]
+    num_recs = get_number('num_recs', request.args.get('num_recs'), 10, int, low=0,
+                          high=neighbour_idxs.shape[1])
+    idx = runtime['anime_idx'][anime_title]
+    similar = [{'anime_title': runtime['anime_titles'][neighbour_idx],
+                'similarity': round(1 - float(dist), 4)}
+               for neighbour_idx, dist in zip(neighbour_idxs[idx, :num_recs],
+                                              neighbour_dists[idx, :num_recs])]
+    return jsonify(anime_title=anime_title, kind=kind, similar=similar)
+
+@app.route('/api/suggest/<kind>', methods=['GET'])
+def suggest(kind):
+    # Autocomplete for kind 'users' (user IDs) or 'anime' (main and English
+    # titles, most popular first), e.g. /api/suggest/anime?q=attack%20on
+    runtime = g.artifacts['runtime']
+    if kind not in runtime['prefix_indexes']:
+        abort(404)
+    keys, rows = runtime['prefix_indexes'][kind]
+    query = request.args.get('q', '')
+    try:
+        limit = prefix_search.parse_limit(request.args.get('limit'))
+    except ValueError:
+        bad_request(f"limit must be an integer, not {request.args['limit']!r}")
+    if kind == 'users' and request.args.get('closest'):
+        # Falls back to shorter prefixes of q like the unknown user page, so that
+        # the router can keep the closest suggestions of every shard
+        with metrics.span('prefix_search'):
+            prefix_len, user_ids = suggest_user_ids(query, limit)
+        return jsonify(q=query, suggestions=user_ids, prefix_len=prefix_len)
+    with metrics.span('prefix_search'):
+        found = prefix_search.search(keys, rows, query, limit, by_row=kind == 'anime')
+    if kind == 'users':
+        return jsonify(q=query, suggestions=[runtime['user_ids'][row] for row in found])
+    return jsonify(q=query, suggestions=[{'anime_title': runtime['anime_titles'][idx],
+                                          'url': runtime['anime_urls'][idx]}
+                                         for idx in found])
 
-    recs, _ = recommend(user_id, user_anime_cosine_distances_content,
-                        user_anime_cosine_distances_collab, user_score_df,
-                        user_anime_history_df, anime_titles,
-                        collab_weight=float(adventurous_level))
+@app.route('/api/version', methods=['GET'])
+def artifact_version():
+    # Active artifact version and any old versions still draining requests
+    return jsonify(am.get_status(manager))
 
-    recs_dicts = [
-        {'anime_title': anime_title,
-         'url': top_anime_df[top_anime_df['title_main'] == anime_title]['url'].values[0],
-         'image_url': top_anime_df[top_anime_df['title_main'] == anime_title]['image_url'].values[0]}
-        for anime_title in recs
-    ]
+def get_json_percentile(histogram, percentile):
+    """Returns metrics.estimate_percentile, with None instead of inf (not valid JSON)."""
+    bound = metrics.estimate_percentile(histogram, percentile)
+    return None if bound == float('inf') else bound
 
-    return render_template('recommendation.html', recs=recs_dicts, user_id=user_id,
-                           adventurous_level=adventurous_level)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Latency histograms of each stage and endpoint, merged over all serve.py
+    # workers if they export to SERVE_METRICS_DIR
+    histograms, counters = metrics.get_all_metrics(METRICS_DIR)
+    if request.args.get('format') == 'json':
+        summary = {name: {'count': histogram['count'],
+                          'mean': histogram['sum'] / histogram['count'],
+                          **{f'p{p}<=': get_json_percentile(histogram, p)
+                             for p in (50, 95, 99)}}
+                   for name, histogram in histograms.items() if histogram['count']}
+        return jsonify(histograms=summary, counters=counters)
+    return app.response_class(metrics.format_prometheus(histograms, counters),
+                              mimetype='text/plain; version=0.0.4')
 
 @app.route('/', methods=['POST', 'GET'])
 def form():
@@ -40,7 +447,8 @@ def form():
         # Use request.form for POST requests and request.args for GET requests
         return redirect(url_for('recommendation',
                                 user_id=request.form.get('user_id'),
-                                adventurous_level=request.form.get('adventurous_level')))
+                                adventurous_level=request.form.get('adventurous_level'),
+                                diversity=request.form.get('diversity')))
     return render_template('index.html')
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+"""This module contains a pure-NumPy approximate nearest-neighbour index for
+cosine distance over anime vectors (NMF anime embeddings or content features).
+
+The index is an inverted file (IVF): anime vectors are normalized and grouped
+into lists by spherical k-means. A query only scores the anime in the
+num_probe lists whose centroids are closest to it, so more probes trade
+latency for recall. With num_probe equal to the number of lists the search is
+exact.
+"""
+
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """Returns vectors scaled to unit length (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def build_ivf_index(vectors, num_lists=None, num_iter=20, seed=4444):
+    """Returns IVF index dict for cosine search over vectors.
+
+    Args:
+        vectors: Anime vectors, shape (n_anime, n_dims). Row i is anime i.
+        num_lists: Number of k-means lists. Defaults to about sqrt(n_anime).
+        num_iter: Number of spherical k-means iterations.
+        seed: Random seed for picking the initial centroids.
+    """
+    unit_vectors = normalize_rows(vectors)
+    num_vectors = len(unit_vectors)
+    num_lists = min(num_lists or max(1, int(np.sqrt(num_vectors))), num_vectors)
+    rng = np.random.default_rng(seed)
+    centroids = unit_vectors[rng.choice(num_vectors, num_lists, replace=False)]
+    for _ in range(num_iter):
+        assignments = (unit_vectors @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, unit_vectors)
+        # Lists that lost all their vectors restart from a random vector
+        empty = np.bincount(assignments, minlength=num_lists) == 0
+        sums[empty] = unit_vectors[rng.choice(num_vectors, empty.sum())]
+        centroids = normalize_rows(sums)
+    assignments = (unit_vectors @ centroids.T).argmax(axis=1)
+    list_ids = np.argsort(assignments, kind='stable').astype(np.int32)
+    list_offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(assignments, minlength=num_lists))]).astype(np.int64)
+    return {
+        'centroids': centroids,
+        'list_offsets': list_offsets,
+        'list_ids': list_ids,
+        # Stored in list order so each list is a contiguous block
+        'list_vectors': unit_vectors[list_ids]
+    }
+
+
+def query_ivf_index(index, query, k=50, num_probe=8):
+    """Returns (anime_idxs, cosine_distances) of the approximate k nearest anime
+    to query, nearest first.
+
+    Args:
+        index: Dict returned by build_ivf_index.
+        query: Query vector, shape (n_dims,).
+        k: Number of neighbours.
+        num_probe: Number of lists to search.
+    """
+    query = normalize_rows(np.asarray(query).reshape(1, -1))[0]
+    centroids = index['centroids']
+    num_probe = min(num_probe, len(centroids))
+    probed = np.argpartition(-(centroids @ query), num_probe - 1)[:num_probe]
+    offsets = index['list_offsets']
+    positions = np.concatenate([np.arange(offsets[i], offsets[i+1]) for i in probed])
+    k = min(k, len(positions))
+    if k == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    distances = 1 - index['list_vectors'][positions] @ query
+    nearest = np.argpartition(distances, k - 1)[:k]
+    nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+    return index['list_ids'][positions[nearest]], distances[nearest]
+
+
+def exact_search(vectors, query, k=50):
+    """Returns (anime_idxs, cosine_distances) of the exact k nearest anime,
+    nearest first. Used as the reference for query_ivf_index.
+
+    Args:
+        vectors: Anime vectors, normalized with normalize_rows.
+        query: Query vector, shape (n_dims,).
+        k: Number of neighbours.
+    """
+    query = normalize_rows(np.asarray(query).reshape(1, -1))[0]
+    distances = 1 - vectors @ query
+    k = min(k, len(distances))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    nearest = np.argpartition(distances, k - 1)[:k]
+    nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+    return nearest, distances[nearest]
@@ -0,0 +1,154 @@
+"""This module hot-swaps the artifact bundle the Flask app serves from.
+
+src/artifacts.publish_bundle writes each bundle as a version under an artifact
+root and points the CURRENT file at it. The manager polls CURRENT in a
+background thread, loads and validates a new version while the old one keeps
+serving, and then swaps a single reference. Requests hold a version with
+acquire_runtime for as long as they use it, so the old version is only released
+once its in-flight requests have drained. A version that fails to load or
+validate is skipped and the old one keeps serving.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+from recommendation import artifacts, runtime as rt
+
+
+def create_artifact_manager(artifact_root, mmap_mode=None):
+    """Returns artifact manager dict for the bundle versions in artifact_root.
+
+    Args:
+        artifact_root: Directory holding bundle versions and CURRENT.
+        mmap_mode: Passed to np.load when loading bundles.
+    """
+    return {
+        'artifact_root': artifact_root,
+        'mmap_mode': mmap_mode,
+        # Guards in-flight counts and the list of draining versions. Swapping
+        # 'active' itself is a single assignment.
+        'lock': threading.Condition(),
+        'active': None,
+        'draining': [],
+        'failed_versions': set()
+    }
+
+
+def load_version(manager, version):
+    """Returns a validated active-version dict for version.
+
+    Raises ValueError (or OSError) if the bundle can't be loaded or is invalid.
+    """
+    runtime = rt.load_runtime(os.path.join(manager['artifact_root'], version),
+                              manager['mmap_mode'])
+    rt.validate_runtime(runtime)
+    return {'version': version, 'runtime': runtime, 'loaded_at': time.time(), 'in_flight': 0}
+
+
+def swap_version(manager, new_active):
+    """Makes new_active the active version and starts draining the old one."""
+    with manager['lock']:
+        old_active = manager['active']
+        manager['active'] = new_active
+        if old_active is not None:
+            manager['draining'].append(old_active)
+        release_drained(manager)
+
+
+def release_drained(manager):
+    """Drops draining versions without in-flight requests. Call with the lock
+    held."""
+    manager['draining'] = [active for active in manager['draining']
+                           if active['in_flight'] > 0]
+    manager['lock'].notify_all()
+
+
+def check_for_update(manager):
+    """Loads and swaps to the version named by CURRENT if it changed. Returns
+    True if the active version changed."""
+    version = artifacts.get_current_version(manager['artifact_root'])
+    active = manager['active']
+    if version is None or version in manager['failed_versions'] \
+            or (active is not None and version == active['version']):
+        return False
+    try:
+        new_active = load_version(manager, version)
+    except (OSError, ValueError, KeyError) as e:
+        # Keep serving the old version rather than retrying a broken bundle
+        # every poll; publishing a new version clears this
+        manager['failed_versions'].add(version)
+        print(f'Skipping artifact version {version}: {e!r}')
+        return False
+    swap_version(manager, new_active)
+    return True
+
+
+def start_polling(manager, poll_interval=10):
+    """Starts a daemon thread that calls check_for_update every poll_interval
+    seconds. Returns the thread."""
+    def poll():
+        while True:
+            time.sleep(poll_interval)
+            try:
+                check_for_update(manager)
+            except Exception as e:
+                print(f'Artifact poll failed: {e!r}')
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    return thread
+
+
+def acquire_version(manager):
+    """Returns the active-version dict and counts a request in flight on it.
+    Every call must be paired with release_version."""
+    with manager['lock']:
+        active = manager['active']
+        if active is None:
+            raise RuntimeError('no artifact version loaded')
+        active['in_flight'] += 1
+        return active
+
+
+def release_version(manager, active):
+    """Ends a request started with acquire_version. If a newer version was
+    swapped in meanwhile, this may let the old one be released."""
+    with manager['lock']:
+        active['in_flight'] -= 1
+        if active is not manager['active']:
+            release_drained(manager)
+
+
+@contextlib.contextmanager
+def acquire_runtime(manager):
+    """Context manager that yields the active runtime and keeps its version from
+    being released until the block exits, even if a new version is swapped in
+    meanwhile."""
+    active = acquire_version(manager)
+    try:
+        yield active['runtime']
+    finally:
+        release_version(manager, active)
+
+
+def wait_until_drained(manager, timeout=None):
+    """Waits until no old version has in-flight requests. Returns True if
+    drained, False on timeout."""
+    with manager['lock']:
+        return manager['lock'].wait_for(lambda: not manager['draining'], timeout)
+
+
+def get_status(manager):
+    """Returns dict describing the active version and versions still draining."""
+    with manager['lock']:
+        active = manager['active']
+        return {
+            'version': active and active['version'],
+            'loaded_at': active and active['loaded_at'],
+            'created_at': active and active['runtime']['manifest'].get('created_at'),
+            'in_flight': active and active['in_flight'],
+            'shard': active and active['runtime']['manifest'].get('shard'),
+            'draining': {old['version']: old['in_flight'] for old in manager['draining']}
+        }
@@ -0,0 +1,240 @@
+"""This module writes the serving artifact bundle that flask/recommendation/runtime.py
+loads.
+
+A bundle is a directory of .npy arrays plus ids.json (user IDs, anime titles,
+URLs) and manifest.json (array shapes and dtypes). Unlike rec_data.pkl it holds
+no DataFrames, so the Flask app can load it without importing pandas, and it
+only keeps what serving needs: each user's top candidate anime instead of the
+full user x anime distance matrices.
+
+Bundles are published as versions under an artifact root, e.g.
+../artifacts/20201101-120000-042137/, and the CURRENT file in the root names
+the version to serve. The Flask app watches CURRENT and swaps to a new version
+without restarting (see flask/recommendation/artifact_manager.py), loading
+bundles with its copy of this module, flask/recommendation/artifacts.py.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+# Same cutoff as get_collab_filt_recs and get_content_filt_recs
+NUM_CANDIDATES = 50
+FORMAT_VERSION = 1
+CURRENT_POINTER = 'CURRENT'
+
+
+def get_candidates(dist_matrix, num_candidates=NUM_CANDIDATES, block_size=10000):
+    """Returns int32 array of each user's num_candidates nearest anime.
+
+    Uses the same argsort as get_collab_filt_recs and get_content_filt_recs, so
+    ties are broken the same way as the pandas recommender.
+
+    Args:
+        dist_matrix: Pairwise distance matrix between users and anime.
+        num_candidates: Number of candidates per user.
+        block_size: Number of users sorted at a time.
+    """
+    num_users, num_anime = dist_matrix.shape
+    num_candidates = min(num_candidates, num_anime)
+    candidates = np.empty((num_users, num_candidates), dtype=np.int32)
+    for start in range(0, num_users, block_size):
+        block = np.asarray(dist_matrix[start:start+block_size])
+        candidates[start:start+block_size] = block.argsort(axis=1)[:, :num_candidates]
+    return candidates
+
+
+def get_nonzero_csr(matrix):
+    """Returns (indptr, indices) of the non-zero entries in each row of a dense
+    user x anime matrix, e.g. the scored or watched anime of each user.
+
+    Args:
+        matrix: Dense user x anime array.
+    """
+    rows, indices = np.nonzero(matrix)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(matrix)))])
+    return indptr.astype(np.int64), indices.astype(np.int32)
+
+
+def create_serving_arrays(user_anime_cosine_distances_content,
+                          user_anime_cosine_distances_collab, user_scores,
+                          user_anime_history, components, anime_features,
+                          ann_indexes=None, neighbour_table=None):
+    """Returns dict of named arrays for save_bundle.
+
+    Args:
+        user_anime_cosine_distances_content: Content-based filtering user x anime
+            cosine distances.
+        user_anime_cosine_distances_collab: Collaborative filtering user x anime
+            cosine distances.
+        user_scores: User-rating matrix without metadata columns, user x anime.
+        user_anime_history: 1 = on animelist, 0 = not on animelist, user x anime.
+        components: NMF components_, shape (n_components, n_anime).
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+        ann_indexes: Optional dict of IVF indexes from src/ann.py.
+        neighbour_table: Optional dict from item_neighbours.create_neighbour_table.
+    """
+    scored_indptr, scored_indices = get_nonzero_csr(np.asarray(user_scores))
+    history_indptr, history_indices = get_nonzero_csr(np.asarray(user_anime_history))
+    arrays = {
+        'collab_candidates': get_candidates(user_anime_cosine_distances_collab),
+        'content_candidates': get_candidates(user_anime_cosine_distances_content),
+        'scored_indptr': scored_indptr,
+        'scored_indices': scored_indices,
+        'history_indptr': history_indptr,
+        'history_indices': history_indices,
+        'components': np.asarray(components, dtype=float),
+        'anime_features': np.asarray(anime_features, dtype=float)
+    }
+    for kind, index in (ann_indexes or {}).items():
+        for key, array in index.items():
+            arrays[f'{kind}_ivf_{key}'] = array
+    for kind, (neighbour_idxs, neighbour_dists) in (neighbour_table or {}).items():
+        arrays[f'{kind}_neighbour_idxs'] = neighbour_idxs
+        arrays[f'{kind}_neighbour_dists'] = neighbour_dists
+    return arrays
+
+
+def create_serving_ids(user_ids, anime_titles, top_anime_df):
+    """Returns dict of the user IDs, anime titles, and anime URLs for save_bundle.
+
+    Args:
+        user_ids: User IDs in the row order of the serving arrays.
+        anime_titles: Anime titles in the column order of the serving arrays.
+        top_anime_df: Cleaned top anime DataFrame with 'title_main', 'url' and
+            'image_url' columns.
+    """
+    anime_urls = dict(zip(top_anime_df['title_main'], top_anime_df['url']))
+    image_urls = dict(zip(top_anime_df['title_main'], top_anime_df['image_url']))
+    return {
+        'user_ids': [str(user_id) for user_id in user_ids],
+        'anime_titles': list(anime_titles),
+        'anime_urls': [anime_urls.get(title, '') for title in anime_titles],
+        'image_urls': [image_urls.get(title, '') for title in anime_titles]
+    }
+
+
+def save_bundle(bundle_dir, arrays, ids, shard=None, link_from=None, linked_names=()):
+    """Writes arrays, ids.json and manifest.json to bundle_dir.
+
+    Args:
+        bundle_dir: Directory to write to. Created if it doesn't exist.
+        arrays: Dict mapping array name to NumPy array.
+        ids: Dict from create_serving_ids.
+        shard: Optional dict with the 'index' and 'num_shards' of a user shard
+            (see src/sharding.py), recorded in the manifest.
+        link_from: Optional bundle directory, e.g. the previous version, to
+            hard-link the arrays in linked_names from instead of writing them.
+            They are written if linking fails (e.g. across file systems).
+        linked_names: Names of arrays that are unchanged in link_from.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    for name, array in arrays.items():
+        path = os.path.join(bundle_dir, f'{name}.npy')
+        if link_from and name in linked_names:
+            try:
+                os.link(os.path.join(link_from, f'{name}.npy'), path)
+                continue
+            except OSError:
+                pass
+        np.save(path, np.ascontiguousarray(array))
+    with open(os.path.join(bundle_dir, 'ids.json'), 'w') as f:
+        # json.dumps encodes in C but json.dump in Python, which is ~10x slower
+        # with hundreds of thousands of user IDs
+        f.write(json.dumps(ids))
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'created_at': time.time(),
+        'arrays': {name: {'shape': list(array.shape), 'dtype': str(array.dtype)}
+                   for name, array in arrays.items()}
+    }
+    if shard is not None:
+        manifest['shard'] = shard
+    # The manifest is written last, so a bundle without one is incomplete
+    with open(os.path.join(bundle_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_bundle(bundle_dir, mmap_mode=None):
+    """Returns (arrays, ids, manifest) of a bundle written by save_bundle.
+
+    Args:
+        bundle_dir: Bundle directory.
+        mmap_mode: Passed to np.load, e.g. 'r' to memory-map the arrays.
+    """
+    with open(os.path.join(bundle_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    with open(os.path.join(bundle_dir, 'ids.json')) as f:
+        ids = json.load(f)
+    arrays = {name: np.load(os.path.join(bundle_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in manifest['arrays']}
+    return arrays, ids, manifest
+
+
+def get_current_version(artifact_root):
+    """Returns the version named by the CURRENT pointer of artifact_root, or None
+    if nothing has been published."""
+    try:
+        with open(os.path.join(artifact_root, CURRENT_POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def create_version():
+    """Returns a new version name: the current time to the microsecond, e.g.
+    20201101-120000-042137, so versions sort by when they were created and
+    publishes within the same second get different names."""
+    now = time.time()
+    return time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f'-{int(now % 1 * 1e6):06d}'
+
+
+def publish_bundle(artifact_root, arrays, ids, version=None, shard=None, link_from=None,
+                   linked_names=()):
+    """Writes a bundle as a new version under artifact_root and points CURRENT at
+    it. Returns the version.
+
+    The bundle is written to a temporary directory and renamed into place, and
+    CURRENT is replaced with os.replace, so readers only ever see the old
+    version or the complete new one.
+
+    Args:
+        artifact_root: Directory holding bundle versions and CURRENT.
+        arrays: Dict mapping array name to NumPy array.
+        ids: Dict from create_serving_ids.
+        version: Version name. Defaults to create_version(), which is retried
+            if another publish took the name first. An explicit version that
+            already exists raises FileExistsError.
+        shard: Optional shard dict passed to save_bundle.
+        link_from: Optional bundle directory passed to save_bundle.
+        linked_names: Names of arrays to hard-link from link_from.
+    """
+    new_version = version or create_version()
+    # Temporary names are unique per thread, so concurrent publishes don't
+    # write into each other's files
+    tmp_name = f'{os.getpid()}.{threading.get_ident()}.tmp'
+    tmp_dir = os.path.join(artifact_root, f'.{new_version}.{tmp_name}')
+    save_bundle(tmp_dir, arrays, ids, shard, link_from, linked_names)
+    while True:
+        try:
+            os.rename(tmp_dir, os.path.join(artifact_root, new_version))
+            break
+        except OSError as e:
+            # Renaming onto an existing (non-empty) version fails
+            if not os.path.isdir(os.path.join(artifact_root, new_version)):
+                raise
+            if version:
+                shutil.rmtree(tmp_dir)
+                raise FileExistsError(f'version {version} already exists in '
+                                      f'{artifact_root}') from e
+            new_version = create_version()
+    version = new_version
+    tmp_pointer = os.path.join(artifact_root, f'.{CURRENT_POINTER}.{tmp_name}')
+    with open(tmp_pointer, 'w') as f:
+        f.write(version)
+    os.replace(tmp_pointer, os.path.join(artifact_root, CURRENT_POINTER))
+    return version
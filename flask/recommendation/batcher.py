@@ -0,0 +1,97 @@
+"""This module contains a micro-batcher that coalesces the lookups of concurrent
+requests into one batched NumPy operation.
+
+Request threads put an item on a queue and wait for its result. A background
+thread takes the first waiting item, keeps collecting items until window
+seconds after that item arrived or until max_batch_size items are waiting,
+runs process_batch on all of them at once and hands each request its result.
+A longer window gives bigger batches (more throughput per NumPy call) at the
+cost of queueing latency. Queueing time is recorded in the 'batch_queue' stage
+histogram and the time a whole request waits in 'batch_wait'. The counters
+batches.batches and batches.items give the mean batch size.
+
+Batching only helps when a process handles several requests at once, i.e.
+serve.py --threaded. The thread is started by the first submit in each process,
+so it also works after serve.py forks its workers.
+"""
+
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from recommendation import metrics
+
+
+def create_batcher(process_batch, window=0.002, max_batch_size=32):
+    """Returns batcher dict used by the functions in this module.
+
+    Args:
+        process_batch: Function that takes a list of items and returns a list of
+            their results in the same order.
+        window: Seconds to wait for more items after the first item of a batch
+            arrives.
+        max_batch_size: Most items in one batch.
+    """
+    return {
+        'process_batch': process_batch,
+        'window': window,
+        'max_batch_size': max_batch_size,
+        'queue': queue.Queue(),
+        'lock': threading.Lock(),
+        # Process that started the batching thread (threads don't survive fork)
+        'pid': None
+    }
+
+
+def submit(batcher, item):
+    """Returns the result of item once its batch has been processed. Raises the
+    exception of process_batch if it failed."""
+    if batcher['pid'] != os.getpid():
+        with batcher['lock']:
+            if batcher['pid'] != os.getpid():
+                # A queue inherited over fork may hold items of the parent's requests
+                batcher['queue'] = queue.Queue()
+                threading.Thread(target=run_batches, args=(batcher,), daemon=True).start()
+                batcher['pid'] = os.getpid()
+    future = concurrent.futures.Future()
+    batcher['queue'].put((time.perf_counter(), item, future))
+    with metrics.span('batch_wait'):
+        return future.result()
+
+
+def get_batch(batcher):
+    """Returns list of (enqueued_at, item, future) for the next batch, waiting
+    for the first item as long as it takes."""
+    batch = [batcher['queue'].get()]
+    deadline = batch[0][0] + batcher['window']
+    while len(batch) < batcher['max_batch_size']:
+        timeout = deadline - time.perf_counter()
+        try:
+            # Items that are already waiting are taken even after the deadline
+            batch.append(batcher['queue'].get(timeout=timeout) if timeout > 0
+                         else batcher['queue'].get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def run_batches(batcher):
+    """Processes batches forever. Runs in the batching thread."""
+    while True:
+        batch = get_batch(batcher)
+        started_at = time.perf_counter()
+        for enqueued_at, _, _ in batch:
+            metrics.observe('stage_seconds.batch_queue', started_at - enqueued_at)
+        metrics.increment('batches.batches')
+        metrics.increment('batches.items', len(batch))
+        try:
+            with metrics.span('batch'):
+                results = batcher['process_batch']([item for _, item, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            continue
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,213 @@
+"""This module contains functions to fold new or updated users into the
+recommender without retraining.
+
+A user's collaborative filtering embedding is found by solving for the
+non-negative weights that best reconstruct their scores from the fixed NMF
+components_ (what NMF.transform does), and their content-based user vector is
+the mean of the feature vectors of the anime on their animelist (as in
+create_user_vector_df). Both can be updated cheaply when a single rating
+changes.
+"""
+
+import numpy as np
+from recommendation import ann
+
+# Same cutoff as get_collab_filt_recs and get_content_filt_recs
+NUM_CANDIDATES = 50
+
+
+def create_anime_idx(anime_titles):
+    """Returns dict mapping anime title to its column index.
+
+    Args:
+        anime_titles: List of anime titles considered in recommender system.
+    """
+    return {anime_title: idx for idx, anime_title in enumerate(anime_titles)}
+
+
+def parse_score(score):
+    """Returns a scraped animelist score as a number ('-', meaning not scored, is 0)."""
+    return 0 if score in ('-', '', None) else float(score)
+
+
+def solve_user_embedding(gram, rhs, user_embedding=None, max_iter=100, tol=1e-6):
+    """Returns the non-negative user embedding w minimizing ||x - wH||^2 for
+    fixed NMF components H, solved by coordinate descent on the normal equations.
+
+    Args:
+        gram: H @ H.T, shape (n_components, n_components).
+        rhs: H @ x for the user's score vector x, shape (n_components,).
+        user_embedding: Optional starting point, e.g. the previous embedding
+            when a single rating changed.
+        max_iter: Maximum number of passes over the components.
+        tol: Stop once no weight moves by more than this.
+    """
+    if user_embedding is None:
+        user_embedding = np.zeros(len(rhs))
+    else:
+        user_embedding = user_embedding.copy()
+    for _ in range(max_iter):
+        max_step = 0.0
+        for j in range(len(rhs)):
+            if gram[j, j] == 0:
+                continue
+            new_weight = max(0.0, user_embedding[j]
+                             - (gram[j] @ user_embedding - rhs[j]) / gram[j, j])
+            max_step = max(max_step, abs(new_weight - user_embedding[j]))
+            user_embedding[j] = new_weight
+        if max_step <= tol:
+            break
+    return user_embedding
+
+
+def solve_user_embeddings(gram, rhs, user_embeddings=None, max_iter=100, tol=1e-6):
+    """Returns solve_user_embedding for many users at once, with each coordinate
+    descent step vectorized across users.
+
+    Args:
+        gram: H @ H.T, shape (n_components, n_components).
+        rhs: X @ H.T for the users' score rows X, shape (n_users, n_components).
+        user_embeddings: Optional starting points, shape (n_users, n_components).
+        max_iter: Maximum number of passes over the components.
+        tol: Stop once no weight moves by more than this.
+    """
+    if user_embeddings is None:
+        user_embeddings = np.zeros(rhs.shape)
+    else:
+        user_embeddings = np.array(user_embeddings, dtype=np.float64)
+    for _ in range(max_iter):
+        max_step = 0.0
+        for j in range(rhs.shape[1]):
+            if gram[j, j] == 0:
+                continue
+            new_weights = np.maximum(0.0, user_embeddings[:, j]
+                                     - (user_embeddings @ gram[j] - rhs[:, j]) / gram[j, j])
+            if len(new_weights):
+                max_step = max(max_step, np.abs(new_weights - user_embeddings[:, j]).max())
+            user_embeddings[:, j] = new_weights
+        if max_step <= tol:
+            break
+    return user_embeddings
+
+
+def create_fold_in_state(animelist_titles, animelist_scores, anime_idx,
+                         components, gram, anime_features):
+    """Returns dict with a user's folded-in collaborative and content state.
+
+    Anime that are not in the recommender system are ignored.
+
+    Args:
+        animelist_titles: List of anime titles on the user's animelist.
+        animelist_scores: List of the user's scores for those titles.
+        anime_idx: Dict mapping anime title to column index.
+        components: NMF components_, shape (n_components, n_anime).
+        gram: components @ components.T.
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+    """
+    num_anime = components.shape[1]
+    user_scores = np.zeros(num_anime)
+    on_animelist = np.zeros(num_anime, dtype=bool)
+    for anime_title, score in zip(animelist_titles, animelist_scores):
+        idx = anime_idx.get(anime_title)
+        if idx is not None:
+            user_scores[idx] = parse_score(score)
+            on_animelist[idx] = True
+    rhs = components @ user_scores
+    return {
+        'user_scores': user_scores,
+        'on_animelist': on_animelist,
+        'rhs': rhs,
+        'user_embedding': solve_user_embedding(gram, rhs),
+        'feature_sum': anime_features[on_animelist].sum(axis=0),
+        'num_on_animelist': int(on_animelist.sum())
+    }
+
+
+def update_fold_in_rating(state, anime_title, score, anime_idx,
+                          components, gram, anime_features):
+    """Updates a folded-in state in place after a single animelist change.
+
+    Only the changed column is touched and the embedding is re-solved starting
+    from the previous one, so this is much cheaper than folding in again.
+
+    Args:
+        state: Dict returned by create_fold_in_state.
+        anime_title: Title of the anime that changed.
+        score: New score ('-' for on the animelist but not scored), or None if
+            the anime was removed from the animelist.
+        anime_idx: Dict mapping anime title to column index.
+        components: NMF components_, shape (n_components, n_anime).
+        gram: components @ components.T.
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+    """
+    idx = anime_idx.get(anime_title)
+    if idx is None:
+        return state
+    new_score = 0 if score is None else parse_score(score)
+    state['rhs'] += (new_score - state['user_scores'][idx]) * components[:, idx]
+    state['user_scores'][idx] = new_score
+    if score is not None and not state['on_animelist'][idx]:
+        state['feature_sum'] = state['feature_sum'] + anime_features[idx]
+        state['num_on_animelist'] += 1
+    elif score is None and state['on_animelist'][idx]:
+        state['feature_sum'] = state['feature_sum'] - anime_features[idx]
+        state['num_on_animelist'] -= 1
+    state['on_animelist'][idx] = score is not None
+    state['user_embedding'] = solve_user_embedding(gram, state['rhs'], state['user_embedding'])
+    return state
+
+
+def get_content_vector(state):
+    """Returns the user's content-based user vector (mean of the feature vectors
+    of anime on their animelist, or zeros if there are none)."""
+    if state['num_on_animelist'] == 0:
+        return np.zeros_like(state['feature_sum'])
+    return state['feature_sum'] / state['num_on_animelist']
+
+
+def get_cosine_distances(vector, matrix):
+    """Returns cosine distances between vector and each row of matrix.
+
+    Zero vectors are treated as being at distance 1 from everything.
+    """
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    similarities = np.divide(matrix @ vector, norms, out=np.zeros(len(matrix)),
+                             where=norms > 0)
+    return 1 - similarities
+
+
+def get_fold_in_recs(state, components, anime_features, anime_titles, num_recs=10,
+                     ann_indexes=None, num_probe=16):
+    """Returns (collab_recs, content_recs) for a folded-in user, filtered the same
+    way as get_collab_filt_recs and get_content_filt_recs.
+
+    Args:
+        state: Dict returned by create_fold_in_state.
+        components: NMF components_, shape (n_components, n_anime).
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+        anime_titles: List of anime titles considered in recommender system.
+        num_recs: Number of recommendations per filter.
+        ann_indexes: Optional dict with 'collab' and 'content' IVF indexes (see
+            ann.py). If given, candidates come from the indexes instead of
+            ranking every anime.
+        num_probe: Number of IVF lists to search; higher is slower but more
+            accurate.
+    """
+    content_vector = get_content_vector(state)
+    if ann_indexes:
+        collab_candidates, _ = ann.query_ivf_index(
+            ann_indexes['collab'], state['user_embedding'], NUM_CANDIDATES, num_probe)
+        content_candidates, _ = ann.query_ivf_index(
+            ann_indexes['content'], content_vector, NUM_CANDIDATES, num_probe)
+    else:
+        collab_dists = get_cosine_distances(state['user_embedding'], components.T)
+        content_dists = get_cosine_distances(content_vector, anime_features)
+        collab_candidates = collab_dists.argsort()[:NUM_CANDIDATES]
+        content_candidates = content_dists.argsort()[:NUM_CANDIDATES]
+    # Collaborative filtering skips scored anime and content-based filtering skips
+    # everything on the animelist, like the precomputed recommendations
+    collab_recs = [anime_titles[idx] for idx in collab_candidates
+                   if state['user_scores'][idx] == 0][:num_recs]
+    content_recs = [anime_titles[idx] for idx in content_candidates
+                    if not state['on_animelist'][idx]][:num_recs]
+    return collab_recs, content_recs
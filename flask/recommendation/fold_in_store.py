@@ -0,0 +1,108 @@
+"""This module keeps the animelists of folded-in users in files, so that every
+serve.py worker sees the same users no matter which worker a PUT /animelist or
+POST /ratings went to, and so that they survive restarts.
+
+Each user is a JSON file in the store directory, named by a hash of the user
+ID, holding the user's animelist and a revision that goes up with every write.
+Files are written to a temporary file and renamed into place, so readers never
+see a partial one. A read-modify-write holds an exclusive flock on the user's
+lock file, so concurrent ratings of one user from different workers (or
+threads) aren't lost.
+
+Workers keep the fold-in states they built in memory and only build them again
+when the stored revision (or the artifact version) changed.
+
+Most requests are for precomputed users who were never folded in. has_user
+answers whether a user is stored from a listing of the store directory, so
+those requests don't open a file. The listing is checked against the
+directory's modification time at most every LISTING_MAX_AGE seconds, so a user
+first stored by another worker can take that long to be seen by this one.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Seconds a listing of the store directory is used before has_user checks
+# whether the directory changed
+LISTING_MAX_AGE = 1
+# Nanoseconds a directory must have been unchanged for its listing to be kept.
+# Some file systems only update modification times every few milliseconds, so
+# a listing of a directory that just changed could miss a second change that
+# leaves the same modification time.
+LISTING_SETTLE_NS = 1_000_000_000
+
+
+def create_store(store_dir):
+    """Returns store dict for the fold-in store in store_dir, creating the
+    directory if it doesn't exist."""
+    os.makedirs(store_dir, exist_ok=True)
+    # listing is (checked_at, directory mtime or None, set of file names)
+    return {'store_dir': store_dir, 'listing': (0, None, frozenset()),
+            'lock': threading.Lock()}
+
+
+def get_user_path(store, user_id):
+    """Returns path of a user's file. User IDs are hashed since they can hold
+    characters that aren't allowed in file names."""
+    user_hash = hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+    return os.path.join(store['store_dir'], f'{user_hash}.json')
+
+
+def has_user(store, user_id):
+    """Returns whether a user is in the store, as of a listing of the store
+    directory that is at most LISTING_MAX_AGE seconds old (users saved by this
+    process are seen at once)."""
+    checked_at, listed_mtime, file_names = store['listing']
+    now = time.monotonic()
+    if now - checked_at > LISTING_MAX_AGE:
+        with store['lock']:
+            checked_at, listed_mtime, file_names = store['listing']
+            if now - checked_at > LISTING_MAX_AGE:
+                mtime = os.stat(store['store_dir']).st_mtime_ns
+                if mtime != listed_mtime:
+                    file_names = frozenset(os.listdir(store['store_dir']))
+                    if time.time_ns() - mtime < LISTING_SETTLE_NS:
+                        # Listed again at the next check, whatever the mtime
+                        mtime = None
+                store['listing'] = (now, mtime, file_names)
+    return os.path.basename(get_user_path(store, user_id)) in file_names
+
+
+def load_user(store, user_id):
+    """Returns dict with the 'animelist' (title -> score) and 'revision' of a
+    stored user, or None if the user isn't in the store."""
+    try:
+        with open(get_user_path(store, user_id)) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {'animelist': stored['animelist'], 'revision': stored['revision']}
+
+
+def save_user(store, user_id, animelist, revision):
+    """Writes a user's animelist and revision. Call while holding lock_user."""
+    path = get_user_path(store, user_id)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'user_id': user_id, 'animelist': animelist, 'revision': revision}, f)
+    os.replace(tmp_path, path)
+    with store['lock']:
+        checked_at, listed_mtime, file_names = store['listing']
+        store['listing'] = (checked_at, listed_mtime, file_names | {os.path.basename(path)})
+
+
+@contextlib.contextmanager
+def lock_user(store, user_id):
+    """Context manager that holds an exclusive lock on a user's file across
+    processes and threads, for a load_user / save_user read-modify-write."""
+    with open(get_user_path(store, user_id) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
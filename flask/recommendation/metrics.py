@@ -0,0 +1,227 @@
+"""This module contains latency instrumentation for the recommendation path of
+the Flask app.
+
+Each stage of a request (user lookup, seen-set slicing, candidate filtering,
+fusion, fold-in, rendering) runs inside span(name), which adds its latency to a
+per-process histogram and to the current request's Server-Timing header. The
+app serves the histograms at /metrics (Prometheus text, or JSON with
+?format=json), modelled on the scraper metrics in src/telemetry.py.
+
+With serve.py every worker process keeps its own histograms. If SERVE_METRICS_DIR
+is set, each worker periodically writes a snapshot there and /metrics merges
+the snapshots of all workers, so it doesn't matter which worker answers.
+"""
+
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR_ENV = 'SERVE_METRICS_DIR'
+
+# Upper bounds (seconds) of the latency histogram buckets. Stages take from a
+# few microseconds to tens of milliseconds; the last bucket catches everything
+# slower.
+LATENCY_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+
+_started_at = time.time()
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+# Stage timings of the request being handled by this thread, for Server-Timing
+_request = threading.local()
+
+
+def observe(name, seconds):
+    """Adds a latency observation to the histogram called name."""
+    with _lock:
+        histogram = _histograms.setdefault(
+            name, {'buckets': [0]*(len(LATENCY_BUCKETS)+1), 'count': 0, 'sum': 0.0})
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+
+def increment(name, amount=1):
+    """Adds amount to the counter called name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def span(name):
+    """Context manager that records the time spent inside it in the histogram
+    'stage_seconds.{name}' and in the current request's stage timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe(f'stage_seconds.{name}', seconds)
+        spans = getattr(_request, 'spans', None)
+        if spans is not None:
+            spans.append((name, seconds))
+
+
+def start_request():
+    """Starts collecting stage timings for the request handled by this thread."""
+    _request.spans = []
+
+
+def finish_request(endpoint, status_code, seconds):
+    """Records a finished request and returns its stage timings as a
+    Server-Timing header value.
+
+    Args:
+        endpoint: Flask endpoint name, used to label the request histogram.
+        status_code: HTTP status code of the response.
+        seconds: Total time spent handling the request.
+    """
+    observe(f'request_seconds.{endpoint}', seconds)
+    increment(f'responses.{endpoint}.{status_code}')
+    spans = getattr(_request, 'spans', None) or []
+    _request.spans = None
+    return ', '.join([f'{name};dur={seconds*1000:.3f}' for name, seconds in spans]
+                     + [f'total;dur={seconds*1000:.3f}'])
+
+
+def get_metrics():
+    """Returns snapshot dict of this process's metrics."""
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'started_at': _started_at,
+            'latency_buckets': LATENCY_BUCKETS,
+            'histograms': json.loads(json.dumps(_histograms)),
+            'counters': dict(_counters)
+        }
+
+
+def export_metrics(metrics_dir):
+    """Writes this process's snapshot to metrics_dir/metrics-{pid}.json."""
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f'metrics-{os.getpid()}.json')
+    # Write to a temporary file first so readers never see a half-written
+    # snapshot. Each thread uses its own, since /metrics requests and the
+    # start_exporting thread export concurrently.
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as to_write:
+        json.dump(get_metrics(), to_write)
+    os.replace(tmp_path, path)
+
+
+def start_exporting(metrics_dir, interval=5):
+    """Starts a daemon thread that exports this process's snapshot every
+    interval seconds. Returns the thread."""
+    def export():
+        while True:
+            time.sleep(interval)
+            export_metrics(metrics_dir)
+
+    thread = threading.Thread(target=export, daemon=True)
+    thread.start()
+    return thread
+
+
+def load_metrics(metrics_dir):
+    """Returns list of the worker snapshots in metrics_dir."""
+    snapshots = []
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if file_name.startswith('metrics-') and file_name.endswith('.json'):
+            with open(os.path.join(metrics_dir, file_name)) as read_file:
+                snapshots.append(json.load(read_file))
+    return snapshots
+
+
+def merge_snapshots(snapshots):
+    """Returns (histograms, counters) summed over all worker snapshots."""
+    histograms = {}
+    counters = {}
+    for snapshot in snapshots:
+        for name, histogram in snapshot['histograms'].items():
+            merged = histograms.setdefault(
+                name, {'buckets': [0]*len(histogram['buckets']), 'count': 0, 'sum': 0.0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+            merged['count'] += histogram['count']
+            merged['sum'] += histogram['sum']
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return histograms, counters
+
+
+def get_all_metrics(metrics_dir=None):
+    """Returns (histograms, counters) of this process, or of every worker that
+    exported to metrics_dir (with this process's latest numbers)."""
+    if not metrics_dir:
+        snapshot = get_metrics()
+        return snapshot['histograms'], snapshot['counters']
+    export_metrics(metrics_dir)
+    return merge_snapshots(load_metrics(metrics_dir))
+
+
+def estimate_percentile(histogram, percentile):
+    """Returns the upper bound of the bucket containing the given percentile
+    (inf if it falls in the last bucket).
+
+    Args:
+        histogram: Histogram dict with 'buckets' and 'count'.
+        percentile: Percentile between 0 and 100.
+    """
+    target = histogram['count'] * percentile / 100
+    cumulative = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS + [float('inf')], histogram['buckets']):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return bound
+    return float('inf')
+
+
+def format_prometheus(histograms, counters):
+    """Returns histograms and counters in the Prometheus text exposition format.
+
+    Names like 'stage_seconds.fusion' become anime_rec_stage_seconds{stage="fusion"}
+    and counters like 'batches.items' become anime_rec_batches_total{name="items"}.
+    """
+    lines = []
+    label_names = {'stage_seconds': 'stage', 'request_seconds': 'endpoint'}
+    for name, histogram in sorted(histograms.items()):
+        family, _, label = name.partition('.')
+        labels = f'{label_names.get(family, "name")}="{label}"'
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ['+Inf'], histogram['buckets']):
+            cumulative += bucket_count
+            lines.append(f'anime_rec_{family}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'anime_rec_{family}_sum{{{labels}}} {histogram["sum"]}')
+        lines.append(f'anime_rec_{family}_count{{{labels}}} {histogram["count"]}')
+    for name, value in sorted(counters.items()):
+        family, rest = name.split('.', 1)
+        if family == 'responses':
+            endpoint, status_code = rest.rsplit('.', 1)
+            labels = f'endpoint="{endpoint}",status="{status_code}"'
+        else:
+            # e.g. 'batches.items' from recommendation/batcher.py
+            labels = f'name="{rest}"'
+        lines.append(f'anime_rec_{family}_total{{{labels}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_profile():
+    """Returns a cProfile.Profile that is already profiling."""
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def get_profile_summary(profile, num_lines=40):
+    """Stops profile and returns its top num_lines functions by cumulative time
+    as text."""
+    profile.disable()
+    summary = io.StringIO()
+    pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(num_lines)
+    return summary.getvalue()
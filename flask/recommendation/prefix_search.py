@@ -0,0 +1,75 @@
+"""This module answers prefix searches over the sorted key arrays built by
+src/prefix_index.py, for autocompleting user IDs and anime titles.
+
+A search is two binary searches for the range of keys that start with the
+prefix, so it takes microseconds even with hundreds of thousands of keys and
+works directly on memory-mapped arrays.
+"""
+
+import numpy as np
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+def parse_limit(value):
+    """Returns the limit of a search from a query string value: DEFAULT_LIMIT if
+    it's missing, otherwise clamped to [0, MAX_LIMIT]. Raises ValueError if it
+    isn't an integer."""
+    if value is None or value == '':
+        return DEFAULT_LIMIT
+    return min(max(int(value), 0), MAX_LIMIT)
+
+
+def normalize_prefix(text):
+    """Returns the UTF-8 key prefix of a query, normalized like
+    src/prefix_index.normalize_key."""
+    return text.lstrip().casefold().encode('utf-8')
+
+
+def get_prefix_range(keys, prefix):
+    """Returns (start, stop) of the keys that start with prefix.
+
+    Args:
+        keys: Sorted fixed-width bytes array.
+        prefix: Normalized prefix from normalize_prefix.
+    """
+    # NumPy would copy keys to a wider dtype to compare a longer prefix, and no
+    # key can start with it anyway
+    if len(prefix) > keys.itemsize:
+        return 0, 0
+    start = int(np.searchsorted(keys, prefix, 'left'))
+    if len(prefix) == keys.itemsize:
+        # Only the key equal to prefix can start with it
+        return start, int(np.searchsorted(keys, prefix, 'right'))
+    # b'\xff' never occurs in UTF-8, so this sorts after every key with the prefix
+    return start, int(np.searchsorted(keys, prefix + b'\xff', 'left'))
+
+
+def search(keys, rows, prefix, limit=DEFAULT_LIMIT, by_row=False):
+    """Returns up to limit distinct rows whose key starts with prefix.
+
+    Args:
+        keys: Sorted keys from src/prefix_index.build_prefix_index.
+        rows: Row of each key.
+        prefix: Query text (not normalized yet).
+        limit: Maximum number of rows.
+        by_row: Whether to return the lowest rows first (e.g. anime in order of
+            popularity) instead of the rows of the alphabetically first keys.
+    """
+    prefix = normalize_prefix(prefix)
+    if not prefix or limit <= 0:
+        return []
+    start, stop = get_prefix_range(keys, prefix)
+    if by_row:
+        return np.unique(rows[start:stop])[:limit].tolist()
+    # A short prefix can match a large share of the keys, so stop at limit
+    # instead of deduplicating the whole range
+    found = []
+    for row in rows[start:stop]:
+        row = int(row)
+        if row not in found:
+            found.append(row)
+            if len(found) == limit:
+                break
+    return found
@@ -0,0 +1,311 @@
+"""This module contains the serving runtime for the Flask app.
+
+It loads the artifact bundle written by src/artifacts.py and does lookup,
+exclusion, top-k and fusion with NumPy and plain Python only, so serving doesn't
+import pandas. Recommendations match recommender.recommend exactly, including
+how it breaks ties. Pandas is imported lazily by get_recs_df for debug output.
+"""
+
+import collections
+
+import numpy as np
+
+from recommendation import ann, artifacts, metrics
+
+# recommender.recommend fuses the top 10 recommendations of each filter no
+# matter how many recommendations are asked for
+NUM_FILTER_RECS = 10
+BOTH = 'both content/collab'
+REQUIRED_ARRAYS = ['collab_candidates', 'content_candidates', 'scored_indptr',
+                   'scored_indices', 'history_indptr', 'history_indices',
+                   'components', 'anime_features']
+
+
+def create_runtime(arrays, ids, manifest):
+    """Returns runtime dict used by the functions in this module.
+
+    Args:
+        arrays: Dict of named arrays from artifacts.load_bundle.
+        ids: Dict of user IDs, anime titles and URLs from artifacts.load_bundle.
+        manifest: Bundle manifest from artifacts.load_bundle.
+    """
+    runtime = dict(ids)
+    runtime['arrays'] = arrays
+    runtime['manifest'] = manifest
+    runtime['user_idx'] = {user_id: idx for idx, user_id in enumerate(ids['user_ids'])}
+    runtime['anime_idx'] = {title: idx for idx, title in enumerate(ids['anime_titles'])}
+    runtime['gram'] = arrays['components'] @ arrays['components'].T
+    runtime['ann_indexes'] = None
+    if 'collab_ivf_centroids' in arrays:
+        runtime['ann_indexes'] = {
+            kind: {key: arrays[f'{kind}_ivf_{key}']
+                   for key in ['centroids', 'list_offsets', 'list_ids', 'list_vectors']}
+            for kind in ['collab', 'content']
+        }
+    runtime['neighbour_table'] = {
+        kind: (arrays[f'{kind}_neighbour_idxs'], arrays[f'{kind}_neighbour_dists'])
+        for kind in ['collab', 'content'] if f'{kind}_neighbour_idxs' in arrays
+    }
+    # Unit-length anime vectors for the similarities in rerank_diverse
+    runtime['unit_vectors'] = {'collab': ann.normalize_rows(arrays['components'].T),
+                               'content': ann.normalize_rows(arrays['anime_features'])}
+    # Sorted keys and rows for autocomplete (see src/prefix_index.py)
+    runtime['prefix_indexes'] = {
+        kind: (arrays[f'{prefix}_prefix_keys'], arrays[f'{prefix}_prefix_rows'])
+        for kind, prefix in [('users', 'user'), ('anime', 'title')]
+        if f'{prefix}_prefix_keys' in arrays
+    }
+    return runtime
+
+
+def load_runtime(bundle_dir, mmap_mode=None):
+    """Returns runtime dict for the bundle in bundle_dir."""
+    return create_runtime(*artifacts.load_bundle(bundle_dir, mmap_mode))
+
+
+def validate_runtime(runtime):
+    """Raises ValueError if the runtime's arrays are missing or don't agree with
+    each other or with its IDs, e.g. for a bundle from a mismatched build."""
+    arrays = runtime['arrays']
+    format_version = runtime['manifest'].get('format_version')
+    if format_version != artifacts.FORMAT_VERSION:
+        raise ValueError(f'unsupported bundle format {format_version}')
+    missing = [name for name in REQUIRED_ARRAYS if name not in arrays]
+    if missing:
+        raise ValueError(f'bundle is missing arrays {missing}')
+    num_users, num_anime = len(runtime['user_ids']), len(runtime['anime_titles'])
+    expected_lens = {'collab_candidates': num_users, 'content_candidates': num_users,
+                     'scored_indptr': num_users + 1, 'history_indptr': num_users + 1,
+                     'anime_features': num_anime}
+    for name, expected_len in expected_lens.items():
+        if len(arrays[name]) != expected_len:
+            raise ValueError(f'{name} has {len(arrays[name])} rows, expected {expected_len}')
+    if arrays['components'].shape[1] != num_anime:
+        raise ValueError(f"components has {arrays['components'].shape[1]} anime, "
+                         f'expected {num_anime}')
+    for name in ['collab_candidates', 'content_candidates']:
+        if arrays[name].size and not 0 <= arrays[name].min() <= arrays[name].max() < num_anime:
+            raise ValueError(f'{name} has anime indices out of range')
+    if len(runtime['anime_urls']) != num_anime or len(runtime['image_urls']) != num_anime:
+        raise ValueError('anime URLs do not match anime titles')
+    for kind, num_rows in [('users', num_users), ('anime', num_anime)]:
+        if kind not in runtime['prefix_indexes']:
+            continue
+        keys, rows = runtime['prefix_indexes'][kind]
+        if len(keys) != len(rows):
+            raise ValueError(f'{kind} prefix index has {len(keys)} keys but {len(rows)} rows')
+        if rows.size and not 0 <= rows.min() <= rows.max() < num_rows:
+            raise ValueError(f'{kind} prefix index has rows out of range')
+
+
+def get_row_indices(indptr, indices, row):
+    """Returns the column indices stored for row of a CSR (indptr, indices) pair."""
+    return indices[indptr[row]:indptr[row+1]]
+
+
+def filter_candidates(candidates, exclude, num_recs=NUM_FILTER_RECS):
+    """Returns the first num_recs candidates that are not in exclude.
+
+    Args:
+        candidates: Anime indices, best first.
+        exclude: Anime indices to skip (e.g. anime already on the animelist).
+        num_recs: Number of recommendations.
+    """
+    return candidates[~np.isin(candidates, exclude)][:num_recs]
+
+
+def get_filter_recs(runtime, user_row):
+    """Returns (collab_recs, content_recs) as lists of anime titles for a
+    precomputed user, filtered like get_collab_filt_recs and
+    get_content_filt_recs.
+
+    Args:
+        runtime: Dict returned by load_runtime.
+        user_row: Row of the user in the bundle arrays.
+    """
+    arrays = runtime['arrays']
+    anime_titles = runtime['anime_titles']
+    # Collaborative filtering skips scored anime and content-based filtering skips
+    # everything on the animelist
+    with metrics.span('seen'):
+        scored = get_row_indices(arrays['scored_indptr'], arrays['scored_indices'], user_row)
+        history = get_row_indices(arrays['history_indptr'], arrays['history_indices'], user_row)
+    with metrics.span('collab_filter'):
+        collab_recs = [anime_titles[idx] for idx in
+                       filter_candidates(arrays['collab_candidates'][user_row], scored)]
+    with metrics.span('content_filter'):
+        content_recs = [anime_titles[idx] for idx in
+                        filter_candidates(arrays['content_candidates'][user_row], history)]
+    return collab_recs, content_recs
+
+
+def filter_candidates_batch(candidates, indptr, indices, user_rows, num_anime,
+                            num_recs=NUM_FILTER_RECS):
+    """Returns list of each user's first num_recs candidates that are not in
+    their CSR row, like filter_candidates for every user at once.
+
+    Args:
+        candidates: Candidate anime indices of the users, one row per user.
+        indptr: indptr of the CSR (indptr, indices) pair to exclude.
+        indices: indices of the CSR pair.
+        user_rows: Row of each user in the CSR pair.
+        num_anime: Number of anime.
+    """
+    starts = indptr[user_rows]
+    counts = indptr[user_rows + 1] - starts
+    # Positions in indices of every excluded entry, without a loop over users
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+    # A users x anime mask of the batch is small, and a scatter plus a gather is
+    # cheaper than np.isin
+    batch_rows = np.arange(len(user_rows))
+    excluded = np.zeros((len(user_rows), num_anime), dtype=bool)
+    excluded[np.repeat(batch_rows, counts), indices[positions]] = True
+    keep = ~excluded[batch_rows[:, None], candidates]
+    keep &= np.cumsum(keep, axis=1) <= num_recs
+    return [user_candidates[user_keep] for user_candidates, user_keep in zip(candidates, keep)]
+
+
+def get_filter_recs_batch(runtime, user_rows):
+    """Returns list of (collab_recs, content_recs) like get_filter_recs for a
+    batch of precomputed users, with one NumPy operation per step for the whole
+    batch (see recommendation/batcher.py).
+
+    Args:
+        runtime: Dict returned by load_runtime.
+        user_rows: Rows of the users in the bundle arrays.
+    """
+    arrays = runtime['arrays']
+    anime_titles = runtime['anime_titles']
+    user_rows = np.asarray(user_rows, dtype=np.int64)
+    num_anime = len(anime_titles)
+    with metrics.span('collab_filter'):
+        collab_idxs = filter_candidates_batch(
+            arrays['collab_candidates'][user_rows], arrays['scored_indptr'],
+            arrays['scored_indices'], user_rows, num_anime)
+    with metrics.span('content_filter'):
+        content_idxs = filter_candidates_batch(
+            arrays['content_candidates'][user_rows], arrays['history_indptr'],
+            arrays['history_indices'], user_rows, num_anime)
+    return [([anime_titles[idx] for idx in collab], [anime_titles[idx] for idx in content])
+            for collab, content in zip(collab_idxs, content_idxs)]
+
+
+def fuse_recs(collab_recs, content_recs, collab_weight=1, num_recs=10):
+    """Returns (recs, rec_rows) combining collaborative and content-based
+    filtering recommendations with the scoring logic of recommender.fuse_recs.
+
+    Args:
+        collab_recs: Collaborative filtering recommendations, best first.
+        content_recs: Content-based filtering recommendations, best first.
+        collab_weight: Weight applied to collaborative filtering scores.
+        num_recs: Number of recommendations.
+    Returns:
+        recs: Recommendations as a list of anime, top recommendations first.
+        rec_rows: List of (anime_rec, rec_type, original_rank, base_score,
+            weighted_score) tuples in recommendation order.
+    """
+    with metrics.span('fusion'):
+        return _fuse_recs(collab_recs, content_recs, collab_weight, num_recs)
+
+
+def _fuse_recs(collab_recs, content_recs, collab_weight, num_recs):
+    pairs = list(zip(collab_recs, content_recs))
+    counts = collections.Counter(anime for pair in pairs for anime in pair)
+    # Anime recommended by both filters become 'both content/collab' and are only
+    # merged into a single row if they have the same rank in both, like the
+    # groupby in combine_double_recs
+    scores = {}
+    for idx, (collab_rec, content_rec) in enumerate(pairs):
+        for anime, rec_type, weight in [(collab_rec, 'collab', collab_weight),
+                                        (content_rec, 'content', 1)]:
+            key = (anime, BOTH if counts[anime] > 1 else rec_type, idx+1)
+            base_score, weighted_score = scores.get(key, (0, 0))
+            scores[key] = (base_score + 10-idx, weighted_score + (10-idx)*weight)
+    # Sort by weighted_score, then rec_type (so collab goes before content), then
+    # the groupby key order that a stable pandas sort leaves ties in
+    rec_rows = sorted((key + value for key, value in scores.items()),
+                      key=lambda row: (-row[4], row[1], row[0], row[2]))
+    return [row[0] for row in rec_rows[:num_recs]], rec_rows
+
+
+def rerank_diverse(runtime, rec_rows, diversity, num_recs=10):
+    """Returns recommendations re-ranked by maximal marginal relevance, so that
+    e.g. several sequels of one franchise don't fill the list.
+
+    Each pick maximizes (1 - diversity) * relevance - diversity * (highest
+    similarity to an anime already picked). Relevance is weighted_score scaled
+    to at most 1, and similarity is the mean cosine similarity of the anime's
+    collaborative (NMF) and content vectors.
+
+    Args:
+        runtime: Dict returned by load_runtime.
+        rec_rows: rec_rows from fuse_recs, best first.
+        diversity: Weight between 0 (same order as fuse_recs) and 1.
+        num_recs: Number of recommendations.
+    """
+    with metrics.span('diversity'):
+        return _rerank_diverse(runtime, rec_rows, diversity, num_recs)
+
+
+def _rerank_diverse(runtime, rec_rows, diversity, num_recs):
+    # An anime can have several rows; its first one is its best
+    scores = {}
+    for row in rec_rows:
+        scores.setdefault(row[0], row[4])
+    titles = list(scores)
+    if diversity <= 0 or len(titles) <= 1:
+        return titles[:num_recs]
+    relevance = np.array(list(scores.values()), dtype=float)
+    relevance /= max(relevance.max(), 1e-12)
+    idxs = [runtime['anime_idx'][title] for title in titles]
+    # Similarities between all candidates at once, so the greedy loop only does
+    # array operations
+    similarity = sum(vectors[idxs] @ vectors[idxs].T
+                     for vectors in runtime['unit_vectors'].values()) / len(runtime['unit_vectors'])
+    # Anime vectors are non-negative, so similarities are at least 0
+    max_similarity = np.zeros(len(titles))
+    weighted_relevance = (1-diversity) * relevance
+    picks = []
+    for _ in range(min(num_recs, len(titles))):
+        # argmax keeps the fused order between ties
+        pick = int((weighted_relevance - diversity*max_similarity).argmax())
+        picks.append(pick)
+        weighted_relevance[pick] = -np.inf
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+    return [titles[pick] for pick in picks]
+
+
+def recommend(runtime, user_id, collab_weight=1, num_recs=10):
+    """Returns recommendations for a precomputed user, or None if the user is
+    not in the bundle.
+
+    Args:
+        runtime: Dict returned by load_runtime.
+        user_id: MyAnimeList user ID.
+        collab_weight: Weight applied to collaborative filtering scores.
+        num_recs: Number of recommendations.
+    """
+    user_row = runtime['user_idx'].get(user_id)
+    if user_row is None:
+        return None
+    collab_recs, content_recs = get_filter_recs(runtime, user_row)
+    recs, _ = fuse_recs(collab_recs, content_recs, collab_weight, num_recs)
+    return recs
+
+
+def get_anime_links(runtime, anime_title):
+    """Returns (url, image_url) of an anime title."""
+    idx = runtime['anime_idx'][anime_title]
+    return runtime['anime_urls'][idx], runtime['image_urls'][idx]
+
+
+def get_recs_df(user_id, rec_rows):
+    """Returns rec_rows from fuse_recs as a DataFrame shaped like recs_df from
+    recommender.recommend. Only used for debugging, so pandas is imported here.
+    """
+    import pandas as pd
+    recs_df = pd.DataFrame(rec_rows, columns=['anime_rec', 'rec_type', 'original_rank',
+                                              'base_score', 'weighted_score'])
+    recs_df.insert(0, 'user_id', user_id)
+    return recs_df
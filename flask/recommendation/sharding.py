@@ -0,0 +1,20 @@
+"""This module maps users to the shards that serve them (see src/sharding.py,
+which splits the artifacts the same way)."""
+
+import os
+import zlib
+
+# Header in which the router sends the closest user IDs of every shard to the
+# shard that answers for an unknown user ID
+SUGGESTED_USER_IDS_HEADER = 'X-Suggested-User-Ids'
+
+
+def get_shard(user_id, num_shards):
+    """Returns the shard of a user ID. Uses CRC-32 rather than hash(), which
+    changes between Python processes."""
+    return zlib.crc32(str(user_id).encode('utf-8')) % num_shards
+
+
+def get_shard_root(artifact_root, shard):
+    """Returns the artifact root of a shard."""
+    return os.path.join(artifact_root, f'shard-{shard}')
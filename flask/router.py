@@ -0,0 +1,302 @@
+"""Router for user-sharded serving: forwards each request to the serve.py
+process of the shard that owns its user.
+
+Usage (from the flask directory):
+    # Shards already running, e.g. on other machines, in shard order
+    python router.py --port 8000 --shards http://10.0.0.1:8000,http://10.0.0.2:8000
+    # Start a local serve.py for every shard under an artifact root
+    python router.py --port 8000 --local ../artifacts --shard-workers 2
+
+With NUM_SHARDS > 1, anime_recommender.py publishes the artifacts of shard n
+under ../artifacts/shard-n (see src/sharding.py), so each shard only holds the
+per-user arrays of its own users. Requests for a user (/recommendation/<user_id>/...,
+/api/recommendation/<user_id> and /api/users/<user_id>/...) go to shard
+get_shard(user_id). Everything else (the form, static files, similar anime)
+is the same on every shard and goes round robin; a submitted form redirects to
+/recommendation/<user_id>/..., which then reaches the right shard.
+
+The router keeps one keep-alive connection per shard and thread, adds an
+X-Shard header to each response, and serves the status of every shard at
+/api/shards. User ID suggestions (/api/suggest/users) are merged from every
+shard, since each shard only knows its own users. For the same reason, when the
+page of an unknown user ID comes back 404, the router asks every shard for its
+closest user IDs and has the owning shard render the page with those.
+"""
+
+import argparse
+import glob
+import http.client
+import itertools
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+from recommendation import prefix_search, sharding
+
+METHODS = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
+# Paths whose first group is the user ID that decides the shard
+USER_PATHS = [re.compile(r'^/recommendation/([^/]+)/'),
+              re.compile(r'^/api/recommendation/([^/]+)$'),
+              re.compile(r'^/api/users/([^/]+)/')]
+# Headers that only apply to a single connection and aren't forwarded
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailers', 'transfer-encoding', 'upgrade', 'host',
+                      'content-length'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Router for user-sharded serving.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    shards = parser.add_mutually_exclusive_group(required=True)
+    shards.add_argument('--shards', help='Comma-separated shard URLs, in shard order')
+    shards.add_argument('--local', metavar='ARTIFACT_ROOT',
+                        help='Start a local serve.py for each shard-<n> under ARTIFACT_ROOT')
+    parser.add_argument('--shard-workers', type=int, default=1,
+                        help='Workers of each local serve.py')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='Seconds to wait for a shard to respond')
+    return parser.parse_args()
+
+
+def get_user_id(path):
+    """Returns the user ID in a request path, or None if the path isn't about a
+    user."""
+    for pattern in USER_PATHS:
+        match = pattern.match(path)
+        if match:
+            return match.group(1)
+    return None
+
+
+def send_to_shard(connections, shard_url, method, path, body=None, headers=None, timeout=30):
+    """Sends a request to a shard and returns (status, headers, body).
+
+    connections is a dict of this thread's keep-alive connections by shard URL.
+    A request on a reused connection that the shard has closed meanwhile is
+    retried once on a new connection.
+    """
+    for attempt in range(2):
+        reused = shard_url in connections
+        if not reused:
+            url = urllib.parse.urlsplit(shard_url)
+            connections[shard_url] = http.client.HTTPConnection(url.hostname, url.port,
+                                                                timeout=timeout)
+        conn = connections[shard_url]
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            response_body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            del connections[shard_url]
+            if not reused or attempt:
+                raise
+            continue
+        if response.will_close:
+            conn.close()
+            del connections[shard_url]
+        return response.status, response.getheaders(), response_body
+
+
+def get_closest_user_ids(connections, shard_urls, user_id, limit=5, timeout=30):
+    """Returns the known user IDs of every shard that share the longest
+    possible prefix with an unknown user ID, like suggest_user_ids in app.py
+    does for a single shard. Shards that don't answer are left out."""
+    target = '/api/suggest/users?' + urllib.parse.urlencode({'q': user_id, 'limit': limit,
+                                                             'closest': 1})
+    best_prefix_len, suggestions = 0, []
+    for shard_url in shard_urls:
+        try:
+            status, _, body = send_to_shard(connections, shard_url, 'GET', target,
+                                            timeout=timeout)
+        except (OSError, http.client.HTTPException):
+            continue
+        if status != 200:
+            continue
+        found = json.loads(body)
+        if found['prefix_len'] > best_prefix_len:
+            best_prefix_len, suggestions = found['prefix_len'], []
+        if found['prefix_len'] == best_prefix_len:
+            suggestions.extend(found['suggestions'])
+    suggestions.sort(key=prefix_search.normalize_prefix)
+    return suggestions[:limit]
+
+
+def create_router(shard_urls, timeout=30):
+    """Returns Flask app that forwards requests to shard_urls (shard n at index
+    n)."""
+    router = Flask(__name__)
+    local = threading.local()
+    round_robin = itertools.count()
+
+    def get_connections():
+        if not hasattr(local, 'connections'):
+            local.connections = {}
+        return local.connections
+
+    @router.route('/api/shards', methods=['GET'])
+    def shard_status():
+        statuses = []
+        for shard, shard_url in enumerate(shard_urls):
+            try:
+                status, _, body = send_to_shard(get_connections(), shard_url, 'GET',
+                                                '/api/version', timeout=timeout)
+                statuses.append({'shard': shard, 'url': shard_url, 'status': status,
+                                 'version': json.loads(body) if status == 200 else None})
+            except (OSError, http.client.HTTPException) as e:
+                statuses.append({'shard': shard, 'url': shard_url, 'error': repr(e)})
+        return jsonify(shards=statuses)
+
+    @router.route('/api/suggest/users', methods=['GET'])
+    def suggest_users():
+        # Each shard only has the user IDs of its own users, so ask every shard
+        # and merge their suggestions in key order
+        try:
+            limit = prefix_search.parse_limit(request.args.get('limit'))
+        except ValueError:
+            return jsonify(error=f"limit must be an integer, not {request.args['limit']!r}"), 400
+        target = '/api/suggest/users?' + request.query_string.decode('latin-1')
+        suggestions = []
+        for shard, shard_url in enumerate(shard_urls):
+            try:
+                status, _, body = send_to_shard(get_connections(), shard_url, 'GET', target,
+                                                timeout=timeout)
+            except (OSError, http.client.HTTPException) as e:
+                return Response(f'Shard {shard} unavailable: {e!r}\n', status=502,
+                                mimetype='text/plain')
+            if status != 200:
+                return Response(body, status=status)
+            suggestions.extend(json.loads(body)['suggestions'])
+        suggestions.sort(key=prefix_search.normalize_prefix)
+        return jsonify(q=request.args.get('q', ''), suggestions=suggestions[:limit])
+
+    @router.route('/', defaults={'path': ''}, methods=METHODS)
+    @router.route('/<path:path>', methods=METHODS)
+    def forward(path):
+        user_id = get_user_id(request.path)
+        if user_id is None:
+            shard = next(round_robin) % len(shard_urls)
+        else:
+            shard = sharding.get_shard(user_id, len(shard_urls))
+        target = urllib.parse.quote(request.path)
+        if request.query_string:
+            target += '?' + request.query_string.decode('latin-1')
+        headers = {name: value for name, value in request.headers.items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            status, response_headers, body = send_to_shard(
+                get_connections(), shard_urls[shard], request.method, target,
+                request.get_data(), headers, timeout)
+            if status == 404 and request.method == 'GET' and len(shard_urls) > 1 \
+                    and USER_PATHS[0].match(request.path):
+                # The shard could only suggest its own users in place of an
+                # unknown user ID, so it renders the page again with the
+                # closest users of every shard
+                headers[sharding.SUGGESTED_USER_IDS_HEADER] = json.dumps(
+                    get_closest_user_ids(get_connections(), shard_urls, user_id,
+                                         timeout=timeout))
+                status, response_headers, body = send_to_shard(
+                    get_connections(), shard_urls[shard], request.method, target,
+                    request.get_data(), headers, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            return Response(f'Shard {shard} unavailable: {e!r}\n', status=502,
+                            mimetype='text/plain', headers={'X-Shard': str(shard)})
+        response = Response(body, status=status,
+                            headers=[(name, value) for name, value in response_headers
+                                     if name.lower() not in HOP_BY_HOP_HEADERS])
+        response.headers['X-Shard'] = str(shard)
+        return response
+
+    return router
+
+
+def wait_for_shard(shard_url, process=None, timeout=300):
+    """Waits until a shard answers /api/version and returns its status dict."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'shard at {shard_url} exited with status {process.returncode}')
+        try:
+            status, _, body = send_to_shard({}, shard_url, 'GET', '/api/version', timeout=5)
+            if status == 200:
+                return json.loads(body)
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'shard at {shard_url} did not start within {timeout} s')
+
+
+def check_shards(shard_statuses):
+    """Raises RuntimeError if a shard serves the artifacts of another shard,
+    e.g. because the shard URLs are in the wrong order."""
+    num_shards = len(shard_statuses)
+    for shard, status in enumerate(shard_statuses):
+        shard_info = status.get('shard')
+        if shard_info is None:
+            if num_shards > 1:
+                raise RuntimeError(f'shard {shard} serves unsharded artifacts')
+        elif shard_info != {'index': shard, 'num_shards': num_shards}:
+            raise RuntimeError(f'shard {shard} serves artifacts of shard '
+                               f"{shard_info['index']} of {shard_info['num_shards']}")
+
+
+def start_local_shards(artifact_root, port, workers):
+    """Starts a serve.py for every shard-<n> under artifact_root on the ports
+    after port. Returns (shard_urls, processes)."""
+    num_shards = len(glob.glob(sharding.get_shard_root(artifact_root, '*')))
+    if num_shards == 0:
+        raise RuntimeError(f'no shard-<n> directories in {artifact_root}')
+    shard_urls, processes = [], []
+    for shard in range(num_shards):
+        env = dict(os.environ, ARTIFACT_ROOT=sharding.get_shard_root(artifact_root, shard))
+        # serve.py clears its metrics directory, so shards can't share one
+        if os.environ.get('SERVE_METRICS_DIR'):
+            env['SERVE_METRICS_DIR'] = os.path.join(os.environ['SERVE_METRICS_DIR'],
+                                                    f'shard-{shard}')
+        shard_port = port + 1 + shard
+        processes.append(subprocess.Popen(
+            [sys.executable, 'serve.py', '--port', str(shard_port), '--workers', str(workers)],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__))))
+        shard_urls.append(f'http://127.0.0.1:{shard_port}')
+    return shard_urls, processes
+
+
+def main():
+    args = parse_args()
+    processes = []
+    # Stop the local shards on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.local:
+            shard_urls, processes = start_local_shards(args.local, args.port,
+                                                       args.shard_workers)
+        else:
+            shard_urls = args.shards.split(',')
+        check_shards([wait_for_shard(shard_url, process) for shard_url, process
+                      in itertools.zip_longest(shard_urls, processes)])
+        server = make_server(args.host, args.port, create_router(shard_urls, args.timeout),
+                             threaded=True)
+        print(f'Routing {args.host}:{args.port} to {len(shard_urls)} shards: '
+              f'{", ".join(shard_urls)}')
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Production entry point for the Flask app: a prefork server with one shared
+copy of the artifacts.
+
+Usage (from the flask directory):
+    python serve.py --workers 4 --port 8000
+    python serve.py --workers 4 --port 8000 --batch-window-ms 2
+
+The parent process memory-maps the active artifact bundle read-only, imports
+the app and opens the listening socket, then forks the workers. The workers
+inherit the mappings, so the arrays live once in the page cache no matter how
+many workers there are, and the kernel spreads connections on the shared socket
+across them. Each worker polls for new artifact versions itself (polling
+threads don't survive fork); a new version is memory-mapped from the same files
+by every worker, so it is shared too. Dead workers are replaced, and SIGTERM or
+SIGINT stops the workers after their current request.
+
+With --batch-window-ms, each worker handles requests in threads and filters the
+candidates of requests that arrive within the window in one batch (see
+recommendation/batcher.py), trading a little latency for throughput.
+
+Workers export their latency metrics to SERVE_METRICS_DIR (a temporary
+directory unless set) so that /metrics on any worker covers all of them.
+Folded-in users are kept in a fold-in store on disk that every worker reads
+(see recommendation/fold_in_store.py), so any worker can answer for them.
+
+app.py still runs on its own with app.run for development.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import traceback
+
+from werkzeug.serving import make_server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prefork server for the anime recommender.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes (default: number of cores)')
+    parser.add_argument('--threaded', action='store_true',
+                        help='Handle each request in a thread within a worker')
+    parser.add_argument('--batch-window-ms', type=float, default=0,
+                        help='Batch the lookups of requests arriving within this many '
+                             'milliseconds (0 = no batching; implies --threaded)')
+    parser.add_argument('--batch-max-size', type=int, default=32,
+                        help='Most users in one batched lookup')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--poll-interval', type=float, default=10,
+                        help='Seconds between checks for a new artifact version')
+    return parser.parse_args()
+
+
+def create_listen_socket(host, port, backlog):
+    """Returns a bound, listening socket that forked workers can share."""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(flask_app, listen_fd, args):
+    """Serves requests on the shared socket until SIGTERM."""
+    from recommendation import artifact_manager as am, metrics
+    # Ctrl-C reaches the whole process group; the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    am.start_polling(flask_app.manager, args.poll_interval)
+    metrics.start_exporting(flask_app.METRICS_DIR)
+    server = make_server(args.host, args.port, flask_app.app, threaded=args.threaded,
+                         fd=listen_fd)
+    # shutdown waits for serve_forever to return, so it can't run in the handler
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+
+
+def spawn_worker(flask_app, listen_fd, args):
+    """Forks a worker process and returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(flask_app, listen_fd, args)
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+    return pid
+
+
+def main():
+    args = parse_args()
+    os.environ['ARTIFACT_MMAP'] = '1'
+    os.environ['ARTIFACT_POLL_SECONDS'] = '0'
+    os.environ['BATCH_WINDOW_MS'] = str(args.batch_window_ms)
+    os.environ['BATCH_MAX_SIZE'] = str(args.batch_max_size)
+    # A worker without threads never has two requests to batch
+    args.threaded = args.threaded or args.batch_window_ms > 0
+    if not os.environ.get('SERVE_METRICS_DIR'):
+        os.environ['SERVE_METRICS_DIR'] = tempfile.mkdtemp(prefix='serve-metrics-')
+    metrics_dir = os.environ['SERVE_METRICS_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Snapshots of a previous run's workers would be merged into /metrics
+    for file_name in os.listdir(metrics_dir):
+        if file_name.startswith('metrics-'):
+            os.remove(os.path.join(metrics_dir, file_name))
+    # Loads the active artifact version before forking so workers share it
+    import app as flask_app
+
+    sock = create_listen_socket(args.host, args.port, args.backlog)
+    # Objects made before the fork (e.g. the user ID dict) stay shared as long as
+    # the garbage collector doesn't write to them
+    gc.freeze()
+    workers = {spawn_worker(flask_app, sock.fileno(), args) for _ in range(args.workers)}
+    print(f'Serving on {args.host}:{args.port} with {args.workers} workers '
+          f"(artifact version {flask_app.manager['active']['version']})")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print(f'Worker {pid} exited with status {status}, starting a new one')
+            workers.add(spawn_worker(flask_app, sock.fileno(), args))
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,9 @@ def fix_mismatching_animelist_len(complete_animelist):
     the scraper wasn't able to pick up the scores, hence causing a mismatch in
     lengths between animelist_titles and animelist_scores.
 
+    Animelists scraped with parse.parse_animelist_rows always have matching
+    lengths, so this only changes animelists scraped before it was added.
+
     Args:
         complete_animelist: List of dicts of user animelists scraped from MyAnimeList.net.
     """
@@ -0,0 +1,57 @@
+"""This module precomputes the top-k most similar anime for every anime, so that
+"more like this" lookups are a single row read at serving time.
+
+Similarity is cosine similarity between item vectors: the NMF components_
+columns for collaborative filtering and the rows of top_anime_df_core for
+content-based filtering. Neighbours are stored as int32 anime indices and
+float32 cosine distances, nearest first.
+"""
+
+import numpy as np
+
+from src import ann
+
+NUM_NEIGHBOURS = 20
+
+
+def get_item_neighbours(vectors, k=NUM_NEIGHBOURS, block_size=1024):
+    """Returns (neighbour_idxs, neighbour_dists) of the k nearest anime to each
+    anime, nearest first and excluding the anime itself.
+
+    Similarities are computed in blocks of rows so memory stays at
+    block_size x n_anime instead of n_anime x n_anime.
+
+    Args:
+        vectors: Anime vectors, shape (n_anime, n_dims). Row i is anime i.
+        k: Number of neighbours per anime.
+        block_size: Number of anime per block.
+    """
+    unit_vectors = ann.normalize_rows(vectors)
+    num_anime = len(unit_vectors)
+    k = min(k, num_anime - 1)
+    neighbour_idxs = np.empty((num_anime, k), dtype=np.int32)
+    neighbour_dists = np.empty((num_anime, k), dtype=np.float32)
+    for start in range(0, num_anime, block_size):
+        stop = min(start + block_size, num_anime)
+        dists = 1 - unit_vectors[start:stop] @ unit_vectors.T
+        # Push each anime's distance to itself past every other anime
+        dists[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        nearest = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        nearest_dists = np.take_along_axis(dists, nearest, axis=1)
+        order = np.argsort(nearest_dists, axis=1, kind='stable')
+        neighbour_idxs[start:stop] = np.take_along_axis(nearest, order, axis=1)
+        neighbour_dists[start:stop] = np.take_along_axis(nearest_dists, order, axis=1)
+    return neighbour_idxs, neighbour_dists
+
+
+def create_neighbour_table(components, anime_features, k=NUM_NEIGHBOURS):
+    """Returns dict mapping 'collab' and 'content' to (neighbour_idxs,
+    neighbour_dists) arrays from get_item_neighbours.
+
+    Args:
+        components: NMF components_, shape (n_components, n_anime).
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+        k: Number of neighbours per anime.
+    """
+    return {'collab': get_item_neighbours(components.T, k),
+            'content': get_item_neighbours(anime_features, k)}
@@ -0,0 +1,188 @@
+"""This module contains functions to update the collaborative filtering NMF
+with new or changed users instead of refitting it from scratch.
+
+The update is an online multiplicative update (in the spirit of online NMF):
+the fit keeps the sufficient statistics A = W.T @ X and B = W.T @ W. For a
+delta of users, their old contributions are removed, their embeddings are
+re-solved against the current components_ (see fold_in.py), their new
+contributions are added, and only the components_ columns of anime that appear
+in the delta are updated with H *= A / (B @ H). Columns of anime that no
+changed user touched stay exactly as they were.
+
+Usage (from the repo root):
+    python -m src.nmf_update ../pickles/nmf_state.pkl ../pickles/delta.pkl \\
+        ../pickles/nmf_state_updated.pkl
+"""
+
+import argparse
+import pickle
+import numpy as np
+from scipy import sparse
+from src import fold_in
+
+# Guards the multiplicative update against division by zero
+EPSILON = 1e-10
+
+
+def create_nmf_state(user_ids, anime_titles, user_score_matrix, user_embedding, components):
+    """Returns dict with everything needed to update a fitted NMF later.
+
+    Args:
+        user_ids: List of user IDs, one per row of user_score_matrix.
+        anime_titles: List of anime titles, one per column.
+        user_score_matrix: User-rating matrix (array or sparse), shape (n_users, n_anime).
+        user_embedding: NMF user embedding W, shape (n_users, n_components).
+        components: NMF components_ H, shape (n_components, n_anime).
+    """
+    user_score_matrix = sparse.csr_matrix(user_score_matrix, dtype=np.float64)
+    return {
+        'user_ids': list(user_ids),
+        'anime_titles': list(anime_titles),
+        'user_score_matrix': user_score_matrix,
+        'user_embedding': np.asarray(user_embedding, dtype=np.float64),
+        'components': np.asarray(components, dtype=np.float64),
+        'wtx': np.asarray((user_score_matrix.T @ user_embedding).T),
+        'wtw': user_embedding.T @ user_embedding
+    }
+
+
+def create_score_rows(animelist_data_list, anime_idx, num_anime):
+    """Returns sparse matrix of score rows for scraped animelists (e.g. a
+    refresh delta), with unscored or unknown anime as 0.
+
+    Args:
+        animelist_data_list: List of animelist data dicts from the scraper.
+        anime_idx: Dict mapping anime title to column index.
+        num_anime: Number of anime columns.
+    """
+    # Built as CSR directly, since assigning entries of a lil_matrix one at a
+    # time took most of the time of patching a delta
+    indptr, indices, data = [0], [], []
+    for animelist_data in animelist_data_list:
+        # A title listed twice keeps its last score
+        row_scores = {}
+        for anime_title, score in zip(animelist_data['animelist_titles'] or [],
+                                      animelist_data['animelist_scores'] or []):
+            idx = anime_idx.get(anime_title)
+            if idx is not None:
+                row_scores[idx] = fold_in.parse_score(score)
+        indices.extend(row_scores)
+        data.extend(row_scores.values())
+        indptr.append(len(indices))
+    score_rows = sparse.csr_matrix((np.array(data, dtype=np.float64), indices, indptr),
+                                   shape=(len(animelist_data_list), num_anime))
+    score_rows.eliminate_zeros()
+    score_rows.sort_indices()
+    return score_rows
+
+
+def _remove_contributions(state, user_idxs):
+    embedding = state['user_embedding'][user_idxs]
+    state['wtx'] -= (state['user_score_matrix'][user_idxs].T @ embedding).T
+    state['wtw'] -= embedding.T @ embedding
+
+
+def _add_contributions(state, user_idxs):
+    embedding = state['user_embedding'][user_idxs]
+    state['wtx'] += (state['user_score_matrix'][user_idxs].T @ embedding).T
+    state['wtw'] += embedding.T @ embedding
+
+
+def _solve_embeddings(state, user_idxs):
+    components = state['components']
+    rhs = np.asarray(state['user_score_matrix'][user_idxs] @ components.T)
+    state['user_embedding'][user_idxs] = fold_in.solve_user_embeddings(
+        components @ components.T, rhs, state['user_embedding'][user_idxs])
+
+
+def _replace_rows(matrix, user_idxs, new_rows):
+    """Returns sparse matrix with the rows at user_idxs replaced by new_rows."""
+    keep = np.ones(matrix.shape[0])
+    keep[user_idxs] = 0
+    selection = sparse.csr_matrix((np.ones(len(user_idxs)), (user_idxs, np.arange(len(user_idxs)))),
+                                  shape=(matrix.shape[0], len(user_idxs)))
+    return (sparse.diags(keep) @ matrix + selection @ new_rows).tocsr()
+
+
+def update_nmf(state, delta_user_ids, delta_score_rows, num_passes=10):
+    """Updates an NMF state in place with new or changed users and returns it.
+
+    Args:
+        state: Dict returned by create_nmf_state.
+        delta_user_ids: List of unique user IDs in the delta.
+        delta_score_rows: Sparse matrix of their current score rows.
+        num_passes: Number of alternating embedding/components passes.
+    """
+    user_idx_lookup = {user_id: idx for idx, user_id in enumerate(state['user_ids'])}
+    new_user_ids = [user_id for user_id in delta_user_ids if user_id not in user_idx_lookup]
+    if new_user_ids:
+        # New users start with an empty row and a zero embedding, so they have
+        # no old contribution to remove
+        num_users = len(state['user_ids'])
+        for offset, user_id in enumerate(new_user_ids):
+            user_idx_lookup[user_id] = num_users + offset
+        state['user_ids'] += new_user_ids
+        state['user_score_matrix'] = sparse.vstack(
+            [state['user_score_matrix'],
+             sparse.csr_matrix((len(new_user_ids), len(state['anime_titles'])))]).tocsr()
+        state['user_embedding'] = np.vstack(
+            [state['user_embedding'], np.zeros((len(new_user_ids), state['components'].shape[0]))])
+    user_idxs = np.array([user_idx_lookup[user_id] for user_id in delta_user_ids], dtype=int)
+
+    # Anime whose components_ column may change: anything in an old or new row
+    old_rows = state['user_score_matrix'][user_idxs]
+    touched_anime = np.union1d(old_rows.indices, sparse.csr_matrix(delta_score_rows).indices)
+
+    _remove_contributions(state, user_idxs)
+    state['user_score_matrix'] = _replace_rows(state['user_score_matrix'], user_idxs,
+                                               sparse.csr_matrix(delta_score_rows))
+
+    components = state['components']
+    for _ in range(num_passes):
+        _solve_embeddings(state, user_idxs)
+        _add_contributions(state, user_idxs)
+        columns = components[:, touched_anime]
+        components[:, touched_anime] = columns * state['wtx'][:, touched_anime] \
+            / (state['wtw'] @ columns + EPSILON)
+        _remove_contributions(state, user_idxs)
+    _solve_embeddings(state, user_idxs)
+    _add_contributions(state, user_idxs)
+    return state
+
+
+def get_reconstruction_error(state):
+    """Returns ||X - WH||_F / ||X||_F for an NMF state.
+
+    Uses the sufficient statistics instead of forming WH, so it is cheap even
+    for the full user-rating matrix.
+    """
+    components = state['components']
+    squared_norm = (state['user_score_matrix'].data ** 2).sum()
+    squared_error = squared_norm - 2 * (state['wtx'] * components).sum() \
+        + (state['wtw'] * (components @ components.T)).sum()
+    return np.sqrt(max(squared_error, 0) / squared_norm)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Update an NMF fit with a delta of users.')
+    arg_parser.add_argument('state_path', help='Pickled NMF state from anime_recommender.py.')
+    arg_parser.add_argument('delta_path', help='Pickled refresh delta (see src/refresh.py).')
+    arg_parser.add_argument('out_path', help='Path to pickle the updated NMF state to.')
+    arg_parser.add_argument('--num-passes', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    with open(args.state_path, 'rb') as read_file:
+        state = pickle.load(read_file)
+    with open(args.delta_path, 'rb') as read_file:
+        animelists = pickle.load(read_file)['animelists']
+    anime_idx = fold_in.create_anime_idx(state['anime_titles'])
+    delta_score_rows = create_score_rows(animelists, anime_idx, len(state['anime_titles']))
+    update_nmf(state, [animelist['user_id'] for animelist in animelists],
+               delta_score_rows, args.num_passes)
+    with open(args.out_path, 'wb') as to_write:
+        pickle.dump(state, to_write)
+    print(f'Updated {len(animelists)} users')
+
+
+if __name__ == '__main__':
+    main()
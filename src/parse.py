@@ -0,0 +1,408 @@
+"""This module contains functions to parse HTML pages scraped from myanimelist.net.
+
+Parsing is kept separate from scrape.py so that saved pages can be parsed (and
+benchmarked) without a network connection or a Chrome driver.
+"""
+
+import re
+from bs4 import BeautifulSoup
+
+# lxml is several times faster than html5lib and gives the same output on
+# MyAnimeList pages. html5lib is still what create_soup uses for other pages.
+PARSER = 'lxml'
+
+# Sidebar labels (the text of <span class="dark_text"> elements) used by
+# parse_anime_page
+SIDEBAR_LABELS = frozenset([
+    'English:', 'Type:', 'Source:', 'Episodes:', 'Status:', 'Aired:',
+    'Premiered:', 'Duration:', 'Rating:', 'Genres:', 'Ranked:', 'Popularity:',
+    'Members:', 'Favorites:', 'Studios:', 'Producers:', 'Licensors:'
+])
+
+TRAILER_CLASS = 'iframe js-fancybox-video video-unit promotion'
+
+
+def create_page_soup(html, parser=PARSER):
+    """Returns BeautifulSoup object for the HTML of a saved or fetched page.
+
+    Args:
+        html: Raw HTML of the page.
+        parser: BeautifulSoup parser backend, e.g. 'lxml' or 'html5lib'.
+    """
+    return BeautifulSoup(html, parser)
+
+
+def create_anime_data(mal_id, url, soup):
+    """Returns dictionary of key data for anime, as scraped by get_anime_data.
+
+    Args:
+        mal_id: MyAnimeList anime ID.
+        url: URL of the anime page.
+        soup: BeautifulSoup object of the anime page.
+    """
+    anime_data = {
+        'mal_id': mal_id,
+        'url': url
+    }
+    anime_data.update(parse_anime_page(soup))
+    return anime_data
+
+
+def create_animelist_data(user_id, url, soup):
+    """Returns dictionary of key data from user's animelist, as scraped by
+    get_animelist_data.
+
+    Args:
+        user_id: MyAnimeList user ID.
+        url: URL of the user's animelist.
+        soup: BeautifulSoup object of the animelist page.
+    """
+    animelist_titles, animelist_scores = parse_animelist_rows(soup)
+    animelist_data = {
+        'user_id': user_id,
+        'animelist_url': url,
+        'animelist_titles': animelist_titles,
+        'animelist_scores': animelist_scores
+    }
+    return animelist_data
+
+
+def index_anime_page(soup):
+    """Returns dict mapping sidebar labels and other anime page landmarks to
+    their elements, built in a single walk over the page.
+
+    Only the first element for each key is kept, which matches what
+    soup.find would return.
+
+    Args:
+        soup: BeautifulSoup object of an anime page.
+    """
+    page_index = {}
+    for element in soup.find_all(True):
+        if element.name == 'span':
+            if element.string in SIDEBAR_LABELS:
+                page_index.setdefault(str(element.string), element)
+            if element.get('itemprop') in ('ratingValue', 'ratingCount'):
+                page_index.setdefault(element.get('itemprop'), element)
+        elif element.name == 'img' and element.get('itemprop') == 'image':
+            page_index.setdefault('image', element)
+        classes = element.get('class')
+        if classes:
+            if 'title-name' in classes:
+                page_index.setdefault('title-name', element)
+            if ' '.join(classes) == TRAILER_CLASS:
+                page_index.setdefault('trailer', element)
+    return page_index
+
+
+def _parent_text(label):
+    """Returns extractor for fields stored as the text next to the label."""
+    def extract(element):
+        return element.find_parent().text.strip().replace(label, '').strip()
+    return extract
+
+
+def _next_text(element):
+    return element.find_next().text
+
+
+def _parent_links(element):
+    return [link.text for link in element.find_parent().find_all('a')]
+
+
+def _parent_rank(element):
+    return element.find_parent().find(string=re.compile('#')).strip()
+
+
+def _english_title(element):
+    # Unlike the other labels, the English title keeps anything after 'English: '
+    return element.find_parent().text.strip().replace('English: ', '')
+
+
+# (field, index key, extractor) in the order the fields appear in anime data dicts
+ANIME_FIELDS = [
+    ('image_url', 'image', lambda element: element.get('data-src')),
+    ('trailer_url', 'trailer', lambda element: element.get('href')),
+    ('title_main', 'title-name', lambda element: element.text),
+    ('title_english', 'English:', _english_title),
+    ('media_type', 'Type:', _next_text),
+    ('source_material', 'Source:', _parent_text('Source:')),
+    ('num_episodes', 'Episodes:', _parent_text('Episodes:')),
+    ('airing_status', 'Status:', _parent_text('Status:')),
+    ('aired_dates', 'Aired:', _parent_text('Aired:')),
+    ('premiered', 'Premiered:', _next_text),
+    ('duration', 'Duration:', _parent_text('Duration:')),
+    ('content_rating', 'Rating:', _parent_text('Rating:')),
+    ('genres', 'Genres:', _parent_links),
+    ('score', 'ratingValue', lambda element: element.text),
+    ('scored_by_num_users', 'ratingCount', lambda element: element.text),
+    ('rank_score', 'Ranked:', _parent_rank),
+    ('rank_popularity', 'Popularity:', _parent_rank),
+    ('members', 'Members:', _parent_text('Members:')),
+    ('favorites', 'Favorites:', _parent_text('Favorites:')),
+    ('studios', 'Studios:', _parent_links),
+    ('producers', 'Producers:', _parent_links),
+    ('licensors', 'Licensors:', _parent_links)
+]
+
+
+def parse_anime_page(soup):
+    """Returns dictionary of key data parsed from an anime page.
+
+    Gives the same output as calling each of the get_* field functions below,
+    but walks the page once instead of searching the whole tree per field.
+
+    Args:
+        soup: BeautifulSoup object of an anime page.
+    """
+    page_index = index_anime_page(soup)
+    anime_data = {}
+    for field, key, extract in ANIME_FIELDS:
+        element = page_index.get(key)
+        anime_data[field] = extract(element) if element is not None else None
+    return anime_data
+
+
+def _parse_animelist_row(row):
+    """Returns (title, score) for an animelist row, or None if the row has no
+    title. Rows with a title but no score text get the score '-', the same
+    value MyAnimeList shows for unscored anime."""
+    title_cell = row.find(class_='data title clearfix')
+    title_link = title_cell.find(class_='link sort') if title_cell else None
+    if title_link is None:
+        return None
+    score_cell = row.find(class_='data score')
+    score = score_cell.text.strip() if score_cell else ''
+    return title_link.text, score or '-'
+
+
+def parse_animelist_rows(soup):
+    """Returns (animelist_titles, animelist_scores) for a user's animelist.
+
+    Each row is read once and only rows with a title are kept, so the two lists
+    always have the same length and line up. Both are None if the page has no
+    anime rows (e.g. the list is private or empty), like get_animelist_titles
+    and get_animelist_scores.
+
+    Args:
+        soup: BeautifulSoup object of a user's animelist page.
+    """
+    rows = soup.find_all('tbody', class_='list-item')
+    if not rows:
+        return None, None
+    animelist_titles = []
+    animelist_scores = []
+    for row in rows:
+        title_score = _parse_animelist_row(row)
+        if title_score:
+            animelist_titles.append(title_score[0])
+            animelist_scores.append(title_score[1])
+    return animelist_titles, animelist_scores
+
+
+def get_animelist_outcome(soup, animelist_data):
+    """Returns the outcome of scraping an animelist page: 'ok' if it has anime
+    rows, 'private' if MyAnimeList refused access, 'timeout' if the list table
+    never loaded and 'empty' otherwise.
+
+    Args:
+        soup: BeautifulSoup object of the animelist page.
+        animelist_data: Dict returned by create_animelist_data for the page.
+    """
+    if animelist_data['animelist_titles'] is not None:
+        return 'ok'
+    # If 'badresult' class exists, means the anime list is private
+    if soup.find(class_='badresult'):
+        return 'private'
+    # create_soup_selenium waits for a table, so no table means the wait timed out
+    if soup.find('table') is None:
+        return 'timeout'
+    return 'empty'
+
+
+# The functions below search the page once per field. They are kept for
+# parsing individual fields and as the reference output for parse_anime_page
+# and parse_animelist_rows.
+
+def get_image_url(soup):
+    if soup.find('img', itemprop='image'):
+        image_url = soup.find('img', itemprop='image').get('data-src')
+        return image_url
+
+
+def get_trailer_url(soup):
+    if soup.find(class_='iframe js-fancybox-video video-unit promotion'):
+        trailer_url = soup.find(class_= \
+            'iframe js-fancybox-video video-unit promotion').get('href')
+        return trailer_url
+
+
+def get_title_main(soup):
+    if soup.find(class_='title-name'):
+        title_main = soup.find(class_='title-name').text
+        return title_main
+
+
+def get_title_english(soup):
+    if soup.find('span', string='English:'):
+        raw_text = soup.find('span', string='English:').find_parent().text
+        # Clean raw text to extract the English title
+        title_english = raw_text.strip().replace('English: ', '')
+        return title_english
+
+
+def get_media_type(soup):
+    if soup.find('span', string='Type:'):
+        media_type = soup.find('span', string='Type:').find_next().text
+        return media_type
+
+
+def get_source_material(soup):
+    if soup.find('span', string='Source:'):
+        raw_text = soup.find('span', string='Source:').find_parent().text
+        # Clean raw text
+        source_material = raw_text.strip().replace('Source:', '').strip()
+        return source_material
+
+
+def get_num_episodes(soup):
+    if soup.find('span', string='Episodes:'):
+        raw_text = soup.find('span', string='Episodes:').find_parent().text
+        # Clean raw text
+        num_episodes = raw_text.strip().replace('Episodes:', '').strip()
+        return num_episodes
+
+
+def get_airing_status(soup):
+    if soup.find('span', string='Status:'):
+        raw_text = soup.find('span', string='Status:').find_parent().text
+        # Clean raw text
+        airing_status = raw_text.strip().replace('Status:', '').strip()
+        return airing_status
+
+
+def get_aired_dates(soup):
+    if soup.find('span', string='Aired:'):
+        raw_text = soup.find('span', string='Aired:').find_parent().text
+        # Clean raw text
+        aired_dates = raw_text.strip().replace('Aired:', '').strip()
+        return aired_dates
+
+
+def get_premiered(soup):
+    if soup.find('span', string='Premiered:'):
+        premiered = soup.find('span', string='Premiered:').find_next().text
+        return premiered
+
+
+def get_duration(soup):
+    if soup.find('span', string='Duration:'):
+        raw_text = soup.find('span', string='Duration:').find_parent().text
+        # Clean raw text
+        duration = raw_text.strip().replace('Duration:', '').strip()
+        return duration
+
+
+def get_content_rating(soup):
+    if soup.find('span', string='Rating:'):
+        raw_text = soup.find('span', string='Rating:').find_parent().text
+        # Clean raw text
+        content_rating = raw_text.strip().replace('Rating:', '').strip()
+        return content_rating
+
+
+def get_genres(soup):
+    if soup.find('span', string='Genres:'):
+        genres = [element.text for element in \
+            soup.find('span', string='Genres:').find_parent().find_all('a')]
+        return genres
+
+
+def get_score(soup):
+    if soup.find('span', itemprop='ratingValue'):
+        score = soup.find('span', itemprop='ratingValue').text
+        return score
+
+
+def get_scored_by_num_users(soup):
+    if soup.find('span', itemprop='ratingCount'):
+        scored_by_num_users = soup.find('span', itemprop='ratingCount').text
+        return scored_by_num_users
+
+
+def get_rank_score(soup):
+    if soup.find('span', string='Ranked:'):
+        rank_score = soup.find('span', string='Ranked:').find_parent() \
+            .find(string=re.compile('#')).strip()
+        return rank_score
+
+
+def get_rank_popularity(soup):
+    if soup.find('span', string='Popularity:'):
+        rank_popularity = soup.find('span', string='Popularity:').find_parent() \
+            .find(string=re.compile('#')).strip()
+        return rank_popularity
+
+
+def get_members(soup):
+    if soup.find('span', string='Members:'):
+        raw_text = soup.find('span', string='Members:').find_parent().text
+        # Clean raw text
+        members = raw_text.strip().replace('Members:', '').strip()
+        return members
+
+
+def get_favorites(soup):
+    if soup.find('span', string='Favorites:'):
+        raw_text = soup.find('span', string='Favorites:').find_parent().text
+        # Clean raw text
+        favorites = raw_text.strip().replace('Favorites:', '').strip()
+        return favorites
+
+
+def get_studios(soup):
+    if soup.find('span', string='Studios:'):
+        studios = [element.text for element in \
+            soup.find('span', string='Studios:').find_parent().find_all('a')]
+        return studios
+
+
+def get_producers(soup):
+    if soup.find('span', string='Producers:'):
+        producers = [element.text for element in \
+            soup.find('span', string='Producers:').find_parent().find_all('a')]
+        return producers
+
+
+def get_licensors(soup):
+    if soup.find('span', string='Licensors:'):
+        licensors = [element.text for element in \
+            soup.find('span', string='Licensors:').find_parent().find_all('a')]
+        return licensors
+
+
+def get_animelist_titles(soup):
+    """Returns list of all anime titles in user's animelist."""
+    if soup.find_all('tbody', class_='list-item'):
+        animelist_titles = []
+        for element in soup.find_all('tbody', class_='list-item'):
+            # Making sure that the element exists before appending
+            if element.find(class_='data title clearfix'):
+                if element.find(class_='data title clearfix').find(class_='link sort'):
+                    animelist_title = element.find(class_='data title clearfix') \
+                        .find(class_='link sort').text
+                    animelist_titles.append(animelist_title)
+        return animelist_titles
+
+
+def get_animelist_scores(soup):
+    """Returns list of all anime ratings in user's animelist."""
+    if soup.find_all('tbody', class_='list-item'):
+        animelist_scores = []
+        for element in soup.find_all('tbody', class_='list-item'):
+            # Making sure that the element exists before appending
+            if element.find(class_='data score'):
+                if element.find(class_='data score').text:
+                    animelist_score = element.find(class_='data score').text.strip()
+                    animelist_scores.append(animelist_score)
+        return animelist_scores
@@ -0,0 +1,249 @@
+"""This module patches the published serving bundle with a delta of new or
+changed users instead of rebuilding everything with anime_recommender.py.
+
+Only the rows of users in the delta are recomputed:
+
+* their score rows and NMF embeddings, with nmf_update.update_nmf and no
+  components_ passes, i.e. re-solved against the fixed components_ (like
+  fold_in.py), so the precomputed candidates of every other user stay valid,
+* their seen sets (scored anime and anime on the animelist),
+* their content user vectors (mean features of the anime on their animelist),
+* their collaborative and content-based candidates.
+
+New users are appended after the existing ones. Anime-side arrays (components,
+features, ANN indexes, neighbour table, title index) are hard-linked from the
+current version instead of written. The per-user arrays can't be linked, since
+the served version memory-maps them, so they are copied with the delta's rows
+replaced; that is a plain memory copy (~0.1 s for 120,000 users), and the rest
+of the work grows with the delta, not with the number of users. Sharded
+artifact roots (see src/sharding.py) are patched shard by shard.
+
+Changed anime in the delta are ignored, since they change every user's
+candidates; those need a full rebuild, which also refits the NMF components.
+
+Usage (from the repo root):
+    python -m src.patch_artifacts ../pickles/nmf_state.pkl ../pickles/delta.pkl \\
+        ../artifacts
+"""
+
+import argparse
+import glob
+import os
+import pickle
+import time
+
+import numpy as np
+from sklearn.metrics import pairwise_distances
+
+from src import artifacts, data_cleaning as dc, fold_in, nmf_update, prefix_index, sharding
+
+
+def create_delta_rows(animelists, anime_idx, num_anime):
+    """Returns (user_ids, score_rows, history_rows) for the users of a delta.
+
+    Args:
+        animelists: List of animelist data dicts from the scraper. If a user
+            appears more than once, their last animelist is used.
+        anime_idx: Dict mapping anime title to column index.
+        num_anime: Number of anime columns.
+    Returns:
+        user_ids: Unique user IDs.
+        score_rows: Sparse matrix of their scores (0 = not scored).
+        history_rows: Sparse 0/1 matrix of the anime on their animelists.
+    """
+    latest = {animelist['user_id']: animelist
+              for animelist in dc.fix_mismatching_animelist_len(animelists)}
+    user_ids = list(latest)
+    score_rows = nmf_update.create_score_rows(list(latest.values()), anime_idx, num_anime)
+    # An anime is on the animelist even if it isn't scored ('-')
+    history_lists = [{'animelist_titles': animelist['animelist_titles'],
+                      'animelist_scores': [1] * len(animelist['animelist_titles'] or [])}
+                     for animelist in latest.values()]
+    history_rows = nmf_update.create_score_rows(history_lists, anime_idx, num_anime)
+    return user_ids, score_rows, history_rows
+
+
+def get_user_candidates(user_embeddings, user_vectors, components, anime_features):
+    """Returns (collab_candidates, content_candidates) for a few users, with the
+    same distances as anime_recommender.py (which rounds the NMF embeddings to 2
+    decimals before taking cosine distances).
+
+    Args:
+        user_embeddings: NMF user embeddings, shape (n_users, n_components).
+        user_vectors: Content-based user vectors, shape (n_users, n_features).
+        components: NMF components_, shape (n_components, n_anime).
+        anime_features: Content feature matrix, shape (n_anime, n_features).
+    """
+    collab_dists = pairwise_distances(np.round(user_embeddings, 2), np.round(components.T, 2),
+                                      metric='cosine')
+    content_dists = pairwise_distances(user_vectors, anime_features, metric='cosine')
+    return artifacts.get_candidates(collab_dists), artifacts.get_candidates(content_dists)
+
+
+def replace_csr_rows(indptr, indices, rows, new_rows):
+    """Returns (indptr, indices) of a CSR (indptr, indices) pair with rows
+    replaced by the rows of new_rows. Rows past the end are appended.
+
+    Args:
+        indptr: CSR indptr.
+        indices: CSR indices.
+        rows: Unique row of each row of new_rows, e.g. len(indptr) - 1 for the
+            first new row.
+        new_rows: Sparse CSR matrix of the new rows.
+    """
+    num_old_rows = len(indptr) - 1
+    num_rows = max(num_old_rows, int(rows.max()) + 1) if len(rows) else num_old_rows
+    old_counts = np.zeros(num_rows, dtype=np.int64)
+    old_counts[:num_old_rows] = np.diff(indptr)
+    counts = old_counts.copy()
+    counts[rows] = np.diff(new_rows.indptr)
+    replaced = np.zeros(num_rows, dtype=bool)
+    replaced[rows] = True
+    new_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(indptr.dtype)
+    new_indices = np.empty(new_indptr[-1], dtype=indices.dtype)
+    # Kept and new entries each fill their slots in row order, so two masked
+    # assignments place every entry without a loop over rows
+    new_indices[np.repeat(~replaced, counts)] = indices[np.repeat(~replaced, old_counts)]
+    new_indices[np.repeat(replaced, counts)] = new_rows[np.argsort(rows)].indices
+    return new_indptr, new_indices
+
+
+def patch_bundle(arrays, ids, user_ids, score_rows, history_rows, user_embeddings):
+    """Returns (arrays, ids, changed_names) of a bundle with the rows of user_ids
+    replaced, or appended for users that aren't in it yet.
+
+    Args:
+        arrays: Dict of the bundle's arrays, e.g. memory-mapped by load_bundle.
+        ids: The bundle's ids dict.
+        user_ids: Unique IDs of the users to patch.
+        score_rows: Sparse CSR matrix of their scores.
+        history_rows: Sparse CSR 0/1 matrix of the anime on their animelists.
+        user_embeddings: Their NMF embeddings, shape (n_users, n_components).
+    """
+    if not user_ids:
+        return dict(arrays), dict(ids), []
+    user_idx = {user_id: idx for idx, user_id in enumerate(ids['user_ids'])}
+    new_user_ids = [user_id for user_id in user_ids if user_id not in user_idx]
+    for offset, user_id in enumerate(new_user_ids):
+        user_idx[user_id] = len(ids['user_ids']) + offset
+    rows = np.array([user_idx[user_id] for user_id in user_ids], dtype=np.int64)
+    num_users = len(ids['user_ids']) + len(new_user_ids)
+
+    # Mean features of the anime on each animelist, like create_user_vector_df
+    user_vectors = np.asarray(history_rows @ arrays['anime_features']) / \
+        np.maximum(np.asarray(history_rows.sum(axis=1)), 1)
+    candidates = get_user_candidates(user_embeddings, user_vectors, arrays['components'],
+                                     arrays['anime_features'])
+    patched = dict(arrays)
+    for name, user_candidates in zip(sharding.USER_ROW_ARRAYS, candidates):
+        patched[name] = np.empty((num_users, arrays[name].shape[1]), dtype=arrays[name].dtype)
+        patched[name][:len(arrays[name])] = arrays[name]
+        patched[name][rows] = user_candidates
+    for (indptr_name, indices_name), new_rows in zip(sharding.USER_CSR_ARRAYS,
+                                                     [score_rows, history_rows]):
+        new_rows = new_rows.tocsr()
+        new_rows.eliminate_zeros()
+        new_rows.sort_indices()
+        patched[indptr_name], patched[indices_name] = replace_csr_rows(
+            arrays[indptr_name], arrays[indices_name], rows, new_rows)
+    changed_names = sharding.USER_ROW_ARRAYS + [name for pair in sharding.USER_CSR_ARRAYS
+                                                for name in pair]
+    if new_user_ids and 'user_prefix_keys' in arrays:
+        patched['user_prefix_keys'], patched['user_prefix_rows'] = \
+            prefix_index.insert_into_prefix_index(
+                arrays['user_prefix_keys'], arrays['user_prefix_rows'], new_user_ids,
+                np.arange(len(ids['user_ids']), num_users))
+        changed_names += ['user_prefix_keys', 'user_prefix_rows']
+    patched_ids = dict(ids)
+    patched_ids['user_ids'] = ids['user_ids'] + new_user_ids
+    return patched, patched_ids, changed_names
+
+
+def get_bundle_roots(artifact_root):
+    """Returns list of (artifact root, shard) to patch: the shard roots of a
+    sharded artifact root in shard order, or the artifact root itself with shard
+    None."""
+    num_shards = len(glob.glob(sharding.get_shard_root(artifact_root, '*')))
+    if num_shards == 0:
+        return [(artifact_root, None)]
+    return [(sharding.get_shard_root(artifact_root, shard), shard) for shard in range(num_shards)]
+
+
+def patch_artifacts(state, animelists, artifact_root, version=None):
+    """Updates the NMF state in place with a delta of animelists and publishes
+    the patched bundle as a new version under artifact_root (every shard if it
+    is sharded). Returns the version.
+
+    Args:
+        state: NMF state from nmf_update.create_nmf_state whose components_ are
+            the ones in the published bundle.
+        animelists: List of animelist data dicts of new or changed users.
+        artifact_root: Artifact root the bundle is published under.
+        version: Version name. Defaults to artifacts.create_version().
+    """
+    version = version or artifacts.create_version()
+    anime_idx = fold_in.create_anime_idx(state['anime_titles'])
+    user_ids, score_rows, history_rows = create_delta_rows(animelists, anime_idx,
+                                                           len(state['anime_titles']))
+    bundles = []
+    for bundle_root, shard in get_bundle_roots(artifact_root):
+        bundle_dir = os.path.join(bundle_root, artifacts.get_current_version(bundle_root))
+        arrays, ids, manifest = artifacts.load_bundle(bundle_dir, mmap_mode='r')
+        # Other users' candidates were ranked against these components, so the
+        # delta's embeddings must be solved against the same ones
+        if ids['anime_titles'] != state['anime_titles'] or \
+                not np.array_equal(arrays['components'], state['components']):
+            raise ValueError(f'{bundle_dir} was not built from this NMF state; '
+                             'rerun anime_recommender.py')
+        bundles.append((bundle_root, bundle_dir, arrays, ids, manifest))
+
+    # No components_ passes, so only the delta's rows and embeddings change
+    nmf_update.update_nmf(state, user_ids, score_rows, num_passes=0)
+    state_idx = {user_id: idx for idx, user_id in enumerate(state['user_ids'])}
+    user_embeddings = state['user_embedding'][[state_idx[user_id] for user_id in user_ids]]
+
+    for bundle_root, bundle_dir, arrays, ids, manifest in bundles:
+        shard = manifest.get('shard')
+        positions = np.arange(len(user_ids))
+        if shard is not None:
+            positions = np.array([position for position, user_id in enumerate(user_ids)
+                                  if sharding.get_shard(user_id, shard['num_shards'])
+                                  == shard['index']], dtype=np.int64)
+        patched, patched_ids, changed_names = patch_bundle(
+            arrays, ids, [user_ids[position] for position in positions],
+            score_rows[positions], history_rows[positions], user_embeddings[positions])
+        artifacts.publish_bundle(bundle_root, patched, patched_ids, version, shard,
+                                 link_from=bundle_dir,
+                                 linked_names=[name for name in patched
+                                               if name not in changed_names])
+    return version
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Patch the serving artifacts with a delta of new or changed users.')
+    arg_parser.add_argument('state_path', help='Pickled NMF state from anime_recommender.py.')
+    arg_parser.add_argument('delta_path', help='Pickled refresh delta (see src/refresh.py).')
+    arg_parser.add_argument('artifact_root', help='Artifact root to publish the patch to.')
+    arg_parser.add_argument('--state-out',
+                            help='Path to pickle the updated NMF state to (default: '
+                                 'state_path, so the next patch starts from this one).')
+    args = arg_parser.parse_args()
+
+    start = time.time()
+    with open(args.state_path, 'rb') as read_file:
+        state = pickle.load(read_file)
+    with open(args.delta_path, 'rb') as read_file:
+        animelists = pickle.load(read_file)['animelists']
+    num_users = len(state['user_ids'])
+    version = patch_artifacts(state, animelists, args.artifact_root)
+    state_out = args.state_out or args.state_path
+    with open(state_out + '.tmp', 'wb') as to_write:
+        pickle.dump(state, to_write)
+    os.replace(state_out + '.tmp', state_out)
+    print(f"Patched {len(animelists)} animelists ({len(state['user_ids']) - num_users} new "
+          f'users) into version {version} in {time.time() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
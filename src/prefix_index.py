@@ -0,0 +1,85 @@
+"""This module builds the prefix-search indexes for autocompleting user IDs and
+anime titles in the Flask app.
+
+An index is a pair of arrays: the case-folded UTF-8 keys in sorted order (a
+fixed-width bytes array) and the row each key belongs to, i.e. the user's row
+in the serving arrays or the anime's column. Byte order of UTF-8 is code point
+order, so all keys starting with a prefix are one contiguous range that
+flask/recommendation/prefix_search.py finds with two binary searches. Both
+arrays are plain .npy files in the bundle, so serve.py memory-maps them like
+the others.
+
+normalize_key must give the same keys as normalize_prefix in
+flask/recommendation/prefix_search.py.
+"""
+
+import numpy as np
+
+
+def normalize_key(text):
+    """Returns the UTF-8 key of text that prefix searches compare against."""
+    return str(text).casefold().encode('utf-8')
+
+
+def build_prefix_index(texts, rows):
+    """Returns (keys, rows) sorted by key.
+
+    Args:
+        texts: Strings to search, e.g. user IDs or anime titles.
+        rows: Row of each string. A row can appear more than once, e.g. an
+            anime under its main and its English title.
+    """
+    keys = np.array([normalize_key(text) for text in texts], dtype=bytes)
+    rows = np.asarray(rows, dtype=np.int32)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], rows[order]
+
+
+def insert_into_prefix_index(keys, rows, texts, new_rows):
+    """Returns (keys, rows) of a prefix index with texts added at their sorted
+    positions, without sorting the existing keys again.
+
+    Args:
+        keys: Sorted keys from build_prefix_index.
+        rows: Row of each key.
+        texts: Strings to add.
+        new_rows: Row of each string.
+    """
+    new_keys, new_rows = build_prefix_index(texts, new_rows)
+    # Keys longer than the current width would be truncated by np.insert
+    width = max(keys.itemsize, new_keys.itemsize)
+    keys, new_keys = keys.astype(f'S{width}'), new_keys.astype(f'S{width}')
+    positions = np.searchsorted(keys, new_keys, 'right')
+    return np.insert(keys, positions, new_keys), np.insert(rows, positions, new_rows)
+
+
+def create_user_prefix_arrays(user_ids):
+    """Returns dict of the user ID prefix index arrays for the serving bundle.
+
+    Args:
+        user_ids: User IDs in the row order of the serving arrays.
+    """
+    keys, rows = build_prefix_index(user_ids, np.arange(len(user_ids)))
+    return {'user_prefix_keys': keys, 'user_prefix_rows': rows}
+
+
+def create_title_prefix_arrays(anime_titles, top_anime_df):
+    """Returns dict of the anime title prefix index arrays for the serving
+    bundle. Each anime is indexed under its main title and, if it has a
+    different one, its English title.
+
+    Args:
+        anime_titles: Anime titles in the column order of the serving arrays.
+        top_anime_df: Cleaned top anime DataFrame with 'title_main' and
+            'title_english' columns.
+    """
+    english_titles = dict(zip(top_anime_df['title_main'], top_anime_df['title_english']))
+    texts, rows = list(anime_titles), list(range(len(anime_titles)))
+    for idx, title in enumerate(anime_titles):
+        english_title = english_titles.get(title)
+        # Missing English titles are None or NaN after cleaning
+        if isinstance(english_title, str) and english_title and english_title != title:
+            texts.append(english_title)
+            rows.append(idx)
+    keys, rows = build_prefix_index(texts, rows)
+    return {'title_prefix_keys': keys, 'title_prefix_rows': rows}
@@ -182,11 +182,28 @@ def recommend(user_id, user_anime_cosine_distances_content,
             the parameter num_recs. List is sorted with top recommendations first.
         recs_df: DataFrame of recommendations with details.
     """
-    rec_dicts = []
     collab_recs = get_collab_filt_recs(user_id, user_anime_cosine_distances_collab,
                                        anime_titles, user_score_df)
     content_recs = get_content_filt_recs(user_id, user_anime_cosine_distances_content,
                                          anime_titles, user_anime_history_df)
+    return fuse_recs(user_id, collab_recs, content_recs, collab_weight, num_recs)
+
+
+def fuse_recs(user_id, collab_recs, content_recs, collab_weight=1, num_recs=10):
+    """Combines collaborative and content-based filtering recommendations using
+    the scoring logic in recommend.
+
+    Args:
+        user_id: MyAnimeList user ID.
+        collab_recs: Collaborative filtering recommendations, best first.
+        content_recs: Content-based filtering recommendations, best first.
+        collab_weight: Weight applied to collaborative filtering scores.
+        num_recs: Number of recommendations.
+    Returns:
+        recs: Recommendations as a list of anime, top recommendations first.
+        recs_df: DataFrame of recommendations with details.
+    """
+    rec_dicts = []
     for idx, (collab_rec, content_rec) in enumerate(zip(collab_recs, content_recs)):
         rec_dict_collab = {
             'user_id': user_id,
@@ -0,0 +1,252 @@
+"""This module contains functions to incrementally refresh scraped data.
+
+Instead of rescraping every anime page and animelist, a refresh keeps a fetch
+state per URL (ETag, Last-Modified and content hashes) and:
+
+* sends conditional requests, so unchanged anime pages come back as
+  304 Not Modified and are neither downloaded nor parsed,
+* skips parsing pages whose raw HTML hashes the same as last time,
+* compares a hash of the parsed data so pages that only changed in unrelated
+  markup (ads, tokens) don't count as changed,
+* skips animelists that are private, timed out or empty without storing their
+  hashes, so they don't zero the user's rows and are tried again next time,
+* records pages that fail to download (e.g. a 5xx or 429) and moves on,
+
+and returns only the anime and users whose data changed as a delta for
+downstream matrix updates.
+
+Usage (from the repo root):
+    python -m src.refresh --state ../pickles/fetch_state.pkl \\
+        --anime-ids ../pickles/mal_ids.pkl --user-ids ../pickles/user_ids.txt \\
+        --delta-out ../pickles/delta.pkl
+"""
+
+import argparse
+import hashlib
+import pickle
+import random
+import time
+import requests
+from fake_useragent import UserAgent
+from src import archive, parse, telemetry
+
+ANIME_BASE_URL = 'https://myanimelist.net/anime/'
+ANIMELIST_BASE_URL = 'https://myanimelist.net/animelist/'
+
+
+def load_fetch_state(state_path):
+    """Returns the fetch state dict (URL -> validators and hashes) saved at
+    state_path, or an empty dict if there is none yet.
+
+    Args:
+        state_path: Path of the pickled fetch state.
+    """
+    try:
+        with open(state_path, 'rb') as read_file:
+            return pickle.load(read_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_fetch_state(fetch_state, state_path):
+    """Pickles the fetch state to state_path.
+
+    Args:
+        fetch_state: Dict mapping URL to validators and hashes.
+        state_path: Path of the pickled fetch state.
+    """
+    with open(state_path, 'wb') as to_write:
+        pickle.dump(fetch_state, to_write)
+
+
+def hash_content(content):
+    """Returns hex SHA-1 of a string, or of the repr of parsed data."""
+    if not isinstance(content, str):
+        content = repr(content)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def conditional_fetch(url, fetch_state, session=None, archive_dir=None):
+    """Returns the HTML for url, or None if the server answered 304 Not Modified.
+
+    Sends If-None-Match/If-Modified-Since from the stored fetch state and saves
+    the new ETag/Last-Modified back into it.
+
+    Args:
+        url: URL to fetch.
+        fetch_state: Dict mapping URL to validators and hashes. Updated in place.
+        session: Optional requests.Session to reuse connections.
+        archive_dir: If given, downloaded pages are appended to the page archive.
+    """
+    url_state = fetch_state.setdefault(url, {})
+    headers = {'User-agent': UserAgent().random}
+    if url_state.get('etag'):
+        headers['If-None-Match'] = url_state['etag']
+    if url_state.get('last_modified'):
+        headers['If-Modified-Since'] = url_state['last_modified']
+    kind = telemetry.get_page_kind(url)
+    with telemetry.timer(f'fetch_seconds.{kind}'):
+        response = (session or requests).get(url, headers=headers)
+    url_state['fetched_at'] = time.time()
+    telemetry.increment(f'bytes.{kind}', len(response.content))
+    if response.status_code == 304:
+        telemetry.increment(f'not_modified.{kind}')
+        return None
+    response.raise_for_status()
+    url_state['etag'] = response.headers.get('ETag')
+    url_state['last_modified'] = response.headers.get('Last-Modified')
+    if archive_dir:
+        archive.append_page(archive_dir, url, response.text, url_state['fetched_at'])
+    return response.text
+
+
+def update_if_changed(url, html, fetch_state, create_data, get_outcome=None):
+    """Returns parsed data for a fetched page if it changed since the last
+    refresh, otherwise None.
+
+    Pages with the same raw HTML hash are not parsed at all. Otherwise the page
+    is parsed and only counts as changed if the parsed data differs.
+
+    Args:
+        url: URL of the page.
+        html: Raw HTML of the page.
+        fetch_state: Dict mapping URL to validators and hashes. Updated in place.
+        create_data: Function that parses the soup into a data dict.
+        get_outcome: Optional function of the soup and data dict that returns
+            one of telemetry.OUTCOMES. Pages with another outcome than 'ok'
+            are recorded and skipped without storing their hashes.
+    """
+    url_state = fetch_state.setdefault(url, {})
+    html_hash = hash_content(html)
+    if html_hash == url_state.get('html_hash'):
+        return None
+    soup = parse.create_page_soup(html)
+    data = create_data(soup)
+    if get_outcome is not None:
+        outcome = get_outcome(soup, data)
+        telemetry.record_page(telemetry.get_page_kind(url), outcome)
+        if outcome != 'ok':
+            return None
+    url_state['html_hash'] = html_hash
+    data_hash = hash_content(data)
+    if data_hash == url_state.get('data_hash'):
+        return None
+    url_state['data_hash'] = data_hash
+    return data
+
+
+def refresh_anime_data(mal_ids, fetch_state, base_url=ANIME_BASE_URL,
+                       archive_dir=None, delay=True):
+    """Returns list of anime data dicts for anime whose pages changed.
+
+    Args:
+        mal_ids: MyAnimeList anime IDs to refresh.
+        fetch_state: Dict mapping URL to validators and hashes. Updated in place.
+        base_url: Base URL of anime pages (point at a local server for testing).
+        archive_dir: If given, downloaded pages are appended to the page archive.
+        delay: Whether to pause between requests like get_anime_data does.
+    """
+    changed_anime_data = []
+    with requests.Session() as session:
+        for mal_id in mal_ids:
+            url = base_url + str(mal_id)
+            try:
+                html = conditional_fetch(url, fetch_state, session, archive_dir)
+            # One failed page (e.g. a 5xx or 429) shouldn't lose the rest of
+            # the refresh. Its validators aren't updated, so it's tried again
+            # next time.
+            except requests.RequestException as e:
+                print(f'Could not fetch {url}: {e}')
+                telemetry.record_page('anime', 'error')
+                html = None
+            if html is not None:
+                anime_data = update_if_changed(
+                    url, html, fetch_state,
+                    lambda soup: parse.create_anime_data(mal_id, url, soup))
+                if anime_data:
+                    changed_anime_data.append(anime_data)
+            if delay:
+                time.sleep(0.5+2*random.random())
+    return changed_anime_data
+
+
+def refresh_animelist_data(user_ids, fetch_state, base_url=ANIMELIST_BASE_URL,
+                           archive_dir=None):
+    """Returns list of animelist data dicts for users whose animelists changed.
+
+    Animelists are rendered with JavaScript in chromedriver, which can't send
+    conditional requests, so they are always loaded and only the hashes are
+    used to skip parsing and unchanged users. Animelists that are private,
+    timed out or empty (see parse.get_animelist_outcome) are left out of the
+    delta, since they would otherwise replace the user's scores with nothing.
+
+    Args:
+        user_ids: MyAnimeList user IDs to refresh.
+        fetch_state: Dict mapping URL to validators and hashes. Updated in place.
+        base_url: Base URL of animelists.
+        archive_dir: If given, loaded pages are appended to the page archive.
+    """
+    # Imported here because importing scrape starts a Chrome driver, which
+    # refreshing anime pages doesn't need
+    from src import scrape
+    changed_animelist_data = []
+    for user_id in user_ids:
+        url = base_url + user_id
+        try:
+            html = scrape.fetch_html_selenium(url, scrape.driver, archive_dir)
+        except scrape.WebDriverException as e:
+            print(f'Could not load {url}: {e}')
+            telemetry.record_page('animelist', 'error')
+            continue
+        fetch_state.setdefault(url, {})['fetched_at'] = time.time()
+        animelist_data = update_if_changed(
+            url, html, fetch_state,
+            lambda soup: parse.create_animelist_data(user_id, url, soup),
+            parse.get_animelist_outcome)
+        if animelist_data:
+            changed_animelist_data.append(animelist_data)
+    return changed_animelist_data
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Incrementally refresh scraped data.')
+    arg_parser.add_argument('--state', required=True, help='Path of the pickled fetch state.')
+    arg_parser.add_argument('--delta-out', required=True,
+                            help='Path to pickle the delta of changed anime and users to.')
+    arg_parser.add_argument('--anime-ids', help='Pickled list of MyAnimeList anime IDs.')
+    arg_parser.add_argument('--user-ids',
+                            help='User ID store of scraped users (see '
+                                 'scrape.discover_mal_user_ids), one ID per line.')
+    arg_parser.add_argument('--anime-base-url', default=ANIME_BASE_URL)
+    arg_parser.add_argument('--archive', help='Directory of the page archive.')
+    args = arg_parser.parse_args()
+
+    fetch_state = load_fetch_state(args.state)
+    delta = {'anime': [], 'animelists': []}
+    if args.anime_ids:
+        with open(args.anime_ids, 'rb') as read_file:
+            mal_ids = pickle.load(read_file)
+        delta['anime'] = refresh_anime_data(mal_ids, fetch_state, args.anime_base_url,
+                                            args.archive)
+    if args.user_ids:
+        # Imported here for the same reason as in refresh_animelist_data
+        from src import scrape
+        user_ids = sorted(scrape.load_user_id_store(args.user_ids))
+        delta['animelists'] = refresh_animelist_data(user_ids, fetch_state,
+                                                     archive_dir=args.archive)
+    with open(args.delta_out, 'wb') as to_write:
+        pickle.dump(delta, to_write)
+    # Only save the new fetch state once the delta is saved; otherwise an
+    # interrupted refresh would mark changes as seen that never reached a delta
+    save_fetch_state(fetch_state, args.state)
+    print(f"{len(delta['anime'])} anime and {len(delta['animelists'])} animelists changed")
+    counters = telemetry.get_metrics()['counters']
+    for kind in ['anime', 'animelist']:
+        skipped = {outcome: counters[f'pages.{kind}.{outcome}'] for outcome in telemetry.OUTCOMES
+                   if outcome != 'ok' and f'pages.{kind}.{outcome}' in counters}
+        if skipped:
+            print(f'Skipped {kind} pages: {skipped}')
+
+
+if __name__ == '__main__':
+    main()
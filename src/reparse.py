@@ -0,0 +1,133 @@
+"""This script re-parses the raw page archive into the same pickled chunks the
+scrapers produce, without touching the network.
+
+Usage (from the repo root):
+    python -m src.reparse ../archive ../pickles/reparsed --n-jobs 8
+
+Use this after fixing a parser in parse.py instead of rescraping. Shards are
+parsed in parallel over a process pool. If a URL was fetched more than once,
+only the most recent fetch is kept.
+"""
+
+import argparse
+import os
+import pickle
+from joblib import Parallel, delayed
+from src import archive, parse
+
+ANIMELIST_URL_PART = '/animelist/'
+ANIME_URL_PART = '/anime/'
+
+
+def parse_record(record):
+    """Returns (kind, data) for an archived page, where kind is 'animelist' or
+    'anime', or None for pages that are not animelists or anime pages.
+
+    Args:
+        record: Archive record with url, fetched_at and html.
+    """
+    url = record['url']
+    if ANIMELIST_URL_PART in url:
+        user_id = url.split(ANIMELIST_URL_PART, 1)[1]
+        soup = parse.create_page_soup(record['html'])
+        return 'animelist', parse.create_animelist_data(user_id, url, soup)
+    if ANIME_URL_PART in url:
+        mal_id = int(url.split(ANIME_URL_PART, 1)[1].split('/')[0])
+        soup = parse.create_page_soup(record['html'])
+        return 'anime', parse.create_anime_data(mal_id, url, soup)
+    return None
+
+
+def parse_shard(shard_path):
+    """Returns (parsed_pages, num_corrupt): list of (url, fetched_at, kind, data)
+    for pages in a shard, and the number of corrupt records skipped.
+
+    Args:
+        shard_path: Path of an archive shard file.
+    """
+    parsed_pages = []
+    counts = {}
+    for record in archive.iter_shard(shard_path, counts):
+        parsed = parse_record(record)
+        if parsed:
+            parsed_pages.append((record['url'], record['fetched_at']) + parsed)
+    return parsed_pages, counts.get('corrupt_records', 0)
+
+
+def keep_latest(parsed_shards):
+    """Returns dict mapping kind to list of data for the latest fetch of each URL,
+    in the order the pages were fetched.
+
+    Args:
+        parsed_shards: List of the parsed_pages lists of parse_shard.
+    """
+    latest = {}
+    for parsed_pages in parsed_shards:
+        for url, fetched_at, kind, data in parsed_pages:
+            if url not in latest or fetched_at > latest[url][0]:
+                latest[url] = (fetched_at, kind, data)
+    data_by_kind = {'animelist': [], 'anime': []}
+    for _, kind, data in sorted(latest.values(), key=lambda page: page[0]):
+        data_by_kind[kind].append(data)
+    return data_by_kind
+
+
+def write_chunks(data_list, out_dir, prefix, chunk_size):
+    """Pickles data_list in chunks named {prefix}_{i}.pkl and returns the
+    number of chunks written.
+
+    Args:
+        data_list: List of animelist or anime data dicts.
+        out_dir: Directory to write the chunks to.
+        prefix: File name prefix of the chunks.
+        chunk_size: Number of dicts per chunk.
+    """
+    num_chunks = 0
+    for i in range(0, len(data_list), chunk_size):
+        with open(os.path.join(out_dir, f'{prefix}_{num_chunks}.pkl'), 'wb') as to_write:
+            pickle.dump(data_list[i:i+chunk_size], to_write)
+        num_chunks += 1
+    return num_chunks
+
+
+def reparse_archive(archive_dir, out_dir, n_jobs=-1, chunk_size=100):
+    """Re-parses every page in the archive and writes the structured chunks.
+
+    Animelists are written as animelist_data_100_{i}.pkl chunks like the
+    scraping loop in anime_recommender.py, and anime data as a single
+    top_anime_data.pkl list.
+
+    Args:
+        archive_dir: Directory of the page archive.
+        out_dir: Directory to write the pickles to.
+        n_jobs: Number of worker processes (-1 uses all cores).
+        chunk_size: Number of animelists per chunk.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shard_results = Parallel(n_jobs=n_jobs, verbose=5)(
+        delayed(parse_shard)(shard_path)
+        for shard_path in archive.get_shard_paths(archive_dir))
+    data_by_kind = keep_latest([parsed_pages for parsed_pages, _ in shard_results])
+    num_chunks = write_chunks(data_by_kind['animelist'], out_dir,
+                              f'animelist_data_{chunk_size}', chunk_size)
+    with open(os.path.join(out_dir, 'top_anime_data.pkl'), 'wb') as to_write:
+        pickle.dump(data_by_kind['anime'], to_write)
+    num_corrupt = sum(num_corrupt for _, num_corrupt in shard_results)
+    print(f"{len(data_by_kind['animelist'])} animelists in {num_chunks} chunks, "
+          f"{len(data_by_kind['anime'])} anime, {num_corrupt} corrupt records skipped")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('archive_dir', help='Directory of the page archive.')
+    arg_parser.add_argument('out_dir', help='Directory to write the pickles to.')
+    arg_parser.add_argument('--n-jobs', type=int, default=-1,
+                            help='Number of worker processes (-1 uses all cores).')
+    arg_parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Number of animelists per pickled chunk.')
+    args = arg_parser.parse_args()
+    reparse_archive(args.archive_dir, args.out_dir, args.n_jobs, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@
 import random
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from bs4 import BeautifulSoup
 from jikanpy import Jikan
 import requests
@@ -12,7 +13,8 @@ from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from src import archive, parse, telemetry
 
 
 # Define Chrome browser options
@@ -30,18 +32,42 @@ chrome_options.add_argument("--no-sandbox")
 driver = webdriver.Chrome(options=chrome_options)
 
 
-def create_soup(url):
-    """Returns BeautifulSoup object for given URL."""
+def fetch_html(url, archive_dir=None):
+    """Returns the raw HTML for given URL.
+
+    Args:
+        url: URL to fetch.
+        archive_dir: If given, the raw HTML is also appended to the page
+            archive in this directory (see archive.py).
+    """
     ua = UserAgent()
     user_agent = {'User-agent': ua.random}
-    response_text = requests.get(url, headers=user_agent).text
-    soup = BeautifulSoup(response_text, 'html5lib')
+    kind = telemetry.get_page_kind(url)
+    with telemetry.timer(f'fetch_seconds.{kind}'):
+        response = requests.get(url, headers=user_agent)
+    telemetry.increment(f'bytes.{kind}', len(response.content))
+    response_text = response.text
+    if archive_dir:
+        archive.append_page(archive_dir, url, response_text)
+    return response_text
+
+
+def create_soup(url, archive_dir=None):
+    """Returns BeautifulSoup object for given URL."""
+    html = fetch_html(url, archive_dir)
+    with telemetry.timer(f'parse_seconds.{telemetry.get_page_kind(url)}'):
+        soup = BeautifulSoup(html, 'html5lib')
     return soup
 
 
-def create_soup_selenium(url, driver=driver):
-    """Returns BeautifulSoup object for given URL by using Selenium to load
-    the webpage in chromedriver and extract the HTML."""
+def fetch_html_selenium(url, driver=driver, archive_dir=None):
+    """Returns the page source for given URL by using Selenium to load
+    the webpage in chromedriver.
+
+    If archive_dir is given, the page source is also appended to the page
+    archive in that directory (see archive.py)."""
+    kind = telemetry.get_page_kind(url)
+    start = time.perf_counter()
     driver.get(url)
     # time.sleep gives time for the webpage to fully load
     # and then I can extract the HTML
@@ -49,260 +75,80 @@ def create_soup_selenium(url, driver=driver):
     # Wait for the 'table' element to appear on
     # the page before extracting the HTML
     try:
-        # Wait until the page is loaded before returning the soup
+        # Wait until the page is loaded before returning the HTML
         WebDriverWait(driver, 5) \
             .until(expected_conditions.visibility_of_element_located((By.TAG_NAME, 'table')))
-        soup = BeautifulSoup(driver.page_source, 'html5lib')
-        return soup
     # If TimeoutException, means the animelist is restricted and so will
-    # return the soup without confirming there is a 'table' element
+    # return the HTML without confirming there is a 'table' element
     except TimeoutException:
         # print("""It's possible that the anime list is restricted or
         # the page is not loading for some reason.
         # Will return the soup and move on.""")
-        soup = BeautifulSoup(driver.page_source, 'html5lib')
-        return soup
+        telemetry.increment(f'timeouts.{kind}')
         # try:
         #     # If 'badresult' class exists, means the anime list is private
         #     # and cannot be accessed. Will return soup as is.
         #     if driver.find_element_by_class_name('badresult'):        #
         # except NoSuchElementException:
         #     driver.refresh()
+    page_source = driver.page_source
+    # Fetch time includes the fixed sleep and the wait for the table
+    telemetry.observe(f'fetch_seconds.{kind}', time.perf_counter() - start)
+    telemetry.increment(f'bytes.{kind}', len(page_source.encode('utf-8')))
+    if archive_dir:
+        archive.append_page(archive_dir, url, page_source)
+    return page_source
 
 
-def get_animelist_data(user_id):
-    """Returns dictionary of key data from user's animelist."""
+def create_soup_selenium(url, driver=driver, archive_dir=None):
+    """Returns BeautifulSoup object for given URL by using Selenium to load
+    the webpage in chromedriver and extract the HTML.
+
+    If archive_dir is given, the page source is also appended to the page
+    archive in that directory (see archive.py)."""
+    html = fetch_html_selenium(url, driver, archive_dir)
+    with telemetry.timer(f'parse_seconds.{telemetry.get_page_kind(url)}'):
+        soup = parse.create_page_soup(html)
+    return soup
+
+
+def get_animelist_data(user_id, archive_dir=None):
+    """Returns dictionary of key data from user's animelist.
+
+    Args:
+        user_id: MyAnimeList user ID.
+        archive_dir: If given, the raw page is also appended to the page
+            archive in this directory.
+    """
     BASE_URL = 'https://myanimelist.net/animelist/'
     url = BASE_URL + user_id
-    soup = create_soup_selenium(url, driver)
-    animelist_data = {
-        'user_id': user_id,
-        'animelist_url': url,
-        'animelist_titles': get_animelist_titles(soup),
-        'animelist_scores': get_animelist_scores(soup)
-    }
+    html = fetch_html_selenium(url, driver, archive_dir)
+    with telemetry.timer('parse_seconds.animelist'):
+        soup = parse.create_page_soup(html)
+        animelist_data = parse.create_animelist_data(user_id, url, soup)
+    telemetry.record_page('animelist', parse.get_animelist_outcome(soup, animelist_data))
     return animelist_data
 
 
-def get_animelist_titles(soup):
-    """Returns list of all anime titles in user's animelist."""
-    if soup.find_all('tbody', class_='list-item'):
-        animelist_titles = []
-        for element in soup.find_all('tbody', class_='list-item'):
-            # Making sure that the element exists before appending
-            if element.find(class_='data title clearfix'):
-                if element.find(class_='data title clearfix').find(class_='link sort'):
-                    animelist_title = element.find(class_='data title clearfix') \
-                        .find(class_='link sort').text
-                    animelist_titles.append(animelist_title)
-        return animelist_titles
-
-
-def get_animelist_scores(soup):
-    """Returns list of all anime ratings in user's animelist."""
-    if soup.find_all('tbody', class_='list-item'):
-        animelist_scores = []
-        for element in soup.find_all('tbody', class_='list-item'):
-            # Making sure that the element exists before appending
-            if element.find(class_='data score'):
-                if element.find(class_='data score').text:
-                    animelist_score = element.find(class_='data score').text.strip()
-                    animelist_scores.append(animelist_score)
-        return animelist_scores
-
-
-def get_anime_data(mal_id):
-    """Returns dictionary of key data for anime."""
+def get_anime_data(mal_id, archive_dir=None):
+    """Returns dictionary of key data for anime.
+
+    Args:
+        mal_id: MyAnimeList anime ID.
+        archive_dir: If given, the raw page is also appended to the page
+            archive in this directory.
+    """
     BASE_URL = 'https://myanimelist.net/anime/'
     url = BASE_URL + str(mal_id)
-    soup = create_soup(url)
+    html = fetch_html(url, archive_dir)
+    with telemetry.timer('parse_seconds.anime'):
+        soup = parse.create_page_soup(html)
+        anime_data = parse.create_anime_data(mal_id, url, soup)
+    telemetry.record_page('anime', 'ok' if anime_data['title_main'] else 'empty')
     time.sleep(0.5+2*random.random())
-    anime_data = {
-        'mal_id': mal_id,
-        'url': url,
-        'image_url': get_image_url(soup),
-        'trailer_url': get_trailer_url(soup),
-        'title_main': get_title_main(soup),
-        'title_english': get_title_english(soup),
-        'media_type': get_media_type(soup),
-        'source_material': get_source_material(soup),
-        'num_episodes': get_num_episodes(soup),
-        'airing_status': get_airing_status(soup),
-        'aired_dates': get_aired_dates(soup),
-        'premiered': get_premiered(soup),
-        'duration': get_duration(soup),
-        'content_rating': get_content_rating(soup),
-        'genres': get_genres(soup),
-        'score': get_score(soup),
-        'scored_by_num_users': get_scored_by_num_users(soup),
-        'rank_score': get_rank_score(soup),
-        'rank_popularity': get_rank_popularity(soup),
-        'members': get_members(soup),
-        'favorites': get_favorites(soup),
-        'studios': get_studios(soup),
-        'producers': get_producers(soup),
-        'licensors': get_licensors(soup)
-    }
     return anime_data
 
 
-def get_image_url(soup):
-    if soup.find('img', itemprop='image'):
-        image_url = soup.find('img', itemprop='image').get('data-src')
-        return image_url
-
-
-def get_trailer_url(soup):
-    if soup.find(class_='iframe js-fancybox-video video-unit promotion'):
-        trailer_url = soup.find(class_= \
-            'iframe js-fancybox-video video-unit promotion').get('href')
-        return trailer_url
-
-
-def get_title_main(soup):
-    if soup.find(class_='title-name'):
-        title_main = soup.find(class_='title-name').text
-        return title_main
-
-
-def get_title_english(soup):
-    if soup.find('span', text='English:'):
-        raw_text = soup.find('span', text='English:').findParent().text
-        # Clean raw text to extract the English title
-        title_english = raw_text.strip().replace('English: ', '')
-        return title_english
-
-
-def get_media_type(soup):
-    if soup.find('span', text='Type:'):
-        media_type = soup.find('span', text='Type:').findNext().text
-        return media_type
-
-
-def get_source_material(soup):
-    if soup.find('span', text='Source:'):
-        raw_text = soup.find('span', text='Source:').findParent().text
-        # Clean raw text
-        source_material = raw_text.strip().replace('Source:', '').strip()
-        return source_material
-
-
-def get_num_episodes(soup):
-    if soup.find('span', text='Episodes:'):
-        raw_text = soup.find('span', text='Episodes:').findParent().text
-        # Clean raw text
-        num_episodes = raw_text.strip().replace('Episodes:', '').strip()
-        return num_episodes
-
-
-def get_airing_status(soup):
-    if soup.find('span', text='Status:'):
-        raw_text = soup.find('span', text='Status:').findParent().text
-        # Clean raw text
-        airing_status = raw_text.strip().replace('Status:', '').strip()
-        return airing_status
-
-
-def get_aired_dates(soup):
-    if soup.find('span', text='Aired:'):
-        raw_text = soup.find('span', text='Aired:').findParent().text
-        # Clean raw text
-        aired_dates = raw_text.strip().replace('Aired:', '').strip()
-        return aired_dates
-
-
-def get_premiered(soup):
-    if soup.find('span', text='Premiered:'):
-        premiered = soup.find('span', text='Premiered:').findNext().text
-        return premiered
-
-
-def get_duration(soup):
-    if soup.find('span', text='Duration:'):
-        raw_text = soup.find('span', text='Duration:').findParent().text
-        # Clean raw text
-        duration = raw_text.strip().replace('Duration:', '').strip()
-        return duration
-
-
-def get_content_rating(soup):
-    if soup.find('span', text='Rating:'):
-        raw_text = soup.find('span', text='Rating:').findParent().text
-        # Clean raw text
-        content_rating = raw_text.strip().replace('Rating:', '').strip()
-        return content_rating
-
-
-def get_genres(soup):
-    if soup.find('span', text='Genres:'):
-        genres = [element.text for element in \
-            soup.find('span', text='Genres:').findParent().find_all('a')]
-        return genres
-
-
-def get_score(soup):
-    if soup.find('span', itemprop='ratingValue'):
-        score = soup.find('span', itemprop='ratingValue').text
-        return score
-
-
-def get_scored_by_num_users(soup):
-    if soup.find('span', itemprop='ratingCount'):
-        scored_by_num_users = soup.find('span', itemprop='ratingCount').text
-        return scored_by_num_users
-
-
-def get_rank_score(soup):
-    if soup.find('span', text='Ranked:'):
-        rank_score = soup.find('span', text='Ranked:').findParent() \
-            .find(text=re.compile('#')).strip()
-        return rank_score
-
-
-def get_rank_popularity(soup):
-    if soup.find('span', text='Popularity:'):
-        rank_popularity = soup.find('span', text='Popularity:').findParent() \
-            .find(text=re.compile('#')).strip()
-        return rank_popularity
-
-
-def get_members(soup):
-    if soup.find('span', text='Members:'):
-        raw_text = soup.find('span', text='Members:').findParent().text
-        # Clean raw text
-        members = raw_text.strip().replace('Members:', '').strip()
-        return members
-
-
-def get_favorites(soup):
-    if soup.find('span', text='Favorites:'):
-        raw_text = soup.find('span', text='Favorites:').findParent().text
-        # Clean raw text
-        favorites = raw_text.strip().replace('Favorites:', '').strip()
-        return favorites
-
-
-def get_studios(soup):
-    if soup.find('span', text='Studios:'):
-        studios = [element.text for element in \
-            soup.find('span', text='Studios:').findParent().find_all('a')]
-        return studios
-
-
-def get_producers(soup):
-    if soup.find('span', text='Producers:'):
-        producers = [element.text for element in \
-            soup.find('span', text='Producers:').findParent().find_all('a')]
-        return producers
-
-
-def get_licensors(soup):
-    if soup.find('span', text='Licensors:'):
-        licensors = [element.text for element in \
-            soup.find('span', text='Licensors:').findParent().find_all('a')]
-        return licensors
-
-
 def get_mal_user_ids_urls(base_url, num_users=240):
     """Returns list of MyAnimeList URLs containing user IDs.
 
@@ -318,6 +164,17 @@ def get_mal_user_ids_urls(base_url, num_users=240):
     return urls_list
 
 
+def parse_mal_user_ids(soup):
+    """Returns list of MyAnimeList user IDs on a users.php page.
+
+    Args:
+        soup: BeautifulSoup object of a users.php page.
+    """
+    # "if element.text" removes any cases where the href does not contain the user's ID
+    return [element.text for element in soup.find_all(href=re.compile('/profile/'))
+            if element.text]
+
+
 def get_mal_user_ids(urls):
     """Returns list of MyAnimeList user IDs.
 
@@ -330,13 +187,89 @@ def get_mal_user_ids(urls):
         page_counter += 1
         print(page_counter)
         soup = create_soup(url)
-        for element in soup.find_all(href=re.compile('/profile/')):
-            # "if element.text" removes any cases where the href does not contain the user's ID
-            if element.text:
-                user_ids.append(element.text)
+        user_ids += parse_mal_user_ids(soup)
     return user_ids
 
 
+def load_user_id_store(store_path):
+    """Returns set of user IDs already scraped in previous runs.
+
+    Args:
+        store_path: Path of the user ID store (a text file with one ID per line).
+    """
+    try:
+        with open(store_path) as read_file:
+            return {line.rstrip('\n') for line in read_file if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def add_to_user_id_store(store_path, user_ids):
+    """Appends user IDs to the user ID store. Call it only once their animelists
+    are saved, so that IDs of a crashed run are scraped again by the next one.
+
+    Args:
+        store_path: Path of the user ID store (a text file with one ID per line).
+        user_ids: List of user IDs.
+    """
+    with open(store_path, 'a') as store:
+        store.writelines(user_id + '\n' for user_id in user_ids)
+
+
+def discover_mal_user_ids(urls, store_path, id_queue, max_workers=4, archive_dir=None):
+    """Fetches users.php pages concurrently and streams user IDs that haven't
+    been seen before onto id_queue, followed by None when all pages are done.
+
+    IDs are deduplicated against the IDs in the store and the ones already
+    queued in this run. The store itself isn't written here: the consumer adds
+    each chunk of IDs with add_to_user_id_store after saving their animelists,
+    so later runs only queue users that haven't been scraped. Meant to run in a
+    background thread while the queue is consumed by the animelist scraper (see
+    iter_queue_chunks).
+
+    Args:
+        urls: List of MyAnimeList URLs containing user IDs.
+        store_path: Path of the user ID store (a text file with one ID per line).
+        id_queue: queue.Queue that new user IDs are put on.
+        max_workers: Maximum number of pages fetched at once.
+        archive_dir: If given, raw pages are appended to the page archive.
+    """
+    seen_user_ids = load_user_id_store(store_path)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(create_soup, url, archive_dir) for url in urls]
+            for future in as_completed(futures):
+                page_user_ids = parse_mal_user_ids(future.result())
+                telemetry.record_page('users', 'ok' if page_user_ids else 'empty')
+                for user_id in page_user_ids:
+                    if user_id not in seen_user_ids:
+                        seen_user_ids.add(user_id)
+                        id_queue.put(user_id)
+    finally:
+        # Always tell the consumer discovery is over, even if a page failed
+        id_queue.put(None)
+
+
+def iter_queue_chunks(id_queue, chunk_size=100):
+    """Yields lists of up to chunk_size IDs from id_queue until None is received.
+
+    Args:
+        id_queue: queue.Queue filled by discover_mal_user_ids.
+        chunk_size: Number of IDs per chunk.
+    """
+    chunk = []
+    while True:
+        user_id = id_queue.get()
+        if user_id is None:
+            break
+        chunk.append(user_id)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_top_anime_mal_ids(num_top_anime=1000):
     """Returns list of MyAnimeList anime IDs for anime listed on top anime pages.
 
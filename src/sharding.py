@@ -0,0 +1,93 @@
+"""This module splits a serving bundle into user shards.
+
+Per-user arrays (candidates and the CSR seen sets) grow with the number of
+users, so with NUM_SHARDS > 1 anime_recommender.py gives each shard only the
+users that hash to it. The anime-side arrays (components, anime features, IVF
+indexes, neighbour table) are small and copied to every shard. Each shard is
+published under its own artifact root, e.g. ../artifacts/shard-0, and served by
+its own serve.py, with flask/router.py forwarding each request to the shard
+that owns its user.
+
+get_shard must give the same answer as get_shard in
+flask/recommendation/sharding.py, which the router uses.
+"""
+
+import os
+import zlib
+
+import numpy as np
+
+from src import artifacts, prefix_index
+
+# Arrays with one row per user (or a CSR indptr/indices pair over users)
+USER_ROW_ARRAYS = ['collab_candidates', 'content_candidates']
+USER_CSR_ARRAYS = [('scored_indptr', 'scored_indices'), ('history_indptr', 'history_indices')]
+
+
+def get_shard(user_id, num_shards):
+    """Returns the shard of a user ID. Uses CRC-32 rather than hash(), which
+    changes between Python processes."""
+    return zlib.crc32(str(user_id).encode('utf-8')) % num_shards
+
+
+def get_shard_root(artifact_root, shard):
+    """Returns the artifact root of a shard."""
+    return os.path.join(artifact_root, f'shard-{shard}')
+
+
+def get_csr_rows(indptr, indices, rows):
+    """Returns (indptr, indices) of the given rows of a CSR (indptr, indices)
+    pair."""
+    counts = indptr[rows + 1] - indptr[rows]
+    new_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(indptr.dtype)
+    # Position in indices of every kept entry, without a loop over rows
+    positions = np.repeat(indptr[rows] - new_indptr[:-1], counts) + np.arange(new_indptr[-1])
+    return new_indptr, indices[positions]
+
+
+def split_bundle(arrays, ids, num_shards):
+    """Returns list of (arrays, ids) for each shard.
+
+    Args:
+        arrays: Dict of serving arrays from artifacts.create_serving_arrays.
+        ids: Dict from artifacts.create_serving_ids.
+        num_shards: Number of shards.
+    """
+    user_shards = np.array([get_shard(user_id, num_shards) for user_id in ids['user_ids']],
+                           dtype=np.int64)
+    shard_bundles = []
+    for shard in range(num_shards):
+        rows = np.flatnonzero(user_shards == shard)
+        shard_arrays = dict(arrays)
+        for name in USER_ROW_ARRAYS:
+            shard_arrays[name] = arrays[name][rows]
+        for indptr_name, indices_name in USER_CSR_ARRAYS:
+            shard_arrays[indptr_name], shard_arrays[indices_name] = get_csr_rows(
+                arrays[indptr_name], arrays[indices_name], rows)
+        shard_ids = dict(ids)
+        shard_ids['user_ids'] = [ids['user_ids'][row] for row in rows]
+        # The user ID prefix index points at rows, so each shard gets its own
+        if 'user_prefix_keys' in arrays:
+            shard_arrays.update(prefix_index.create_user_prefix_arrays(shard_ids['user_ids']))
+        shard_bundles.append((shard_arrays, shard_ids))
+    return shard_bundles
+
+
+def publish_sharded_bundles(artifact_root, arrays, ids, num_shards, version=None):
+    """Publishes each shard of a bundle as a new version under its shard's
+    artifact root. Returns the version, which is the same for every shard.
+
+    Args:
+        artifact_root: Directory holding the shard-<n> artifact roots.
+        arrays: Dict of serving arrays from artifacts.create_serving_arrays.
+        ids: Dict from artifacts.create_serving_ids.
+        num_shards: Number of shards.
+        version: Version name. Defaults to artifacts.create_version().
+    """
+    version = version or artifacts.create_version()
+    for shard, (shard_arrays, shard_ids) in enumerate(split_bundle(arrays, ids, num_shards)):
+        shard_root = get_shard_root(artifact_root, shard)
+        os.makedirs(shard_root, exist_ok=True)
+        artifacts.publish_bundle(shard_root, shard_arrays, shard_ids, version,
+                                 shard={'index': shard, 'num_shards': num_shards})
+    return version
@@ -0,0 +1,366 @@
+"""This module sweeps the NMF n_components and max_iter and the content feature
+set of anime_recommender.py across a process pool, instead of editing the
+constants and rerunning the whole script for each combination.
+
+The user-rating matrix is split like src/evaluation.py does (held-out ratings
+for ranking metrics) and the training, test and animelist matrices are copied
+once into shared memory blocks. Each worker rebuilds them as CSR matrices over
+those blocks, so no worker gets its own copy of the data, whatever the start
+method (with spawn or forkserver, arguments to workers are pickled).
+
+Configs are drawn from the grid (or --num-random of them at random) and
+grouped by n_components: with the same random_state, a fit to 500 iterations
+passes through the fit to 200 iterations, so each n_components is fitted once
+in chunks, warm-started from the previous chunk, and snapshotted at every
+max_iter of the sweep. sklearn checks convergence relative to the first
+iteration of each call, so a chunked fit can run a few more iterations than a
+single fit before it counts as converged; n_iter records how many ran. The
+feature set only changes the content-based filter, so every feature set of a
+snapshot reuses its fit.
+
+For each config, the results table records the fit time and iterations up to
+the snapshot, the relative reconstruction error ||X - WH||_F / ||X||_F on the
+training ratings, the peak memory of the fit and NDCG@k of the collaborative,
+content-based and fused recommendations (see src/evaluation.py). tracemalloc
+slows down every allocation, so the peak memory comes from a separate, untimed
+fit of MEMORY_PASS_ITER iterations; the solver's working memory doesn't grow
+with the number of iterations. The shared matrix is not part of it.
+
+Every --check-every iterations, each fit compares its reconstruction error with
+its own error at the previous check. More components always reconstruct
+better, so errors are only compared within the same n_components. A fit that
+improved by less than --min-improvement (relative) is stopped, since more
+iterations would give clearly no better model, and its remaining configs are
+recorded with stopped_early and no ranking metrics. Use --min-improvement 0 to
+turn early stopping off.
+
+Usage (from the repo root):
+    python -m src.sweep ../pickles/nmf_state.pkl ../artifacts \\
+        --n-components 4,6,8,12 --max-iter 100,200,500 --output ../sweep_results.csv
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+import tracemalloc
+import warnings
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.decomposition import NMF
+from sklearn.exceptions import ConvergenceWarning
+
+from src import evaluation, nmf_update
+
+FEATURE_SETS = ('raw', 'scaled', 'binary')
+
+# Iterations of the untimed fit that measures a config's peak memory
+MEMORY_PASS_ITER = 5
+
+# Shared matrices and sweep options of a worker process, set by init_worker
+worker_data = {}
+
+
+def create_feature_sets(anime_features):
+    """Returns dict mapping feature set name to content feature matrix.
+
+    raw: Features as anime_recommender.py builds them. The numeric columns
+        (episodes, score, members, age) aren't scaled, so members dominates
+        cosine similarity.
+    scaled: Numeric columns min-max scaled to [0, 1] like the 0/1 columns.
+    binary: Only the 0/1 columns (genres, media type, content rating and
+        airing status dummies).
+
+    Args:
+        anime_features: Content feature matrix from the serving bundle.
+    """
+    anime_features = np.asarray(anime_features, dtype=float)
+    is_binary = np.isin(anime_features, (0, 1)).all(axis=0)
+    low, high = anime_features.min(axis=0), anime_features.max(axis=0)
+    scaled = np.where(is_binary, anime_features,
+                      (anime_features - low) / np.maximum(high - low, 1e-12))
+    return {'raw': anime_features, 'scaled': scaled, 'binary': anime_features[:, is_binary]}
+
+
+def create_configs(n_components_values, max_iter_values, feature_sets, num_random=None,
+                   seed=4444):
+    """Returns list of (n_components, max_iter, feature_set) configs: the whole
+    grid, or num_random configs drawn from it without replacement."""
+    configs = list(itertools.product(n_components_values, max_iter_values, feature_sets))
+    if num_random is not None and num_random < len(configs):
+        rng = np.random.default_rng(seed)
+        configs = [configs[idx] for idx in sorted(rng.choice(len(configs), num_random,
+                                                             replace=False))]
+    return configs
+
+
+def group_configs(configs):
+    """Returns list of tasks (n_components, dict mapping max_iter to list of
+    feature sets), one per n_components, largest first."""
+    tasks = {}
+    for n_components, max_iter, feature_set in configs:
+        tasks.setdefault(n_components, {}).setdefault(max_iter, []).append(feature_set)
+    return sorted(tasks.items(), reverse=True)
+
+
+def share_csr(matrix, blocks):
+    """Returns spec of a CSR matrix copied into shared memory, for attach_csr.
+
+    Args:
+        matrix: Sparse CSR matrix.
+        blocks: List the new SharedMemory blocks are appended to. The caller
+            closes and unlinks them.
+    """
+    spec = {'shape': matrix.shape, 'arrays': {}}
+    for name in ['data', 'indices', 'indptr']:
+        array = getattr(matrix, name)
+        # Size 0 isn't allowed, e.g. for an empty test matrix
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        spec['arrays'][name] = (block.name, array.shape, array.dtype.str)
+    return spec
+
+
+def attach_csr(spec, blocks):
+    """Returns CSR matrix over the shared memory blocks of a share_csr spec
+    without copying them.
+
+    Args:
+        spec: Spec from share_csr.
+        blocks: List the attached SharedMemory blocks are appended to. They must
+            stay open as long as the matrix is used.
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+    return sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                             shape=spec['shape'], copy=False)
+
+
+def init_worker(specs, feature_sets, options):
+    """Attaches a worker process to the shared matrices.
+
+    Args:
+        specs: Dict mapping matrix name to share_csr spec.
+        feature_sets: Dict from create_feature_sets (small, so it is copied).
+        options: Dict of sweep options (check_every, min_improvement, k,
+            num_candidates, collab_weight, block_size).
+    """
+    worker_data['blocks'] = []
+    worker_data['matrices'] = {name: attach_csr(spec, worker_data['blocks'])
+                               for name, spec in specs.items()}
+    worker_data['feature_sets'] = feature_sets
+    worker_data['options'] = options
+    # Chunks stop at their max_iter on purpose
+    warnings.simplefilter('ignore', ConvergenceWarning)
+
+
+def fit_chunk(matrix, n_components, num_iter, user_embedding=None, components=None):
+    """Returns (user_embedding, components, n_iter) after up to num_iter NMF
+    iterations, starting like evaluation.fit_collab or from a previous chunk."""
+    if user_embedding is None:
+        nmf = NMF(n_components=n_components, max_iter=num_iter, random_state=4444)
+        user_embedding = nmf.fit_transform(matrix)
+    else:
+        nmf = NMF(n_components=n_components, init='custom', max_iter=num_iter,
+                  random_state=4444)
+        user_embedding = nmf.fit_transform(matrix, W=user_embedding, H=components)
+    return user_embedding, nmf.components_, nmf.n_iter_
+
+
+def get_reconstruction_error(matrix, user_embedding, components):
+    """Returns ||X - WH||_F / ||X||_F without forming WH."""
+    return nmf_update.get_reconstruction_error({
+        'user_score_matrix': matrix,
+        'components': components,
+        'wtx': np.asarray(matrix.T @ user_embedding).T,
+        'wtw': user_embedding.T @ user_embedding
+    })
+
+
+def get_peak_memory(matrix, n_components):
+    """Returns peak bytes tracemalloc traces during a fit of MEMORY_PASS_ITER
+    iterations, which is run only to measure it."""
+    tracemalloc.start()
+    try:
+        fit_chunk(matrix, n_components, MEMORY_PASS_ITER)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def is_clearly_worse(previous_error, error, min_improvement):
+    """Returns whether error, at an early stopping check, improved by less than
+    min_improvement (relative) on previous_error, the same fit's error at the
+    previous check (None at the first check)."""
+    if previous_error is None:
+        return False
+    return error > previous_error * (1 - min_improvement)
+
+
+def get_ranking_metrics(user_embedding, components, feature_set):
+    """Returns dict of NDCG@k of the collaborative, content-based and fused
+    recommendations for a fit and a feature set."""
+    matrices = worker_data['matrices']
+    options = worker_data['options']
+    data = evaluation.create_eval_data(
+        matrices['train_matrix'], matrices['test_matrix'], matrices['train_history'],
+        user_embedding, components, worker_data['feature_sets'][feature_set])
+    num_users = matrices['train_matrix'].shape[0]
+    # Workers already use every core, so blocks run one after another
+    block_results = [evaluation.evaluate_block(
+        start, min(start + options['block_size'], num_users), data,
+        [options['collab_weight']], options['k'], options['num_candidates'])
+        for start in range(0, num_users, options['block_size'])]
+    metrics_df = evaluation.summarize_blocks(block_results, options['k']).set_index('model')
+    return {f"{model}_ndcg@{options['k']}": metrics_df.loc[model, f"ndcg@{options['k']}"]
+            for model in ['collab', 'content', 'fused']}
+
+
+def run_task(task):
+    """Returns list of result dicts, one per config of a task from
+    group_configs. Runs in a worker process."""
+    n_components, feature_sets_by_max_iter = task
+    matrix = worker_data['matrices']['train_matrix']
+    options = worker_data['options']
+    check_every = options['check_every']
+    stops = sorted(set(feature_sets_by_max_iter)
+                   | set(range(check_every, max(feature_sets_by_max_iter) + 1, check_every)))
+    user_embedding = components = error = checked_error = None
+    num_iter = 0
+    fit_seconds = 0
+    peak_memory = get_peak_memory(matrix, n_components)
+    converged = stopped_early = False
+    results = []
+    for stop in stops:
+        was_stopped = stopped_early
+        if not (converged or stopped_early):
+            start = time.perf_counter()
+            user_embedding, components, chunk_iter = fit_chunk(
+                matrix, n_components, stop - num_iter, user_embedding, components)
+            fit_seconds += time.perf_counter() - start
+            # Fewer iterations than asked for means the fit met sklearn's tolerance
+            converged = chunk_iter < stop - num_iter
+            num_iter += chunk_iter
+            error = get_reconstruction_error(matrix, user_embedding, components)
+        if stop % check_every == 0 and not stopped_early:
+            stopped_early = is_clearly_worse(checked_error, error,
+                                             options['min_improvement']) and not converged
+            checked_error = error
+        for feature_set in feature_sets_by_max_iter.get(stop, []):
+            result = {
+                'n_components': n_components,
+                'max_iter': stop,
+                'feature_set': feature_set,
+                'n_iter': num_iter,
+                'stopped_early': was_stopped,
+                'fit_seconds': fit_seconds,
+                'reconstruction_error': error,
+                'peak_mib': peak_memory / 2 ** 20
+            }
+            if options['k'] and not was_stopped:
+                result.update(get_ranking_metrics(user_embedding, components, feature_set))
+            results.append(result)
+    return results
+
+
+def sweep(user_score_matrix, anime_features, configs, user_anime_history=None,
+          check_every=50, min_improvement=0.001, k=10, num_candidates=50, collab_weight=1,
+          holdout_fraction=0.2, min_ratings=5, block_size=1024, n_jobs=None, seed=4444):
+    """Returns DataFrame with one row of results per config.
+
+    Args:
+        user_score_matrix: Sparse user-rating matrix.
+        anime_features: Content feature matrix from the serving bundle.
+        configs: List of (n_components, max_iter, feature_set) from create_configs.
+        user_anime_history: Optional sparse animelist matrix, see
+            evaluation.evaluate.
+        check_every: Iterations between early stopping checks.
+        min_improvement: Relative improvement of the error between checks
+            below which a fit is stopped.
+        k: Number of recommendations scored per user (0 for no ranking metrics).
+        num_candidates: Nearest anime considered per filter.
+        collab_weight: Collab weight of the fused recommendations.
+        holdout_fraction: Fraction of each user's ratings held out.
+        min_ratings: Minimum ratings for a user to be tested.
+        block_size: Number of users per evaluation block.
+        n_jobs: Number of worker processes (None for all cores).
+        seed: Random seed of the hold-out split.
+    """
+    train_matrix, test_matrix = evaluation.holdout_split(user_score_matrix, holdout_fraction,
+                                                         min_ratings, seed)
+    train_history = evaluation.get_train_history(train_matrix, test_matrix, user_anime_history)
+    feature_sets = create_feature_sets(anime_features)
+    options = {'check_every': check_every, 'min_improvement': min_improvement, 'k': k,
+               'num_candidates': num_candidates, 'collab_weight': collab_weight,
+               'block_size': block_size}
+    tasks = group_configs(configs)
+    blocks = []
+    results = []
+    try:
+        specs = {'train_matrix': share_csr(train_matrix, blocks),
+                 'test_matrix': share_csr(test_matrix, blocks),
+                 'train_history': share_csr(train_history, blocks)}
+        with multiprocessing.Pool(min(n_jobs or os.cpu_count(), len(tasks)), init_worker,
+                                  (specs, feature_sets, options)) as pool:
+            for task_results in pool.imap_unordered(run_task, tasks):
+                results += task_results
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return pd.DataFrame(results).sort_values(['n_components', 'max_iter', 'feature_set'],
+                                             ignore_index=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Sweep NMF and content feature settings in parallel.')
+    arg_parser.add_argument('state_path', help='Pickled NMF state from anime_recommender.py '
+                                               '(holds the user-rating matrix).')
+    arg_parser.add_argument('artifact_root', help='Artifact root; anime features and '
+                                                  'animelists come from its current version.')
+    arg_parser.add_argument('--n-components', default='4,6,8,12')
+    arg_parser.add_argument('--max-iter', default='100,200,500')
+    arg_parser.add_argument('--feature-sets', default=','.join(FEATURE_SETS),
+                            help=f"Comma-separated subset of {', '.join(FEATURE_SETS)}.")
+    arg_parser.add_argument('--num-random', type=int,
+                            help='Run this many configs drawn at random from the grid.')
+    arg_parser.add_argument('--check-every', type=int, default=50)
+    arg_parser.add_argument('--min-improvement', type=float, default=0.001)
+    arg_parser.add_argument('--k', type=int, default=10, help='0 skips ranking metrics.')
+    arg_parser.add_argument('--holdout-fraction', type=float, default=0.2)
+    arg_parser.add_argument('--n-jobs', type=int)
+    arg_parser.add_argument('--output', help='CSV file to write the results table to.')
+    args = arg_parser.parse_args()
+
+    feature_sets = args.feature_sets.split(',')
+    unknown = set(feature_sets) - set(FEATURE_SETS)
+    if unknown:
+        arg_parser.error(f"unknown feature sets: {', '.join(sorted(unknown))}")
+    configs = create_configs([int(value) for value in args.n_components.split(',')],
+                             [int(value) for value in args.max_iter.split(',')],
+                             feature_sets, args.num_random)
+    user_score_matrix, anime_features, user_anime_history = evaluation.load_inputs(
+        args.state_path, args.artifact_root)
+
+    start = time.perf_counter()
+    results_df = sweep(user_score_matrix, anime_features, configs, user_anime_history,
+                       args.check_every, args.min_improvement, args.k,
+                       holdout_fraction=args.holdout_fraction, n_jobs=args.n_jobs)
+    print(results_df.to_string(index=False, float_format='{:.4f}'.format))
+    print(f'Swept {len(configs)} configs on {user_score_matrix.shape[0]} users in '
+          f'{time.perf_counter() - start:.1f} s')
+    if args.output:
+        results_df.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
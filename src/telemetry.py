@@ -0,0 +1,196 @@
+"""This module contains lightweight instrumentation for the scrapers.
+
+Each process keeps its own latency histograms (fetch and parse time per page
+kind) and counters (page outcomes, timeouts and bytes transferred). If the
+environment variable SCRAPE_METRICS_DIR is set, every recorded page also
+rewrites this process's snapshot to SCRAPE_METRICS_DIR/metrics-{pid}.json.
+Set it before starting Parallel so joblib workers inherit it.
+
+To summarize the snapshots of all workers (from the repo root):
+    python -m src.telemetry ../metrics
+"""
+
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR_ENV = 'SCRAPE_METRICS_DIR'
+
+# Upper bounds (seconds) of the latency histogram buckets. The last bucket
+# catches everything slower.
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Page outcomes recorded by the scrapers. 'error' is a page that couldn't be
+# fetched at all.
+OUTCOMES = ['ok', 'private', 'timeout', 'empty', 'error']
+
+_started_at = time.time()
+_histograms = {}
+_counters = {}
+# Discovery fetches pages from a thread pool, so updates need a lock
+_lock = threading.Lock()
+
+
+def get_page_kind(url):
+    """Returns the kind of MyAnimeList page a URL points to, used to label metrics."""
+    if '/animelist/' in url:
+        return 'animelist'
+    if '/anime/' in url:
+        return 'anime'
+    if 'users.php' in url:
+        return 'users'
+    return 'other'
+
+
+def observe(name, seconds):
+    """Adds a latency observation to the histogram called name.
+
+    Args:
+        name: Histogram name, e.g. 'fetch_seconds.animelist'.
+        seconds: Observed latency in seconds.
+    """
+    with _lock:
+        histogram = _histograms.setdefault(
+            name, {'buckets': [0]*(len(LATENCY_BUCKETS)+1), 'count': 0, 'sum': 0.0})
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+
+def increment(name, amount=1):
+    """Adds amount to the counter called name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def timer(name):
+    """Context manager that records the time spent inside it in histogram name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def record_page(kind, outcome):
+    """Records the outcome of a scraped page, then exports metrics.
+
+    Args:
+        kind: Page kind, e.g. 'animelist', 'anime' or 'users'.
+        outcome: One of OUTCOMES.
+    """
+    increment(f'pages.{kind}.{outcome}')
+    export_metrics()
+
+
+def get_metrics():
+    """Returns snapshot dict of this process's metrics."""
+    elapsed = time.time() - _started_at
+    with _lock:
+        # Copies, so other threads can keep recording while the snapshot is written
+        histograms = json.loads(json.dumps(_histograms))
+        counters = dict(_counters)
+    num_pages = sum(value for name, value in counters.items() if name.startswith('pages.'))
+    return {
+        'pid': os.getpid(),
+        'started_at': _started_at,
+        'elapsed_seconds': elapsed,
+        'pages_per_second': num_pages / elapsed if elapsed else 0.0,
+        'latency_buckets': LATENCY_BUCKETS,
+        'histograms': histograms,
+        'counters': counters
+    }
+
+
+def export_metrics(metrics_dir=None):
+    """Writes this process's snapshot to metrics_dir/metrics-{pid}.json.
+
+    Does nothing if metrics_dir is None and SCRAPE_METRICS_DIR is not set.
+
+    Args:
+        metrics_dir: Directory to write to. Defaults to SCRAPE_METRICS_DIR.
+    """
+    metrics_dir = metrics_dir or os.environ.get(METRICS_DIR_ENV)
+    if not metrics_dir:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f'metrics-{os.getpid()}.json')
+    # Write to a temporary file first so readers never see a half-written
+    # snapshot. Each thread uses its own, since threads export concurrently.
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as to_write:
+        json.dump(get_metrics(), to_write)
+    os.replace(tmp_path, path)
+
+
+def load_metrics(metrics_dir):
+    """Returns list of the worker snapshots in metrics_dir."""
+    snapshots = []
+    for file_name in sorted(os.listdir(metrics_dir)):
+        if file_name.startswith('metrics-') and file_name.endswith('.json'):
+            with open(os.path.join(metrics_dir, file_name)) as read_file:
+                snapshots.append(json.load(read_file))
+    return snapshots
+
+
+def estimate_percentile(histogram, percentile):
+    """Returns the upper bound of the bucket containing the given percentile
+    (inf if it falls in the last bucket).
+
+    Args:
+        histogram: Histogram dict with 'buckets' and 'count'.
+        percentile: Percentile between 0 and 100.
+    """
+    target = histogram['count'] * percentile / 100
+    cumulative = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS + [float('inf')], histogram['buckets']):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return bound
+    return float('inf')
+
+
+def merge_snapshots(snapshots):
+    """Returns (histograms, counters) summed over all worker snapshots."""
+    histograms = {}
+    counters = {}
+    for snapshot in snapshots:
+        for name, histogram in snapshot['histograms'].items():
+            merged = histograms.setdefault(
+                name, {'buckets': [0]*len(histogram['buckets']), 'count': 0, 'sum': 0.0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+            merged['count'] += histogram['count']
+            merged['sum'] += histogram['sum']
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return histograms, counters
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Summarize scraper metrics.')
+    arg_parser.add_argument('metrics_dir', help='Directory the scrapers exported metrics to.')
+    args = arg_parser.parse_args()
+
+    snapshots = load_metrics(args.metrics_dir)
+    histograms, counters = merge_snapshots(snapshots)
+    print(f'{"histogram":<28}{"count":>8}{"mean":>9}{"p50<=":>8}{"p95<=":>8}{"p99<=":>8}')
+    for name, histogram in sorted(histograms.items()):
+        mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0.0
+        print(f'{name:<28}{histogram["count"]:>8}{mean:>9.3f}'
+              + ''.join(f'{estimate_percentile(histogram, p):>8}' for p in (50, 95, 99)))
+    print()
+    for name, value in sorted(counters.items()):
+        print(f'{name:<28}{value:>12}')
+    print()
+    for snapshot in snapshots:
+        print(f'worker {snapshot["pid"]:<8}{snapshot["pages_per_second"]:8.3f} pages/sec '
+              f'over {snapshot["elapsed_seconds"]/3600:.1f} h')
+
+
+if __name__ == '__main__':
+    main()
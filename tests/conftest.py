@@ -0,0 +1,60 @@
+"""Shared fixtures for the checks in this directory.
+
+The Flask app reads its configuration from the environment when it's
+imported, so load_app imports flask/app.py under a new module name each time.
+Two apps loaded this way keep separate per-process state, like two serve.py
+workers.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLASK_DIR = os.path.join(REPO_DIR, 'flask')
+sys.path[:0] = [REPO_DIR, FLASK_DIR]
+
+NUM_USERS = 300
+NUM_ANIME = 120
+
+
+def load_app(module_name, artifact_root, **environ):
+    """Returns flask/app.py imported as module_name, serving artifact_root.
+
+    Args:
+        module_name: Name to import the module under.
+        artifact_root: Artifact root with a published version.
+        **environ: Other environment variables the app reads at import time.
+    """
+    os.environ.update(ARTIFACT_ROOT=artifact_root, ARTIFACT_POLL_SECONDS='0', **environ)
+    spec = importlib.util.spec_from_file_location(module_name,
+                                                  os.path.join(FLASK_DIR, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Flask finds the templates from the module's file in sys.modules
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def artifact_root(tmp_path_factory):
+    """Returns an artifact root with a published version of synthetic data."""
+    from benchmarks import load_test
+    root = str(tmp_path_factory.mktemp('artifacts'))
+    load_test.publish_synthetic_artifacts(root, NUM_USERS, NUM_ANIME)
+    return root
+
+
+@pytest.fixture
+def fold_in_store_dir(tmp_path):
+    """Returns an empty fold-in store directory for the test."""
+    return str(tmp_path / 'fold_in')
+
+
+@pytest.fixture
+def client(artifact_root, fold_in_store_dir):
+    """Returns a test client of a freshly loaded app."""
+    return load_app('app_under_test', artifact_root,
+                    FOLD_IN_STORE_DIR=fold_in_store_dir).app.test_client()
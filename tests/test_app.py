@@ -0,0 +1,169 @@
+"""Checks the fold-in API of flask/app.py on synthetic artifacts: bad request
+bodies get a 400 with a message instead of a 500, and users folded in by one
+serve.py worker are seen by the others, also when they are precomputed users.
+Each worker's cache of fold-in states is bounded, and ratings replace its
+entries rather than changing them. Malformed query arguments get a 400 and
+out-of-range ones are clamped.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import pytest
+
+from benchmarks import synthetic
+from recommendation import prefix_search
+
+from conftest import load_app
+
+USER_ID = 'fold_in_user'
+ANIMELIST_URL = f'/api/users/{USER_ID}/animelist'
+RATINGS_URL = f'/api/users/{USER_ID}/ratings'
+TITLES = synthetic.make_anime_titles(3)
+
+
+@pytest.fixture
+def folded_in(client):
+    """Returns client of an app that folded in USER_ID."""
+    response = client.put(ANIMELIST_URL, json={'animelist_titles': TITLES[:2],
+                                               'animelist_scores': ['7', 9]})
+    assert response.status_code == 200
+    assert response.get_json() == {'user_id': USER_ID, 'num_anime': 2}
+    return client
+
+
+def test_fold_in(folded_in):
+    response = folded_in.post(RATINGS_URL, json={'anime_title': TITLES[2], 'score': '-'})
+    assert response.get_json() == {'user_id': USER_ID, 'num_anime': 3}
+    response = folded_in.post(RATINGS_URL, json={'anime_title': TITLES[0], 'score': None})
+    assert response.get_json() == {'user_id': USER_ID, 'num_anime': 2}
+    recs = folded_in.get(f'/api/recommendation/{USER_ID}').get_json()['recs']
+    assert recs and not set(recs) & set(TITLES[1:])
+
+
+@pytest.mark.parametrize('body', [
+    None,
+    [TITLES, [7]],
+    {'animelist_titles': TITLES},
+    {'animelist_titles': TITLES, 'animelist_scores': [7, 8]},
+    {'animelist_titles': [1, 2], 'animelist_scores': [7, 8]},
+    {'animelist_titles': TITLES[:1], 'animelist_scores': [11]},
+    {'animelist_titles': TITLES[:1], 'animelist_scores': ['great']},
+    {'animelist_titles': TITLES[:1], 'animelist_scores': [True]},
+])
+def test_bad_animelist(client, body):
+    if body is None:
+        response = client.put(ANIMELIST_URL, data='not json',
+                              content_type='application/json')
+    else:
+        response = client.put(ANIMELIST_URL, json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+@pytest.mark.parametrize('body', [
+    {'anime_title': TITLES[2]},
+    {'score': 7},
+    {'anime_title': 'Not An Anime', 'score': 7},
+    {'anime_title': TITLES[2], 'score': 0},
+    {'anime_title': TITLES[2], 'score': [7]},
+])
+def test_bad_rating(folded_in, body):
+    response = folded_in.post(RATINGS_URL, json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+def test_rating_of_unknown_user(client):
+    response = client.post('/api/users/nobody/ratings', json={'anime_title': TITLES[0],
+                                                              'score': 7})
+    assert response.status_code == 404
+
+
+def test_workers_share_folded_in_users(artifact_root, fold_in_store_dir):
+    workers = [load_app(f'app_worker_{worker}', artifact_root,
+                        FOLD_IN_STORE_DIR=fold_in_store_dir).app.test_client()
+               for worker in range(2)]
+    response = workers[0].put(ANIMELIST_URL, json={'animelist_titles': TITLES[:2],
+                                                   'animelist_scores': [7, 9]})
+    assert response.status_code == 200
+    recs_url = f'/api/recommendation/{USER_ID}'
+    recs = workers[0].get(recs_url).get_json()['recs']
+    assert workers[1].get(recs_url).get_json()['recs'] == recs
+
+    # A rating on either worker updates the user on both, and neither misses
+    # the other's ratings
+    response = workers[1].post(RATINGS_URL, json={'anime_title': TITLES[2], 'score': 8})
+    assert response.get_json()['num_anime'] == 3
+    response = workers[0].post(RATINGS_URL, json={'anime_title': TITLES[0], 'score': None})
+    assert response.get_json()['num_anime'] == 2
+    recs = [worker.get(recs_url).get_json()['recs'] for worker in workers]
+    assert recs[0] == recs[1]
+    assert not set(recs[0]) & set(TITLES[1:])
+
+
+@pytest.mark.parametrize('url', [
+    '/recommendation/synthetic_user_0/lots',
+    '/api/recommendation/synthetic_user_0?adventurous_level=nan',
+    '/api/recommendation/synthetic_user_0?num_probe=many',
+    '/api/recommendation/synthetic_user_0?num_probe=1.5',
+    '/api/recommendation/synthetic_user_0?diversity=some',
+    f'/api/anime/{TITLES[0]}/similar?num_recs=ten',
+    '/api/suggest/users?q=synthetic&limit=five',
+])
+def test_malformed_arguments(client, url):
+    response = client.get(url)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+def test_out_of_range_arguments_are_clamped(client):
+    url = '/api/recommendation/synthetic_user_0'
+    recs = client.get(url + '?diversity=1').get_json()['recs']
+    assert client.get(url + '?diversity=7&num_probe=-3').get_json()['recs'] == recs
+    similar = client.get(f'/api/anime/{TITLES[0]}/similar?num_recs=100000').get_json()
+    assert 0 < len(similar['similar']) < 100000
+    assert client.get(f'/api/anime/{TITLES[0]}/similar?num_recs=-1').get_json()['similar'] == []
+    suggestions = client.get('/api/suggest/users?q=synthetic&limit=100000').get_json()
+    assert len(suggestions['suggestions']) == prefix_search.MAX_LIMIT
+
+
+def test_folded_in_precomputed_user(artifact_root, fold_in_store_dir):
+    workers = [load_app(f'app_worker_{worker}', artifact_root,
+                        FOLD_IN_STORE_DIR=fold_in_store_dir).app.test_client()
+               for worker in range(2)]
+    recs_url = '/api/recommendation/synthetic_user_0'
+    recs = workers[0].get(recs_url).get_json()['recs']
+    # The precomputed user's current recommendations go on their animelist, so
+    # the folded-in user must not get them
+    response = workers[0].put('/api/users/synthetic_user_0/animelist',
+                              json={'animelist_titles': recs[:3], 'animelist_scores': [8] * 3})
+    assert response.status_code == 200
+    for worker in workers:
+        assert not set(worker.get(recs_url).get_json()['recs']) & set(recs[:3])
+
+
+def test_fold_in_cache_is_bounded(artifact_root, fold_in_store_dir):
+    module = load_app('app_small_cache', artifact_root, FOLD_IN_STORE_DIR=fold_in_store_dir,
+                      FOLD_IN_CACHE_SIZE='2')
+    client = module.app.test_client()
+    user_ids = [f'{USER_ID}_{idx}' for idx in range(3)]
+    for user_id in user_ids:
+        client.put(f'/api/users/{user_id}/animelist',
+                   json={'animelist_titles': TITLES[:2], 'animelist_scores': [7, 9]})
+    assert list(module.folded_in_users) == user_ids[1:]
+    # The evicted user is folded in again from the store
+    assert client.get(f'/api/recommendation/{user_ids[0]}').get_json()['recs']
+    assert list(module.folded_in_users) == [user_ids[2], user_ids[0]]
+
+
+def test_ratings_replace_the_cached_state(artifact_root, fold_in_store_dir):
+    module = load_app('app_replace_state', artifact_root, FOLD_IN_STORE_DIR=fold_in_store_dir)
+    client = module.app.test_client()
+    client.put(ANIMELIST_URL, json={'animelist_titles': TITLES[:2],
+                                    'animelist_scores': [7, 9]})
+    state = module.folded_in_users[USER_ID]['state']
+    client.post(RATINGS_URL, json={'anime_title': TITLES[2], 'score': 8})
+    # A request still holding the old state sees it unchanged
+    assert state['num_on_animelist'] == 2
+    assert module.folded_in_users[USER_ID]['state']['num_on_animelist'] == 3
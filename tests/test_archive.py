@@ -0,0 +1,57 @@
+"""Checks src/archive.py with several threads appending at once, like the
+discovery thread pool in scrape.discover_mal_user_ids.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import os
+import threading
+
+from src import archive
+
+
+def test_concurrent_appends_can_all_be_read_back(tmp_path):
+    archive_dir = str(tmp_path)
+    num_threads, num_pages = 4, 50
+    # Random pages don't compress, so every write takes many gzip blocks
+    html = '<html>' + os.urandom(150000).hex() + '</html>'
+
+    def append(thread):
+        for page in range(num_pages):
+            archive.append_page(archive_dir, f'https://example.com/{thread}/{page}', html,
+                                fetched_at=0)
+
+    threads = [threading.Thread(target=append, args=(thread,)) for thread in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = list(archive.iter_pages(archive_dir))
+    assert sorted(record['url'] for record in records) == sorted(
+        f'https://example.com/{thread}/{page}'
+        for thread in range(num_threads) for page in range(num_pages))
+    assert all(record['html'] == html for record in records)
+
+
+def test_corrupt_records_are_skipped_and_counted(tmp_path, capsys):
+    archive_dir = str(tmp_path)
+    for page in range(6):
+        archive.append_page(archive_dir, f'https://example.com/{page}', f'<p>{page}</p>',
+                            fetched_at=0)
+    shard_path, = archive.get_shard_paths(archive_dir)
+    with open(shard_path, 'rb') as f:
+        data = f.read()
+    # Breaks the CRC at the end of the third record and cuts off the last one
+    starts = [idx for idx in range(len(data)) if data.startswith(archive.GZIP_MAGIC, idx)]
+    data = bytearray(data[:starts[5] + 12])
+    data[starts[3] - 8] ^= 0xff
+    with open(shard_path, 'wb') as f:
+        f.write(data)
+
+    counts = {}
+    records = list(archive.iter_shard(shard_path, counts))
+    assert [record['url'] for record in records] == \
+        [f'https://example.com/{page}' for page in [0, 1, 3, 4]]
+    assert counts == {'corrupt_records': 2}
+    assert capsys.readouterr().out.count('Skipping corrupt record') == 2
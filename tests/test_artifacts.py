@@ -0,0 +1,52 @@
+"""Checks publishing artifact versions with src/artifacts.py, and that the
+modules copied into flask/recommendation/ only differ by their imports.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from src import artifacts
+
+from conftest import FLASK_DIR, REPO_DIR
+
+# Modules the Flask app has its own copy of, because it doesn't import src
+COPIED_MODULES = ['ann.py', 'artifacts.py', 'fold_in.py']
+IDS = {'user_ids': [], 'anime_titles': [], 'anime_urls': [], 'image_urls': []}
+
+
+def publish(artifact_root, version=None):
+    return artifacts.publish_bundle(artifact_root, {'a': np.arange(3)}, IDS, version)
+
+
+def test_publishes_in_the_same_second_get_new_versions(tmp_path, monkeypatch):
+    artifact_root = str(tmp_path)
+    versions = [publish(artifact_root) for _ in range(20)]
+    assert len(set(versions)) == len(versions)
+    # Even if the clock gives a name that's taken, the publish picks another
+    names = iter([versions[0], versions[0], 'later'])
+    monkeypatch.setattr(artifacts, 'create_version', lambda: next(names))
+    assert publish(artifact_root) == 'later'
+    assert artifacts.get_current_version(artifact_root) == 'later'
+    assert not [name for name in os.listdir(artifact_root) if name.startswith('.')]
+
+
+def test_explicit_version_is_not_overwritten(tmp_path):
+    artifact_root = str(tmp_path)
+    publish(artifact_root, 'v1')
+    with pytest.raises(FileExistsError):
+        publish(artifact_root, 'v1')
+    assert artifacts.get_current_version(artifact_root) == 'v1'
+    assert sorted(os.listdir(artifact_root)) == ['CURRENT', 'v1']
+
+
+@pytest.mark.parametrize('module_file', COPIED_MODULES)
+def test_copies_only_differ_by_imports(module_file):
+    with open(os.path.join(REPO_DIR, 'src', module_file)) as f:
+        source = f.read().replace('from src import', 'from recommendation import')
+    with open(os.path.join(FLASK_DIR, 'recommendation', module_file)) as f:
+        assert f.read() == source
@@ -0,0 +1,104 @@
+"""Checks that folding a user in gives the same embedding and recommendations
+as the batch path, on a toy matrix small enough to fit exactly.
+
+anime_recommender.py gets a user's embedding from the NMF fit (NMF.transform
+for a fixed components_), ranks anime by cosine distance and keeps the top
+candidates that aren't on the animelist. src/fold_in.py must give the same
+recommendations without the fit.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+from sklearn.decomposition import NMF
+from sklearn.metrics import pairwise_distances
+
+from src import artifacts, fold_in
+
+NUM_RECS = 5
+
+
+@pytest.fixture(scope='module')
+def toy():
+    """Returns dict with a toy user-rating matrix, its NMF fit and anime
+    features."""
+    rng = np.random.default_rng(4444)
+    num_users, num_anime = 40, 30
+    scores = rng.integers(1, 11, (num_users, num_anime)).astype(float)
+    scores[rng.random((num_users, num_anime)) < 0.6] = 0
+    # Tight tolerances so NMF.transform is as exact as the fold-in solver
+    nmf = NMF(n_components=3, init='nndsvda', max_iter=5000, tol=1e-10, random_state=4444)
+    user_embedding = nmf.fit_transform(scores)
+    return {
+        'scores': scores,
+        'nmf': nmf,
+        'user_embedding': user_embedding,
+        'anime_titles': [f'Anime {idx}' for idx in range(num_anime)],
+        'anime_features': rng.random((num_anime, 8)).round(1)
+    }
+
+
+def get_batch_recs(toy, user_embedding, scores):
+    """Returns (collab_recs, content_recs) the way the precomputed artifacts
+    are built: cosine distances to every anime, top candidates, then the
+    unscored / unseen ones."""
+    components = toy['nmf'].components_
+    on_animelist = scores > 0
+    user_vector = toy['anime_features'][on_animelist].mean(axis=0)
+    collab_candidates = artifacts.get_candidates(
+        pairwise_distances(user_embedding[None], components.T, metric='cosine'))[0]
+    content_candidates = artifacts.get_candidates(
+        pairwise_distances(user_vector[None], toy['anime_features'], metric='cosine'))[0]
+    collab_recs = [toy['anime_titles'][idx] for idx in collab_candidates
+                   if scores[idx] == 0][:NUM_RECS]
+    content_recs = [toy['anime_titles'][idx] for idx in content_candidates
+                    if not on_animelist[idx]][:NUM_RECS]
+    return collab_recs, content_recs
+
+
+def create_state(toy, scores):
+    """Returns the fold-in state of a user with a row of scores."""
+    components = toy['nmf'].components_
+    rated = np.flatnonzero(scores)
+    return fold_in.create_fold_in_state(
+        [toy['anime_titles'][idx] for idx in rated], [str(int(scores[idx])) for idx in rated],
+        fold_in.create_anime_idx(toy['anime_titles']), components,
+        components @ components.T, toy['anime_features'])
+
+
+def test_fold_in_matches_fit(toy):
+    components = toy['nmf'].components_
+    for user in range(len(toy['scores'])):
+        state = create_state(toy, toy['scores'][user])
+        # The training embedding of the fit is the transform of the user's row
+        expected_embedding = toy['nmf'].transform(toy['scores'][user][None])[0]
+        np.testing.assert_allclose(state['user_embedding'], expected_embedding, atol=1e-4)
+        np.testing.assert_allclose(state['user_embedding'], toy['user_embedding'][user],
+                                   atol=1e-3)
+        assert fold_in.get_fold_in_recs(state, components, toy['anime_features'],
+                                        toy['anime_titles'], NUM_RECS) \
+            == get_batch_recs(toy, expected_embedding, toy['scores'][user])
+
+
+def test_rating_update_matches_fold_in_from_scratch(toy):
+    components = toy['nmf'].components_
+    anime_idx = fold_in.create_anime_idx(toy['anime_titles'])
+    scores = toy['scores'][0].copy()
+    state = create_state(toy, scores)
+    unrated = int(np.flatnonzero(scores == 0)[0])
+    rated = int(np.flatnonzero(scores)[0])
+    for idx, score in [(unrated, '9'), (rated, None), (unrated, '2')]:
+        fold_in.update_fold_in_rating(state, toy['anime_titles'][idx], score, anime_idx,
+                                      components, components @ components.T,
+                                      toy['anime_features'])
+        scores[idx] = 0 if score is None else float(score)
+        expected = create_state(toy, scores)
+        np.testing.assert_allclose(state['user_embedding'], expected['user_embedding'],
+                                   atol=1e-6)
+        np.testing.assert_allclose(fold_in.get_content_vector(state),
+                                   fold_in.get_content_vector(expected))
+        assert fold_in.get_fold_in_recs(state, components, toy['anime_features'],
+                                        toy['anime_titles'], NUM_RECS) \
+            == get_batch_recs(toy, expected['user_embedding'], scores)
@@ -0,0 +1,32 @@
+"""Checks that flask/recommendation/metrics.py can export from several threads
+at once, like /metrics requests racing the start_exporting thread.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import threading
+
+from recommendation import metrics
+
+
+def test_concurrent_exports(tmp_path):
+    metrics_dir = str(tmp_path)
+    num_threads, num_exports = 8, 200
+    errors = []
+
+    def export():
+        try:
+            for _ in range(num_exports):
+                metrics.export_metrics(metrics_dir)
+                metrics.load_metrics(metrics_dir)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=export) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(metrics.load_metrics(metrics_dir)) == 1
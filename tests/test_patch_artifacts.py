@@ -0,0 +1,98 @@
+"""Checks that src/patch_artifacts.py gives the same bundle as building it
+again from scratch with the patched users, on a small synthetic data set.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import NMF
+from sklearn.metrics import pairwise_distances
+
+from benchmarks import synthetic
+from src import artifacts, nmf_update, patch_artifacts, prefix_index
+
+NUM_USERS = 300
+NUM_ANIME = 80
+NUM_CHANGED = 20
+NUM_NEW = 10
+
+
+def create_arrays(user_score_matrix, history, user_embedding, components, anime_features):
+    """Returns the per-user arrays of a bundle built from scratch."""
+    user_vectors = np.asarray(history @ anime_features) / \
+        np.maximum(np.asarray(history.sum(axis=1)), 1)
+    arrays = {}
+    arrays['collab_candidates'], arrays['content_candidates'] = \
+        patch_artifacts.get_user_candidates(user_embedding, user_vectors, components,
+                                            anime_features)
+    for prefix, matrix in [('scored', user_score_matrix), ('history', history)]:
+        arrays[f'{prefix}_indptr'], arrays[f'{prefix}_indices'] = \
+            artifacts.get_nonzero_csr(matrix.toarray())
+    return arrays
+
+
+def test_patch_matches_rebuild(tmp_path):
+    user_score_matrix, history = synthetic.make_user_score_matrix(NUM_USERS, NUM_ANIME)
+    anime_titles = synthetic.make_anime_titles(NUM_ANIME)
+    anime_features = synthetic.make_anime_features(NUM_ANIME)
+    user_ids = synthetic.make_user_ids(NUM_USERS)
+    nmf = NMF(n_components=4, max_iter=500, random_state=4444)
+    user_embedding = nmf.fit_transform(user_score_matrix)
+    state = nmf_update.create_nmf_state(user_ids, anime_titles, user_score_matrix,
+                                        user_embedding, nmf.components_)
+    arrays = create_arrays(user_score_matrix, history, user_embedding, nmf.components_,
+                           anime_features)
+    arrays.update({'components': nmf.components_, 'anime_features': anime_features})
+    arrays.update(prefix_index.create_user_prefix_arrays(user_ids))
+    ids = {'user_ids': user_ids, 'anime_titles': anime_titles,
+           'anime_urls': [''] * NUM_ANIME, 'image_urls': [''] * NUM_ANIME}
+    artifact_root = str(tmp_path)
+    old_version = artifacts.publish_bundle(artifact_root, arrays, ids)
+
+    # Some users get the animelists of others, and a few new users arrive
+    rng = np.random.default_rng(4444)
+    changed = rng.choice(NUM_USERS, NUM_CHANGED, replace=False)
+    donors = rng.choice(NUM_USERS, NUM_CHANGED + NUM_NEW, replace=False)
+    new_user_ids = [f'new_user_{idx}' for idx in range(NUM_NEW)]
+    animelists = synthetic.make_complete_animelist(
+        user_score_matrix[donors], history[donors], anime_titles,
+        [user_ids[row] for row in changed] + new_user_ids)
+    version = patch_artifacts.patch_artifacts(state, animelists, artifact_root)
+    assert version != old_version
+    patched, patched_ids, _ = artifacts.load_bundle(os.path.join(artifact_root, version))
+
+    assert patched_ids['user_ids'] == user_ids + new_user_ids
+    expected_history = sparse.vstack([history, history[donors[NUM_CHANGED:]]]).tolil()
+    expected_history[changed] = history[donors[:NUM_CHANGED]]
+    expected_history = expected_history.tocsr()
+    expected = create_arrays(state['user_score_matrix'], expected_history,
+                             state['user_embedding'], nmf.components_, anime_features)
+    for name in ['scored_indptr', 'scored_indices', 'history_indptr', 'history_indices']:
+        np.testing.assert_array_equal(patched[name], expected[name], err_msg=name)
+    # Other users' candidates are copied as they were
+    unchanged = np.setdiff1d(np.arange(NUM_USERS), changed)
+    for name in ['collab_candidates', 'content_candidates']:
+        np.testing.assert_array_equal(patched[name][unchanged], arrays[name][unchanged],
+                                      err_msg=name)
+    # The delta's candidates are the nearest anime. Distances rather than
+    # indices are compared, since the last bit of a distance can depend on how
+    # many users pairwise_distances gets at once, which breaks ties differently.
+    delta_rows = np.concatenate([changed, np.arange(NUM_USERS, NUM_USERS + NUM_NEW)])
+    user_vectors = np.asarray(expected_history @ anime_features) / \
+        np.maximum(np.asarray(expected_history.sum(axis=1)), 1)
+    for name, dists in [
+            ('collab_candidates', pairwise_distances(
+                np.round(state['user_embedding'][delta_rows], 2),
+                np.round(nmf.components_.T, 2), metric='cosine')),
+            ('content_candidates', pairwise_distances(
+                user_vectors[delta_rows], anime_features, metric='cosine'))]:
+        np.testing.assert_allclose(
+            np.take_along_axis(dists, patched[name][delta_rows].astype(np.int64), axis=1),
+            np.sort(dists, axis=1)[:, :patched[name].shape[1]], err_msg=name)
+    # The anime-side arrays are hard-linked from the old version
+    assert os.path.samefile(os.path.join(artifact_root, old_version, 'components.npy'),
+                            os.path.join(artifact_root, version, 'components.npy'))
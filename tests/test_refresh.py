@@ -0,0 +1,187 @@
+"""Checks src/refresh.py against a local stand-in for myanimelist.net.
+
+The stand-in serves anime pages from a dict. Pages with an ETag answer a
+matching If-None-Match with 304 Not Modified; pages without one are always
+sent in full, like servers that don't support conditional requests.
+Animelists are loaded through a fake scrape module instead of chromedriver.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import http.server
+import sys
+import threading
+import types
+
+import pytest
+
+import src
+from src import parse, refresh
+
+ANIME_PAGE = '''<html><body>
+<h1 class="title-name">{title}</h1>
+<div><span class="dark_text">Type:</span><a>TV</a></div>
+<div><span class="dark_text">Episodes:</span> {num_episodes}</div>
+<!-- {markup} -->
+</body></html>'''
+
+ANIMELIST_ROW = '''<tbody class="list-item"><tr>
+<td class="data title clearfix"><a class="link sort">{title}</a></td>
+<td class="data score">{score}</td>
+</tr></tbody>'''
+
+
+def create_page(title, num_episodes=12, markup=''):
+    """Returns the HTML of a minimal anime page."""
+    return ANIME_PAGE.format(title=title, num_episodes=num_episodes, markup=markup)
+
+
+@pytest.fixture
+def stand_in():
+    """Yields dict with the stand-in server's base URL, its pages (path ->
+    (html or error status, etag or None)) and the headers of every request it
+    received."""
+    server_data = {'pages': {}, 'requests': []}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            server_data['requests'].append((self.path, dict(self.headers)))
+            html, etag = server_data['pages'][self.path]
+            if isinstance(html, int):
+                self.send_error(html)
+                return
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = html.encode('utf-8')
+            self.send_response(200)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server_data['base_url'] = f'http://127.0.0.1:{server.server_port}/anime/'
+    yield server_data
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def parse_calls(monkeypatch):
+    """Returns list that gets an entry every time refresh parses a page."""
+    calls = []
+    create_page_soup = parse.create_page_soup
+
+    def counting_create_page_soup(html, *args):
+        calls.append(html)
+        return create_page_soup(html, *args)
+
+    monkeypatch.setattr(parse, 'create_page_soup', counting_create_page_soup)
+    return calls
+
+
+def refresh_anime(stand_in, mal_ids, fetch_state):
+    return refresh.refresh_anime_data(mal_ids, fetch_state, stand_in['base_url'], delay=False)
+
+
+def test_not_modified_pages_are_skipped(stand_in, parse_calls):
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop'), '"v1"')
+    fetch_state = {}
+    changed = refresh_anime(stand_in, [1], fetch_state)
+    assert [anime_data['title_main'] for anime_data in changed] == ['Cowboy Bebop']
+    assert fetch_state[stand_in['base_url'] + '1']['etag'] == '"v1"'
+
+    # The second refresh sends the stored ETag, gets a 304 and parses nothing
+    changed = refresh_anime(stand_in, [1], fetch_state)
+    assert changed == []
+    assert stand_in['requests'][-1][1].get('If-None-Match') == '"v1"'
+    assert len(parse_calls) == 1
+
+
+def test_changed_pages_are_in_the_delta(stand_in):
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop'), '"v1"')
+    stand_in['pages']['/anime/2'] = (create_page('Trigun'), '"v1"')
+    fetch_state = {}
+    refresh_anime(stand_in, [1, 2], fetch_state)
+    stand_in['pages']['/anime/2'] = (create_page('Trigun', num_episodes=26), '"v2"')
+    changed = refresh_anime(stand_in, [1, 2], fetch_state)
+    assert [(anime_data['mal_id'], anime_data['num_episodes']) for anime_data in changed] \
+        == [(2, '26')]
+
+
+def test_unchanged_html_is_not_parsed(stand_in, parse_calls):
+    # Without an ETag every refresh downloads the page again
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop'), None)
+    fetch_state = {}
+    refresh_anime(stand_in, [1], fetch_state)
+    assert refresh_anime(stand_in, [1], fetch_state) == []
+    assert 'If-None-Match' not in stand_in['requests'][-1][1]
+    assert len(parse_calls) == 1
+
+
+def test_markup_only_changes_are_not_in_the_delta(stand_in, parse_calls):
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop', markup='ad 1'), None)
+    fetch_state = {}
+    refresh_anime(stand_in, [1], fetch_state)
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop', markup='ad 2'), None)
+    # The new HTML is parsed, but the parsed data is the same
+    assert refresh_anime(stand_in, [1], fetch_state) == []
+    assert len(parse_calls) == 2
+
+
+def test_failed_pages_dont_stop_the_refresh(stand_in):
+    stand_in['pages']['/anime/1'] = (503, None)
+    stand_in['pages']['/anime/2'] = (create_page('Trigun'), '"v1"')
+    fetch_state = {}
+    changed = refresh_anime(stand_in, [1, 2], fetch_state)
+    assert [anime_data['title_main'] for anime_data in changed] == ['Trigun']
+    assert 'html_hash' not in fetch_state[stand_in['base_url'] + '1']
+
+    # The failed page is refreshed once the server answers again
+    stand_in['pages']['/anime/1'] = (create_page('Cowboy Bebop'), '"v1"')
+    changed = refresh_anime(stand_in, [1, 2], fetch_state)
+    assert [anime_data['title_main'] for anime_data in changed] == ['Cowboy Bebop']
+
+
+def test_unusable_animelists_are_skipped(monkeypatch):
+    rows = ANIMELIST_ROW.format(title='Trigun', score='8')
+    pages = {
+        'ok_user': f'<html><body><table>{rows}</table></body></html>',
+        'private_user': '<html><body><div class="badresult">Access denied</div></body></html>',
+        'timeout_user': '<html><body></body></html>',
+        'empty_user': '<html><body><table></table></body></html>',
+    }
+
+    class WebDriverException(Exception):
+        pass
+
+    def fetch_html_selenium(url, driver, archive_dir=None):
+        user_id = url.rsplit('/', 1)[1]
+        if user_id not in pages:
+            raise WebDriverException('page crashed')
+        return pages[user_id]
+
+    scrape = types.SimpleNamespace(driver=None, fetch_html_selenium=fetch_html_selenium,
+                                   WebDriverException=WebDriverException)
+    monkeypatch.setitem(sys.modules, 'src.scrape', scrape)
+    monkeypatch.setattr(src, 'scrape', scrape, raising=False)
+
+    fetch_state = {}
+    changed = refresh.refresh_animelist_data(list(pages) + ['crashed_user'], fetch_state,
+                                             base_url='https://example.com/animelist/')
+    assert [(animelist_data['user_id'], animelist_data['animelist_titles'])
+            for animelist_data in changed] == [('ok_user', ['Trigun'])]
+    # Only the usable animelist's hashes are stored, so the others are parsed
+    # again next time rather than looking unchanged
+    assert [url.rsplit('/', 1)[1] for url, url_state in fetch_state.items()
+            if 'html_hash' in url_state] == ['ok_user']
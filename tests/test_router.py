@@ -0,0 +1,72 @@
+"""Checks flask/router.py in front of two shards of the synthetic artifacts,
+each served by its own app on a local port.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import os
+import re
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from src import artifacts, sharding
+
+from conftest import load_app
+
+NUM_SHARDS = 2
+
+
+@pytest.fixture(scope='module')
+def shards(artifact_root, tmp_path_factory):
+    """Yields dict with the 'router' test client, the 'unsharded' app's test
+    client and the 'user_ids' of the synthetic artifacts."""
+    arrays, ids, _ = artifacts.load_bundle(
+        os.path.join(artifact_root, artifacts.get_current_version(artifact_root)))
+    sharded_root = str(tmp_path_factory.mktemp('sharded'))
+    sharding.publish_sharded_bundles(sharded_root, arrays, ids, NUM_SHARDS)
+    servers, shard_urls = [], []
+    for shard in range(NUM_SHARDS):
+        shard_app = load_app(f'app_shard_{shard}', sharding.get_shard_root(sharded_root, shard),
+                             FOLD_IN_STORE_DIR=str(tmp_path_factory.mktemp('fold_in')))
+        server = make_server('127.0.0.1', 0, shard_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        shard_urls.append(f'http://127.0.0.1:{server.server_port}')
+    # router.py imports flask/recommendation, which is on sys.path like app.py
+    import router
+    unsharded = load_app('app_unsharded', artifact_root,
+                         FOLD_IN_STORE_DIR=str(tmp_path_factory.mktemp('fold_in')))
+    yield {'router': router.create_router(shard_urls, timeout=10).test_client(),
+           'unsharded': unsharded.app.test_client(), 'user_ids': ids['user_ids']}
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get_suggestions(response):
+    """Returns the user IDs suggested on an unknown user page."""
+    assert response.status_code == 404
+    match = re.search(r'Did you mean ([^<?]*)\?', response.get_data(as_text=True))
+    return match.group(1).split(', ') if match else []
+
+
+def test_unknown_user_suggestions_come_from_every_shard(shards):
+    # A typo of a user ID that hashes to another shard than the user's
+    user_id = shards['user_ids'][17]
+    unknown_id = next(user_id + suffix for suffix in 'abcdefghij'
+                      if sharding.get_shard(user_id + suffix, NUM_SHARDS)
+                      != sharding.get_shard(user_id, NUM_SHARDS))
+    expected = get_suggestions(shards['unsharded'].get(f'/recommendation/{unknown_id}/1'))
+    assert user_id in expected
+    assert get_suggestions(shards['router'].get(f'/recommendation/{unknown_id}/1')) == expected
+
+
+def test_suggestions_are_merged_up_to_the_limit(shards):
+    url = '/api/suggest/users?q=synthetic_user_1&limit='
+    expected = shards['unsharded'].get(url + '100000').get_json()['suggestions']
+    assert shards['router'].get(url + '100000').get_json()['suggestions'] == expected
+    assert shards['router'].get(url + '-2').get_json()['suggestions'] == []
+    assert shards['router'].get(url + 'five').status_code == 400
@@ -0,0 +1,33 @@
+"""Checks that src/telemetry.py doesn't lose updates from concurrent threads,
+like the discovery thread pool in scrape.discover_mal_user_ids.
+
+Run from the repo root:
+    python -m pytest tests
+"""
+
+import threading
+
+from src import telemetry
+
+
+def test_concurrent_updates_are_not_lost(tmp_path, monkeypatch):
+    monkeypatch.setattr(telemetry, '_counters', {})
+    monkeypatch.setattr(telemetry, '_histograms', {})
+    num_threads, num_updates = 8, 20000
+
+    def record():
+        for update in range(num_updates):
+            telemetry.increment('pages.test.ok')
+            telemetry.observe('fetch_seconds.test', 0.01)
+            if update % 1000 == 0:
+                telemetry.export_metrics(str(tmp_path))
+
+    threads = [threading.Thread(target=record) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snapshot = telemetry.get_metrics()
+    assert snapshot['counters']['pages.test.ok'] == num_threads * num_updates
+    assert snapshot['histograms']['fetch_seconds.test']['count'] == num_threads * num_updates
+    assert len(telemetry.load_metrics(str(tmp_path))) == 1